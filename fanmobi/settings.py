@@ -11,6 +11,8 @@ https://docs.djangoproject.com/en/1.8/ref/settings/
 """
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
+import hashlib
+import hmac
 import os
 
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -143,6 +145,7 @@ MEDIA_URL='media/'
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
+        'main.auth.TokenAuthentication',
         'main.auth.FanmobiAuthentication',
         'rest_framework.authentication.BasicAuthentication'
         # 'rest_framework.authentication.SessionAuthentication',
@@ -161,6 +164,76 @@ REST_FRAMEWORK = {
     )
 }
 
+# Location updates. When LOCATION_BUFFER_ENABLED is True, only the latest
+# position of each profile is kept in memory and positions are written to the
+# database in batches (see main.buffers.LocationBuffer). Each process buffers
+# its own updates: a move is only seen by other processes after the next
+# flush (up to LOCATION_BUFFER_FLUSH_SECONDS later)
+LOCATION_BUFFER_ENABLED = False
+LOCATION_BUFFER_FLUSH_SECONDS = 5
+LOCATION_BUFFER_MAX_PENDING = 500
+
+# Memory-mapped snapshot of artist locations shared by all workers (see
+# main.geo_snapshot). Set GEO_SNAPSHOT_PATH to None to disable it. The snapshot
+# is rebuilt from the database once it is older than
+# GEO_SNAPSHOT_MAX_AGE_SECONDS
+GEO_SNAPSHOT_PATH = None
+GEO_SNAPSHOT_MAX_AGE_SECONDS = 300
+
+# Per-process cache of artists-in-radius candidates (see
+# main.cache.GeoQueryCache). Queries are grouped by the cell of a grid of
+# GEO_QUERY_CACHE_PRECISION degrees containing their point and by their
+# radius rounded up to a multiple of GEO_QUERY_CACHE_RADIUS_STEP km
+GEO_QUERY_CACHE_ENABLED = True
+GEO_QUERY_CACHE_PRECISION = 0.001
+GEO_QUERY_CACHE_RADIUS_STEP = 0.1
+GEO_QUERY_CACHE_TTL_SECONDS = 15
+GEO_QUERY_CACHE_MAX_ENTRIES = 10000
+
+# When MESSAGE_FANOUT_ON_WRITE is True, new messages are copied into an inbox
+# row per follower (see main.models.InboxEntry) so reading a fan's unread
+# messages doesn't need to join followers, messages and dismissals. Run
+# `manage.py runscript rebuild_message_inbox` after turning it on
+MESSAGE_FANOUT_ON_WRITE = False
+
+# Streaming of new messages to fans (see main.broker). With the 'local' broker,
+# streams only see messages created in the same process. With 'change_log',
+# each process with open streams polls the change log every
+# MESSAGE_BROKER_POLL_SECONDS. Streams send a keepalive comment every
+# MESSAGE_STREAM_HEARTBEAT_SECONDS and end after MESSAGE_STREAM_MAX_SECONDS
+MESSAGE_BROKER = 'local'
+MESSAGE_BROKER_POLL_SECONDS = 1
+MESSAGE_STREAM_HEARTBEAT_SECONDS = 15
+MESSAGE_STREAM_MAX_SECONDS = 300
+MESSAGE_STREAM_RETRY_MILLISECONDS = 3000
+
+# Messages older than this are moved to the message archive by the
+# archive_messages script
+MESSAGE_ARCHIVE_AFTER_DAYS = 90
+
+# Sessions are read through the cache, falling back to the database. The
+# user logged in with recently seen session keys is also kept in the cache
+# (see main.cache.SessionUserCache) for up to SESSION_USER_CACHE_TTL_SECONDS.
+# Logouts and user changes remove it, for every process sharing the cache
+SESSION_ENGINE = 'django.contrib.sessions.backends.cached_db'
+SESSION_USER_CACHE_ENABLED = True
+SESSION_USER_CACHE_TTL_SECONDS = 30
+
+# Signed tokens issued by the login endpoint (see main.tokens). Tokens are
+# signed with AUTH_TOKEN_KEYS[AUTH_TOKEN_KEY_ID] and accepted if signed with
+# any key in AUTH_TOKEN_KEYS. To rotate keys, add a new key and make it the
+# current one, then remove the old key AUTH_TOKEN_LIFETIME_SECONDS later.
+# The key is derived from SECRET_KEY (rather than being SECRET_KEY itself),
+# so tokens can't be used to attack the secret Django signs other data with
+AUTH_TOKEN_KEYS = {'1': hmac.new(SECRET_KEY.encode('utf-8'),
+    b'fanmobi.auth-token-key.1', hashlib.sha256).hexdigest()}
+AUTH_TOKEN_KEY_ID = '1'
+AUTH_TOKEN_LIFETIME_SECONDS = 3600
+# The token denylist (logged out tokens) is kept in the AUTH_TOKEN_CACHE
+# cache, which must be shared by every process accepting tokens (a startup
+# check enforces it unless DEBUG is on)
+AUTH_TOKEN_CACHE = 'default'
+
 # django-cors-headers
 # TODO: lock this down in production
 CORS_ORIGIN_ALLOW_ALL = True
@@ -0,0 +1,13 @@
+"""
+Application configuration
+"""
+from django.apps import AppConfig
+from django.core import checks
+
+
+class MainConfig(AppConfig):
+    name = 'main'
+
+    def ready(self):
+        import main.tokens as tokens
+        checks.register(tokens.check_denylist_cache, checks.Tags.security)
@@ -2,11 +2,32 @@
 Auth
 """
 from django.contrib.auth.models import User
+from django.db.models.signals import post_delete
+from django.db.models.signals import post_save
 from rest_framework import authentication
 from rest_framework import exceptions
 
+import main.cache as cache
+import main.errors as errors
+import main.tokens as tokens
+
 class FanmobiAuthentication(authentication.BaseAuthentication):
+    """
+    Authenticates the user logged in with the session (see views.LoginView)
+
+    Users of recently seen sessions are kept in the session user cache (see
+    cache.SessionUserCache), in which case neither the session nor the user
+    is read from the database
+    """
     def authenticate(self, request):
+        users = cache.get_session_user_cache()
+        # read from the cookie, without loading the session
+        session_key = request.session.session_key
+        if users is not None and session_key:
+            user = users.get(session_key)
+            if user is not None:
+                return (user, None)
+
         if 'username' not in request.session:
             return None
 
@@ -15,4 +36,45 @@ class FanmobiAuthentication(authentication.BaseAuthentication):
         except User.DoesNotExist:
             raise exceptions.AuthenticationFailed('No such user')
 
-        return (user, None)
\ No newline at end of file
+        if users is not None and session_key:
+            users.set(session_key, user)
+        return (user, None)
+
+class TokenAuthentication(authentication.BaseAuthentication):
+    """
+    Authenticates requests with an `Authorization: Bearer <token>` header
+    (see main.tokens)
+
+    request.user is a tokens.TokenUser and request.auth the token's claims
+    """
+    keyword = 'Bearer'
+
+    def authenticate(self, request):
+        header = authentication.get_authorization_header(request).split()
+        if not header or header[0].lower() != self.keyword.lower().encode():
+            return None
+        if len(header) != 2:
+            raise exceptions.AuthenticationFailed('Invalid token header')
+        try:
+            claims = tokens.verify(header[1].decode('ascii'))
+        except (errors.InvalidInput, UnicodeError) as e:
+            raise exceptions.AuthenticationFailed(str(e))
+        return (tokens.TokenUser(claims), claims)
+
+def forget_session(session_key):
+    """
+    Remove a session from the session user cache (call on logout)
+    """
+    users = cache.get_session_user_cache()
+    if users is not None and session_key:
+        users.forget_session(session_key)
+
+def _forget_user(sender, instance, **kwargs):
+    users = cache.get_session_user_cache()
+    if users is not None:
+        users.forget_user(instance.pk)
+
+post_save.connect(_forget_user, sender=User,
+    dispatch_uid='fanmobi_forget_saved_user')
+post_delete.connect(_forget_user, sender=User,
+    dispatch_uid='fanmobi_forget_deleted_user')
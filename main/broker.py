@@ -0,0 +1,202 @@
+"""
+Publish/subscribe for new artist messages
+
+Fans streaming their inbox (see views.FanMessageViewSet.stream) subscribe to
+the artists they follow, and services.create_message publishes every new
+message. Two brokers are available (settings.MESSAGE_BROKER):
+
+    local       subscribers are notified directly by the publishing thread.
+                Only works when messages are created in the same process as
+                the streams (tests, runserver)
+    change_log  a background thread in each process with subscribers polls
+                the change log (models.ChangeLogEntry) for new messages every
+                settings.MESSAGE_BROKER_POLL_SECONDS, so messages created by
+                any worker reach streams served by any other. This costs one
+                query per process per interval, no matter how many streams
+                are open
+
+Subscriptions block on queue.Queue, so they are cheap to hold open on a
+gevent worker (see deploy/roles/fanmobi_backend/files/gunicorn-stream.conf)
+"""
+import collections
+import logging
+import queue
+import threading
+import time
+
+from django.conf import settings
+from django.db import connection
+
+import main.models as models
+
+# Get an instance of a logger
+logger = logging.getLogger('fanmobi')
+
+class Subscription(object):
+    """
+    New messages from a set of artists, as they are published
+    """
+    def __init__(self, broker, artist_ids):
+        self.broker = broker
+        self.artist_ids = frozenset(artist_ids)
+        self._queue = queue.Queue()
+
+    def put(self, message_id):
+        self._queue.put(message_id)
+
+    def get(self, timeout=None):
+        """
+        Wait for the next message id (up to timeout seconds)
+
+        Returns None if no message was published in time
+        """
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        self.broker.unsubscribe(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class LocalBroker(object):
+    """
+    Delivers published messages to subscribers in this process
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        # artist id -> subscriptions
+        self._subscriptions = collections.defaultdict(set)
+
+    def subscribe(self, artist_ids):
+        """
+        Returns a Subscription to new messages from the given artists
+        """
+        subscription = Subscription(self, artist_ids)
+        with self._lock:
+            for artist_id in subscription.artist_ids:
+                self._subscriptions[artist_id].add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            for artist_id in subscription.artist_ids:
+                subscriptions = self._subscriptions.get(artist_id, None)
+                if subscriptions is not None:
+                    subscriptions.discard(subscription)
+                    if not subscriptions:
+                        del self._subscriptions[artist_id]
+
+    def subscriber_count(self):
+        with self._lock:
+            return len(set().union(*self._subscriptions.values()))
+
+    def publish(self, message_id, artist_id):
+        """
+        Notify subscribers of a new message (call once it is committed)
+        """
+        self.deliver(message_id, artist_id)
+
+    def deliver(self, message_id, artist_id):
+        with self._lock:
+            subscriptions = list(self._subscriptions.get(artist_id, ()))
+        for subscription in subscriptions:
+            subscription.put(message_id)
+
+
+class ChangeLogBroker(LocalBroker):
+    """
+    Delivers messages recorded in the change log to subscribers in this
+    process
+
+    Publishing is a no-op, since services.create_message already records
+    the message in the change log
+    """
+    def __init__(self):
+        super(ChangeLogBroker, self).__init__()
+        self._poller = None
+        self._last_seen = None
+        # serializes subscribe() so two first subscribers don't both move
+        # _last_seen
+        self._subscribe_lock = threading.Lock()
+
+    def subscribe(self, artist_ids):
+        with self._subscribe_lock:
+            if self._last_seen is None or not self.subscriber_count():
+                # deliver messages logged from now on. Set before the
+                # subscription exists (rather than on the next poll) so
+                # nothing logged in between is missed, and reset after the
+                # broker was idle so old messages aren't delivered
+                self._last_seen = self._latest_entry_id()
+            subscription = super(ChangeLogBroker, self).subscribe(artist_ids)
+        with self._lock:
+            if self._poller is None:
+                self._start_poller()
+        return subscription
+
+    def publish(self, message_id, artist_id):
+        pass
+
+    def poll(self):
+        """
+        Deliver messages logged since the last poll
+
+        Returns the number of messages delivered
+        """
+        Log = models.ChangeLogEntry
+        if self._last_seen is None:
+            # only deliver messages created from now on
+            self._last_seen = self._latest_entry_id()
+            return 0
+        entries = list(Log.objects.filter(id__gt=self._last_seen,
+            kind=Log.MESSAGE, action=Log.CREATED).order_by('id').values_list(
+            'id', 'object_id', 'artist_id'))
+        for entry_id, message_id, artist_id in entries:
+            self.deliver(message_id, artist_id)
+            self._last_seen = entry_id
+        return len(entries)
+
+    def _latest_entry_id(self):
+        return models.ChangeLogEntry.objects.order_by('-id').values_list('id',
+            flat=True).first() or 0
+
+    def _start_poller(self):
+        self._poller = threading.Thread(target=self._poll_periodically,
+            name='message-broker-poller')
+        self._poller.daemon = True
+        self._poller.start()
+
+    def _poll_periodically(self):
+        while True:
+            try:
+                if self.subscriber_count():
+                    self.poll()
+            except Exception as e:
+                logger.error('unable to poll the change log: %s' % e)
+            finally:
+                # this thread has its own database connection
+                connection.close()
+            time.sleep(settings.MESSAGE_BROKER_POLL_SECONDS)
+
+
+BROKERS = {
+    'local': LocalBroker,
+    'change_log': ChangeLogBroker
+}
+
+_broker = None
+
+def get_broker():
+    """
+    Returns this process's broker (as configured by settings.MESSAGE_BROKER)
+    """
+    global _broker
+    if _broker is None:
+        _broker = BROKERS[settings.MESSAGE_BROKER]()
+    return _broker
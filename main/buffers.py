@@ -0,0 +1,127 @@
+"""
+In-memory write buffers
+"""
+import atexit
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db import connection
+from django.db import transaction
+
+import main.models as models
+import main.utils as utils
+
+# Get an instance of a logger
+logger = logging.getLogger('fanmobi')
+
+class LocationBuffer(object):
+    """
+    Coalesces high-frequency location updates
+
+    Only the latest position of each profile is kept in memory. Pending
+    positions are written to the database in one transaction when the buffer
+    is flushed, which happens every settings.LOCATION_BUFFER_FLUSH_SECONDS (from
+    a background thread), when settings.LOCATION_BUFFER_MAX_PENDING profiles
+    are waiting, and when the process exits
+
+    Positions stay pending (and visible through get() and pending()) until
+    the transaction writing them commits. The buffer is per process: queries
+    in this process should overlay pending() on top of what they read from
+    the database, and other processes only see a move once it is flushed
+    (the geo snapshot, if enabled, is updated immediately)
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        # one flush at a time
+        self._flush_lock = threading.Lock()
+        self._pending = {}
+        self._flusher = None
+
+    def add(self, profile_id, latitude, longitude):
+        """
+        Buffer the new location of a profile, replacing any pending location
+        """
+        with self._lock:
+            self._pending[profile_id] = (latitude, longitude)
+            full = len(self._pending) >= settings.LOCATION_BUFFER_MAX_PENDING
+            if self._flusher is None:
+                self._start_flusher()
+        if full:
+            self.flush()
+
+    def get(self, profile_id):
+        """
+        Returns the pending (latitude, longitude) of a profile, or None
+        """
+        with self._lock:
+            return self._pending.get(profile_id, None)
+
+    def pending(self):
+        """
+        Returns a copy of all pending locations ({profile_id: (lat, lon)})
+        """
+        with self._lock:
+            return dict(self._pending)
+
+    def flush(self):
+        """
+        Write all pending locations to the database
+
+        Returns the number of profiles written
+        """
+        with self._flush_lock:
+            with self._lock:
+                batch = dict(self._pending)
+            if not batch:
+                return 0
+            self._write(batch)
+            # drop what was written, unless it has been superseded since
+            with self._lock:
+                for profile_id, location in batch.items():
+                    if self._pending.get(profile_id, None) == location:
+                        del self._pending[profile_id]
+        logger.debug('flushed %d buffered locations' % len(batch))
+        return len(batch)
+
+    def _write(self, batch):
+        with transaction.atomic():
+            for profile_id, (lat, lon) in batch.items():
+                models.BasicProfile.objects.filter(id=profile_id).update(
+                    current_latitude=lat, current_longitude=lon,
+                    geo_cell=utils.get_geo_cell(lat, lon))
+
+    def clear(self):
+        """
+        Discard all pending locations
+        """
+        with self._lock:
+            self._pending = {}
+
+    def _start_flusher(self):
+        self._flusher = threading.Thread(target=self._flush_periodically,
+            name='location-buffer-flusher')
+        self._flusher.daemon = True
+        self._flusher.start()
+
+    def _flush_periodically(self):
+        while True:
+            time.sleep(settings.LOCATION_BUFFER_FLUSH_SECONDS)
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error('unable to flush buffered locations: %s' % e)
+            finally:
+                # this thread has its own database connection
+                connection.close()
+
+
+location_buffer = LocationBuffer()
+
+@atexit.register
+def _flush_on_exit():
+    try:
+        location_buffer.flush()
+    except Exception as e:
+        logger.error('unable to flush buffered locations on exit: %s' % e)
@@ -0,0 +1,320 @@
+"""
+Caches
+"""
+import collections
+import logging
+import math
+import threading
+import time
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache as django_cache
+
+import main.constants as constants
+import main.utils as utils
+
+# Get an instance of a logger
+logger = logging.getLogger('fanmobi')
+
+class LRUCache(object):
+    """
+    A thread-safe, size-bounded cache with least-recently-used eviction and an
+    optional time-to-live for entries
+
+    Args:
+        max_size: maximum number of entries
+        ttl: seconds an entry stays valid, or None to keep entries until they
+            are evicted
+        on_evict: optional callable(key, value) invoked (with the cache lock
+            held) whenever an entry is removed for any reason
+    """
+    def __init__(self, max_size, ttl=None, on_evict=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._on_evict = on_evict
+        self._entries = collections.OrderedDict()
+        self.lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self._entries:
+                return default
+            expires_at, value = self._entries[key]
+            if expires_at is not None and expires_at < time.time():
+                self._remove(key)
+                return default
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            if key in self._entries:
+                self._remove(key)
+            expires_at = time.time() + self.ttl if self.ttl is not None else None
+            self._entries[key] = (expires_at, value)
+            while len(self._entries) > self.max_size:
+                self._remove(next(iter(self._entries)))
+
+    def delete(self, key):
+        with self.lock:
+            if key in self._entries:
+                self._remove(key)
+
+    def clear(self):
+        with self.lock:
+            for key in list(self._entries):
+                self._remove(key)
+
+    def _remove(self, key):
+        expires_at, value = self._entries.pop(key)
+        if self._on_evict:
+            self._on_evict(key, value)
+
+
+class _Flight(object):
+    """
+    A computation in progress that other callers can wait on
+    """
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.failed = False
+
+
+class GeoQueryCache(object):
+    """
+    Caches the candidate artist ids of radius queries
+
+    The query point is mapped to the cell of a grid of
+    settings.GEO_QUERY_CACHE_PRECISION degrees containing it, and the radius
+    is rounded up to a multiple of settings.GEO_QUERY_CACHE_RADIUS_STEP km,
+    so nearby queries share an entry. An entry holds the artists within the
+    rounded radius (plus the distance from the cell's center to its corners)
+    of the cell's center, which includes every artist any query mapping to
+    it can match. Callers check the candidates exactly against their own
+    point and radius (see services.get_cached_artists_in_radius)
+
+    Entries expire after settings.GEO_QUERY_CACHE_TTL_SECONDS and the least
+    recently used are evicted beyond settings.GEO_QUERY_CACHE_MAX_ENTRIES.
+    When an artist moves, entries whose query circle overlaps the artist's
+    old or new grid cell are invalidated. Concurrent misses for the same key
+    wait for a single computation
+
+    The cache is per process: a move in another worker is only picked up
+    when the entry expires
+    """
+    def __init__(self):
+        self._cache = LRUCache(settings.GEO_QUERY_CACHE_MAX_ENTRIES,
+            ttl=settings.GEO_QUERY_CACHE_TTL_SECONDS, on_evict=self._unindex)
+        # grid cell -> keys of entries whose query circle overlaps it
+        self._keys_by_cell = collections.defaultdict(set)
+        # keys of entries covering too many cells to index
+        self._wide_keys = set()
+        self._in_flight = {}
+        # incremented on every invalidation
+        self._version = 0
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.invalidations = 0
+
+    def get_key(self, latitude, longitude, radius):
+        precision = settings.GEO_QUERY_CACHE_PRECISION
+        radius_step = settings.GEO_QUERY_CACHE_RADIUS_STEP
+        return (int(math.floor(float(latitude) / precision)),
+            int(math.floor(float(longitude) / precision)),
+            int(math.ceil(float(radius) / radius_step)))
+
+    def get_covering_query(self, key):
+        """
+        Returns the (latitude, longitude, radius) of a circle containing the
+        query circle of every point and radius mapping to a key
+        """
+        precision = settings.GEO_QUERY_CACHE_PRECISION
+        radius_step = settings.GEO_QUERY_CACHE_RADIUS_STEP
+        # no point of a cell is further from its center than half of the
+        # cell's diagonal (measured along a meridian, where degrees are
+        # longest)
+        center_error = math.sqrt(2) * math.radians(precision / 2) * \
+            constants.EARTH_RADIUS_KM
+        return ((key[0] + 0.5) * precision, (key[1] + 0.5) * precision,
+            key[2] * radius_step + center_error)
+
+    def get_artist_ids(self, latitude, longitude, radius, compute):
+        """
+        Get the ids of the artists that may be within a radius of the given
+        coordinates (a superset, see get_covering_query)
+
+        Args:
+            latitude: the latitude (in degrees) of the center point
+            longitude: the longitude (in degrees) of the center point
+            radius: the radius (in km)
+            compute: callable(latitude, longitude, radius) returning a list
+                of artist ids, called with the covering point and radius on a
+                miss
+
+        Returns:
+            a list of artist ids
+        """
+        key = self.get_key(latitude, longitude, radius)
+        while True:
+            with self._cache.lock:
+                entry = self._cache.get(key)
+                if entry is not None:
+                    self.hits += 1
+                    return entry[0]
+                flight = self._in_flight.get(key, None)
+                if flight is None:
+                    flight = self._in_flight[key] = _Flight()
+                    self.misses += 1
+                    version = self._version
+                    break
+                self.coalesced += 1
+            flight.done.wait()
+            if not flight.failed:
+                return flight.result
+            # the computation we waited on failed, try again ourselves
+
+        covering = self.get_covering_query(key)
+        try:
+            flight.result = compute(*covering)
+        except Exception:
+            flight.failed = True
+            raise
+        finally:
+            with self._cache.lock:
+                del self._in_flight[key]
+                # don't cache a result an invalidation may have raced with
+                if not flight.failed and version == self._version:
+                    cells = utils.get_cells_in_radius(*covering)
+                    self._cache.set(key, (flight.result, cells))
+                    if cells is None:
+                        self._wide_keys.add(key)
+                    else:
+                        for cell in cells:
+                            self._keys_by_cell[cell].add(key)
+            flight.done.set()
+        return flight.result
+
+    def invalidate_cells(self, *cells):
+        """
+        Invalidate all entries whose query circle overlaps any of the given
+        grid cells (None values are ignored)
+        """
+        with self._cache.lock:
+            self._version += 1
+            keys = set(self._wide_keys)
+            for cell in cells:
+                if cell is not None:
+                    keys.update(self._keys_by_cell.get(cell, ()))
+            for key in keys:
+                self._cache.delete(key)
+            self.invalidations += len(keys)
+
+    def clear(self):
+        with self._cache.lock:
+            self._version += 1
+            self._cache.clear()
+
+    def stats(self):
+        with self._cache.lock:
+            return {
+                'entries': len(self._cache),
+                'hits': self.hits,
+                'misses': self.misses,
+                'coalesced': self.coalesced,
+                'invalidations': self.invalidations
+            }
+
+    def _unindex(self, key, value):
+        ids, cells = value
+        if cells is None:
+            self._wide_keys.discard(key)
+            return
+        for cell in cells:
+            keys = self._keys_by_cell.get(cell, None)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._keys_by_cell[cell]
+
+
+_geo_query_cache = None
+
+def get_geo_query_cache():
+    """
+    Returns this process's GeoQueryCache, or None if it is disabled
+    """
+    global _geo_query_cache
+    if not settings.GEO_QUERY_CACHE_ENABLED:
+        return None
+    if _geo_query_cache is None:
+        _geo_query_cache = GeoQueryCache()
+    return _geo_query_cache
+
+
+class SessionUserCache(object):
+    """
+    Caches the user logged in with each session key
+
+    Lets main.auth.FanmobiAuthentication skip reading the session and the
+    user on requests from recently seen sessions. Entries are kept in the
+    cache backend shared by all workers (django.core.cache, see
+    settings.CACHES) for settings.SESSION_USER_CACHE_TTL_SECONDS, so logouts
+    and user changes handled by any worker are seen by all of them: logging
+    out deletes the session's entry, and a user change replaces the user's
+    version, which turns every entry stored with the old one into a miss
+    """
+    SESSION_PREFIX = 'fanmobi-session-user:'
+    VERSION_PREFIX = 'fanmobi-user-version:'
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, session_key):
+        """
+        Returns the user logged in with a session, or None
+        """
+        entry = django_cache.get(self.SESSION_PREFIX + session_key)
+        if entry is not None:
+            user, version = entry
+            if django_cache.get(self.VERSION_PREFIX + str(user.pk)) == version:
+                self.hits += 1
+                return user
+        self.misses += 1
+        return None
+
+    def set(self, session_key, user):
+        ttl = settings.SESSION_USER_CACHE_TTL_SECONDS
+        version_key = self.VERSION_PREFIX + str(user.pk)
+        version = django_cache.get(version_key)
+        if version is None:
+            django_cache.add(version_key, uuid.uuid4().hex, ttl)
+            version = django_cache.get(version_key)
+        django_cache.set(self.SESSION_PREFIX + session_key, (user, version),
+            ttl)
+
+    def forget_session(self, session_key):
+        django_cache.delete(self.SESSION_PREFIX + session_key)
+
+    def forget_user(self, user_id):
+        django_cache.delete(self.VERSION_PREFIX + str(user_id))
+
+
+_session_user_cache = None
+
+def get_session_user_cache():
+    """
+    Returns this process's SessionUserCache, or None if it is disabled
+    """
+    global _session_user_cache
+    if not settings.SESSION_USER_CACHE_ENABLED:
+        return None
+    if _session_user_cache is None:
+        _session_user_cache = SessionUserCache()
+    return _session_user_cache
@@ -4,3 +4,47 @@ Constants
 FACEBOOK_ME_ENDPOINT = 'https://graph.facebook.com/v2.5/me'
 VALID_IMAGE_EXTENSIONS = ['png', 'jpg', 'jpeg', 'gif']
 VALID_IMAGE_TYPES = ['avatar', 'icon']
+
+# maximum number of values to put in a single SQL IN clause (SQLite allows at
+# most 999 parameters per query)
+MAX_IN_CLAUSE_SIZE = 500
+
+# number of inbox rows built in memory per bulk insert when fanning out a
+# message (the database backend may split each insert further)
+INBOX_FANOUT_BATCH_SIZE = 1000
+
+# mean radius of the Earth (in km) used for all distance calculations
+EARTH_RADIUS_KM = 6371.0
+# size (in decimal degrees) of a cell in the fixed latitude/longitude grid used
+# to index locations (0.5 degrees is roughly 55km of latitude)
+GEO_CELL_SIZE_DEGREES = 0.5
+# radius queries touching more grid cells than this fall back to scanning
+# every located row instead of building a huge IN clause
+GEO_MAX_QUERY_CELLS = 400
+# number of artists returned per page by the nearest artists endpoint
+NEAREST_ARTISTS_DEFAULT_LIMIT = 10
+NEAREST_ARTISTS_MAX_LIMIT = 100
+# shows are indexed by the (UTC) day they start on
+SHOW_TIME_BUCKET_SECONDS = 24 * 60 * 60
+# longest a show may run (a whole number of buckets)
+SHOW_MAX_DURATION_SECONDS = 7 * SHOW_TIME_BUCKET_SECONDS
+# number of earlier buckets to search for shows that are still running at the
+# start of a time window (enough to reach the longest show)
+SHOW_TIME_BUCKET_LOOKBACK = SHOW_MAX_DURATION_SECONDS // SHOW_TIME_BUCKET_SECONDS
+# default and maximum number of days ahead to search for shows near a user
+SHOWS_IN_RADIUS_DEFAULT_DAYS = 7
+SHOWS_IN_RADIUS_MAX_DAYS = 90
+
+# a delta sync covering more changes than this returns a full sync instead
+# (kept within MAX_IN_CLAUSE_SIZE, since changed objects are loaded by id)
+SYNC_MAX_CHANGES = 500
+
+# number of fans whose dismissals are compacted per transaction (see
+# scripts/compact_dismissals.py)
+COMPACTION_BATCH_SIZE = 100
+# maximum number of dismissal rows recreated when following artists with
+# messages under a fan's read-up-to mark (see services._uncover_artists)
+UNCOVER_MAX_DISMISSALS = 500
+
+# rows read per query when streaming an export
+EXPORT_CHUNK_SIZE = 1000
@@ -0,0 +1,273 @@
+"""
+Shared, memory-mapped snapshot of artist locations
+
+The snapshot is a single file holding a fixed size header followed by four
+arrays (structure-of-arrays layout), each with room for `capacity` entries:
+
+    artist ids      int32
+    profile ids     int32
+    latitudes       float32 (NaN if unknown)
+    longitudes      float32 (NaN if unknown)
+
+Every gunicorn worker maps the same file, so candidate lookups for radius
+queries are answered straight from the shared pages without touching the ORM.
+Location changes are written into the mapping in place. A full rebuild (from
+the database) writes a new file and atomically replaces the old one, which
+readers notice on their next lookup. Writers serialize on an flock()ed lock
+file next to the snapshot
+
+Lookups return None whenever the snapshot can't be trusted (missing,
+unreadable, or older than settings.GEO_SNAPSHOT_MAX_AGE_SECONDS), and callers
+fall back to the database
+"""
+import fcntl
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+
+import numpy as np
+
+from django.conf import settings
+from django.db import connection
+
+import main.buffers as buffers
+import main.models as models
+import main.utils as utils
+
+# Get an instance of a logger
+logger = logging.getLogger('fanmobi')
+
+MAGIC = b'FMGEO001'
+# magic, capacity, count, generation, built_at, updated_at
+HEADER = struct.Struct('<8sIIQdd')
+HEADER_SIZE = 64
+MIN_CAPACITY = 1024
+# dtype of each array, in file order
+ARRAYS = (('artist_ids', np.int32), ('profile_ids', np.int32),
+    ('lats', np.float32), ('lons', np.float32))
+
+
+class _Mapping(object):
+    """
+    A mapped snapshot file and the array views into it
+    """
+    def __init__(self, path, writable=False):
+        mode = 'r+b' if writable else 'rb'
+        with open(path, mode) as f:
+            self.key = os.fstat(f.fileno()).st_ino
+            access = mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ
+            self.mm = mmap.mmap(f.fileno(), 0, access=access)
+        magic, self.capacity = HEADER.unpack_from(self.mm)[:2]
+        size = HEADER_SIZE + sum(np.dtype(dtype).itemsize * self.capacity
+            for name, dtype in ARRAYS)
+        if magic != MAGIC or len(self.mm) != size:
+            raise ValueError('invalid geo snapshot %s' % path)
+        offset = HEADER_SIZE
+        for name, dtype in ARRAYS:
+            setattr(self, name, np.frombuffer(self.mm, dtype=dtype,
+                count=self.capacity, offset=offset))
+            offset += np.dtype(dtype).itemsize * self.capacity
+
+    def close(self):
+        """
+        Unmap the file (the array views must not be used afterwards)
+        """
+        for name, dtype in ARRAYS:
+            setattr(self, name, None)
+        self.mm.close()
+
+    def header(self):
+        """
+        Returns (count, generation, built_at, updated_at)
+        """
+        return HEADER.unpack_from(self.mm)[2:]
+
+    def write_header(self, count, generation, built_at, updated_at):
+        HEADER.pack_into(self.mm, 0, MAGIC, self.capacity, count, generation,
+            built_at, updated_at)
+
+
+class GeoSnapshot(object):
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._mapping = None
+        self._rebuilder = None
+
+    def _get_mapping(self):
+        """
+        Returns the current (read-only) mapping, remapping if the file has
+        been replaced
+        """
+        key = os.stat(self.path).st_ino
+        with self._lock:
+            if self._mapping is None or self._mapping.key != key:
+                self._mapping = _Mapping(self.path)
+            return self._mapping
+
+    def _acquire_write_lock(self, blocking=True):
+        """
+        Returns an open (flock()ed) lock file, or None if blocking is False
+        and another process holds the lock
+        """
+        lock_file = open(self.path + '.lock', 'a+')
+        flags = fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB
+        try:
+            fcntl.flock(lock_file, flags)
+        except (IOError, OSError):
+            lock_file.close()
+            return None
+        return lock_file
+
+    def get_artists_in_radius(self, latitude, longitude, radius):
+        """
+        Get the ids of all artists within a radius of the given coordinates
+
+        Coordinates are stored as float32, so distances are accurate to about
+        a meter
+
+        Returns:
+            a list of artist ids, or None if the snapshot is missing or stale
+            (in which case a rebuild is started in the background)
+        """
+        try:
+            mapping = self._get_mapping()
+        except (OSError, IOError, ValueError) as e:
+            logger.debug('geo snapshot unavailable: %s' % e)
+            self.rebuild_in_background()
+            return None
+        count, generation, built_at, updated_at = mapping.header()
+        if time.time() - built_at > settings.GEO_SNAPSHOT_MAX_AGE_SECONDS:
+            logger.debug('geo snapshot is stale')
+            self.rebuild_in_background()
+            return None
+        with np.errstate(invalid='ignore'):
+            distances, mask = utils.get_points_inside_radius(latitude,
+                longitude, mapping.lats[:count], mapping.lons[:count], radius)
+        return mapping.artist_ids[:count][mask].tolist()
+
+    def rebuild(self, blocking=True):
+        """
+        Rebuild the snapshot from the database (plus any locations buffered in
+        this process) and atomically replace the file
+
+        Returns False if blocking is False and another process is already
+        writing the snapshot
+        """
+        lock_file = self._acquire_write_lock(blocking)
+        if lock_file is None:
+            return False
+        try:
+            rows = list(models.ArtistProfile.objects.values_list('id',
+                'basic_profile__id', 'basic_profile__current_latitude',
+                'basic_profile__current_longitude'))
+            pending = buffers.location_buffer.pending()
+            capacity = max(MIN_CAPACITY, 2 * len(rows))
+            columns = {
+                'artist_ids': np.zeros(capacity, dtype=np.int32),
+                'profile_ids': np.zeros(capacity, dtype=np.int32),
+                'lats': np.full(capacity, np.nan, dtype=np.float32),
+                'lons': np.full(capacity, np.nan, dtype=np.float32)
+            }
+            for i, (artist_id, profile_id, lat, lon) in enumerate(rows):
+                if profile_id in pending:
+                    lat, lon = pending[profile_id]
+                columns['artist_ids'][i] = artist_id
+                columns['profile_ids'][i] = profile_id
+                if lat is not None and lon is not None:
+                    columns['lats'][i] = lat
+                    columns['lons'][i] = lon
+            now = time.time()
+            header = HEADER.pack(MAGIC, capacity, len(rows), 0, now, now)
+            tmp_path = '%s.%d.tmp' % (self.path, os.getpid())
+            with open(tmp_path, 'wb') as f:
+                f.write(header.ljust(HEADER_SIZE, b'\0'))
+                for name, dtype in ARRAYS:
+                    f.write(columns[name].tobytes())
+            os.replace(tmp_path, self.path)
+            logger.debug('rebuilt geo snapshot with %d artists' % len(rows))
+            return True
+        finally:
+            lock_file.close()
+
+    def rebuild_in_background(self):
+        """
+        Start a rebuild in a background thread, unless one is already running
+
+        Returns the thread, or None if a rebuild is already running
+        """
+        with self._lock:
+            if self._rebuilder is not None and self._rebuilder.is_alive():
+                return None
+            self._rebuilder = threading.Thread(target=self._rebuild_quietly,
+                name='geo-snapshot-rebuilder')
+            self._rebuilder.daemon = True
+            self._rebuilder.start()
+            return self._rebuilder
+
+    def _rebuild_quietly(self):
+        try:
+            self.rebuild(blocking=False)
+        except Exception as e:
+            logger.error('unable to rebuild geo snapshot: %s' % e)
+        finally:
+            # this thread has its own database connection
+            connection.close()
+
+    def update_location(self, profile_id, latitude, longitude,
+            artist_id=None):
+        """
+        Update the location of a profile in place
+
+        Profiles that are not in the snapshot (fans) are ignored, unless an
+        artist_id is given, in which case the artist is appended. If there is
+        no room left, the snapshot is marked stale so the next lookup rebuilds
+        it
+        """
+        if not os.path.exists(self.path):
+            return
+        lock_file = self._acquire_write_lock()
+        mapping = None
+        try:
+            mapping = _Mapping(self.path, writable=True)
+            count, generation, built_at, updated_at = mapping.header()
+            lat = np.nan if latitude is None else latitude
+            lon = np.nan if longitude is None else longitude
+            index = np.flatnonzero(mapping.profile_ids[:count] == profile_id)
+            if index.size:
+                index = index[0]
+            elif artist_id is None:
+                return
+            elif count < mapping.capacity:
+                index = count
+                count += 1
+                mapping.artist_ids[index] = artist_id
+                mapping.profile_ids[index] = profile_id
+            else:
+                mapping.write_header(count, generation + 1, 0, time.time())
+                return
+            mapping.lats[index] = lat
+            mapping.lons[index] = lon
+            mapping.write_header(count, generation + 1, built_at, time.time())
+        finally:
+            if mapping is not None:
+                mapping.close()
+            lock_file.close()
+
+
+_snapshots = {}
+
+def get_snapshot():
+    """
+    Returns the GeoSnapshot for settings.GEO_SNAPSHOT_PATH, or None if the
+    snapshot is disabled
+    """
+    path = getattr(settings, 'GEO_SNAPSHOT_PATH', None)
+    if not path:
+        return None
+    if path not in _snapshots:
+        _snapshots[path] = GeoSnapshot(path)
+    return _snapshots[path]
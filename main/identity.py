@@ -0,0 +1,139 @@
+"""
+Who is making a request
+
+The user's profile, roles and artist id are resolved once per request (see
+get_identity) and shared by the permission classes, views, serializers and
+services, instead of each of them looking up the profile and groups again
+"""
+import main.models as models
+import main.tokens as tokens
+
+class Identity(object):
+    """
+    An authenticated user, with their profile, roles and artist id
+
+    The profile itself is only loaded when needed if the identity comes from
+    a signed token (see for_token)
+    """
+    def __init__(self, user, profile_id, roles, artist_id=None,
+            profile=None):
+        self.user = user
+        self.profile_id = profile_id
+        self.roles = frozenset(roles)
+        self.artist_id = artist_id
+        self._profile = profile
+
+    @property
+    def username(self):
+        return self.user.username
+
+    @property
+    def profile(self):
+        if self._profile is None:
+            self._profile = models.BasicProfile.objects.get(
+                id=self.profile_id)
+        return self._profile
+
+    @property
+    def is_admin(self):
+        return 'ADMIN' in self.roles
+
+    def has_role(self, *roles):
+        return not self.roles.isdisjoint(roles)
+
+    def highest_role(self):
+        """
+        ADMIN > ARTIST > FAN
+        """
+        for name, _ in models.BasicProfile.ROLES:
+            if name in self.roles:
+                return name
+        return ''
+
+    def can_access(self, profile_id):
+        """
+        Determine if this user should have access to a profile
+
+        Args:
+            profile_id: id of the models.BasicProfile to access
+        """
+        try:
+            profile_id = int(profile_id)
+        except (TypeError, ValueError):
+            return False
+        return self.is_admin or profile_id == self.profile_id
+
+    def can_manage_artist(self, artist_id):
+        """
+        Determine if this user can act as an artist (create shows and
+        messages, etc)
+
+        Args:
+            artist_id: id of the models.ArtistProfile
+        """
+        try:
+            artist_id = int(artist_id)
+        except (TypeError, ValueError):
+            return False
+        return self.is_admin or artist_id == self.artist_id
+
+    @classmethod
+    def for_user(cls, user):
+        """
+        Resolve the identity of a user (with one query)
+
+        Returns None if the user has no profile
+        """
+        profile = models.BasicProfile.objects.select_related('artist').filter(
+            user=user).first()
+        if profile is None:
+            return None
+        # already loaded
+        profile.user = user
+        roles = profile.role_names()
+        try:
+            artist_id = profile.artist.id
+        except models.ArtistProfile.DoesNotExist:
+            artist_id = None
+        return cls(user, profile.id, roles, artist_id=artist_id,
+            profile=profile)
+
+    @classmethod
+    def for_token(cls, user):
+        """
+        Resolve the identity of a user authenticated with a signed token,
+        from the token's claims (without queries)
+
+        Args:
+            user: tokens.TokenUser
+        """
+        claims = user.claims
+        roles = [name for name, bit in models.BasicProfile.ROLES
+            if claims['roles'] & bit]
+        return cls(user, claims['pid'], roles, artist_id=claims['aid'])
+
+
+def get_identity(request):
+    """
+    Returns the Identity of the user making a request, or None if they
+    aren't authenticated or have no profile
+
+    The identity is resolved on first use and kept on the request
+
+    Args:
+        request: a rest_framework Request (or django HttpRequest)
+    """
+    user = request.user
+    # kept on the HttpRequest that rest_framework's Request wraps
+    http_request = getattr(request, '_request', request)
+    # (user id, identity), in case the user changes (e.g. on login)
+    resolved = getattr(http_request, 'fanmobi_identity', None)
+    if resolved is not None and resolved[0] == user.pk:
+        return resolved[1]
+    identity = None
+    if isinstance(user, tokens.TokenUser):
+        identity = Identity.for_token(user)
+    elif user.is_authenticated():
+        identity = Identity.for_user(user)
+    http_request.fanmobi_identity = (user.pk, identity)
+    return identity
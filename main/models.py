@@ -11,11 +11,14 @@ from django.core.exceptions import ValidationError
 from django.core.validators import MaxValueValidator, MinValueValidator
 from django.core.validators import RegexValidator
 from django.db import models
+from django.db.models.signals import m2m_changed
+from django.db import transaction
 from django.conf import settings
 
 from PIL import Image
 
 import main.constants as constants
+import main.utils as utils
 
 # Get an instance of a logger
 logger = logging.getLogger('fanmobi')
@@ -36,6 +39,23 @@ class Genre(models.Model):
         return self.name
 
 
+def exclude_counters(instance, counters, kwargs):
+    """
+    Keep save() of an existing row from overwriting counter columns
+
+    Counters are only changed in the database (with F() expressions), so the
+    in-memory values may be stale. Returns the save() kwargs with every field
+    but the counters in update_fields
+    """
+    if instance._state.adding or kwargs.get('force_insert', False):
+        return kwargs
+    update_fields = kwargs.get('update_fields', None)
+    if update_fields is None:
+        update_fields = [f.name for f in instance._meta.concrete_fields
+            if not f.primary_key]
+    kwargs['update_fields'] = [f for f in update_fields if f not in counters]
+    return kwargs
+
 class ArtistProfile(models.Model):
     basic_profile = models.OneToOneField('BasicProfile', related_name='artist')
     name = models.CharField(max_length=256)
@@ -43,7 +63,9 @@ class ArtistProfile(models.Model):
     bio = models.CharField(max_length=8192, blank=True, null=True)
     website = models.URLField(max_length=2048, blank=True, null=True)
     facebook_id = models.CharField(max_length=256, blank=True, null=True)
-    facebook_page_id = models.CharField(max_length=256, blank=True, null=True)
+    # indexed for services.import_follows
+    facebook_page_id = models.CharField(max_length=256, blank=True, null=True,
+        db_index=True)
     twitter_id = models.CharField(max_length=256, blank=True, null=True)
     youtube_id = models.CharField(max_length=256, blank=True, null=True)
     soundcloud_id = models.CharField(max_length=256, blank=True, null=True)
@@ -66,9 +88,16 @@ class ArtistProfile(models.Model):
         related_name='connected_artists',
         db_table='artist_user'
     )
+    # number of connected_users, maintained by services.follow_artist and
+    # friends (and repaired by the repair_follow_counts script)
+    follower_count = models.IntegerField(default=0)
     # thank you message
     # thank you attachment
 
+    def save(self, *args, **kwargs):
+        super(ArtistProfile, self).save(*args,
+            **exclude_counters(self, ('follower_count',), kwargs))
+
 
 class BasicProfile(models.Model):
     """
@@ -79,7 +108,9 @@ class BasicProfile(models.Model):
     Note that some information (username, email, last_login, date_joined) is
     held in the associated Django User model. In addition, the user's role
     (USER, ARTIST, or ADMIN) is represented by the Group
-    associated with the Django User model
+    associated with the Django User model. The groups are mirrored in the
+    roles bitmask, so role checks don't need to query them. The bitmask is
+    recomputed whenever a user's groups change (see sync_roles)
 
     Notes on use of contrib.auth.models.User model:
         * first_name and last_name are not used
@@ -93,12 +124,28 @@ class BasicProfile(models.Model):
     user = models.OneToOneField(settings.AUTH_USER_MODEL, null=True,
         blank=True)
 
-    current_latitude = models.CharField(max_length=16, blank=True, null=True)
-    current_longitude = models.CharField(max_length=16, blank=True, null=True)
+    current_latitude = models.FloatField(blank=True, null=True)
+    current_longitude = models.FloatField(blank=True, null=True)
+    # grid cell of the current location (see utils.get_geo_cell). This is
+    # kept in sync with current_latitude/current_longitude by save()
+    geo_cell = models.IntegerField(blank=True, null=True, db_index=True)
     avatar = models.ForeignKey('Image', related_name='basic_profile_avatar',
         null=True, blank=True)
     icon = models.ForeignKey('Image', related_name='basic_profile_icon',
         null=True, blank=True)
+    # number of artists followed, maintained like ArtistProfile.follower_count
+    following_count = models.IntegerField(default=0)
+    # bitmask of the user's Groups (FAN, ARTIST, ADMIN)
+    roles = models.PositiveSmallIntegerField(default=0, db_index=True)
+
+    # role bits, from most to least privileged
+    FAN = 1
+    ARTIST = 2
+    ADMIN = 4
+    ROLES = (('ADMIN', ADMIN), ('ARTIST', ARTIST), ('FAN', FAN))
+
+    class Meta:
+        index_together = (('current_latitude', 'current_longitude'),)
 
     def __repr__(self):
         return 'Profile: %s' % self.user.username
@@ -106,6 +153,25 @@ class BasicProfile(models.Model):
     def __str__(self):
         return self.user.username
 
+    def save(self, *args, **kwargs):
+        """
+        Keep the spatial index (geo_cell) up to date on every location write
+        (and leave following_count and roles alone: roles is only written
+        by sync_roles, from the user's groups)
+        """
+        self.geo_cell = utils.get_geo_cell(self.current_latitude,
+            self.current_longitude)
+        kwargs = exclude_counters(self, ('following_count', 'roles'), kwargs)
+        update_fields = kwargs.get('update_fields', None)
+        if update_fields is not None and 'geo_cell' not in update_fields and \
+                ('current_latitude' in update_fields or
+                'current_longitude' in update_fields):
+            kwargs['update_fields'] = list(update_fields) + ['geo_cell']
+        super(BasicProfile, self).save(*args, **kwargs)
+
+    # group name -> id (see get_group_ids)
+    _group_ids = {}
+
     @staticmethod
     def create_groups():
         """
@@ -113,6 +179,7 @@ class BasicProfile(models.Model):
         their declaration here (NOTE that this must be invoked manually
         after the server has started)
         """
+        BasicProfile._group_ids.clear()
         # create the different Groups (Roles) of users
         group = django.contrib.auth.models.Group.objects.create(
             name='FAN')
@@ -121,36 +188,113 @@ class BasicProfile(models.Model):
         group = django.contrib.auth.models.Group.objects.create(
             name='ADMIN')
 
+    @staticmethod
+    def get_group_ids(names):
+        """
+        Returns the ids of Groups by name, read from the database once per
+        process
+
+        Raises:
+            django.contrib.auth.models.Group.DoesNotExist for unknown names
+        """
+        group_ids = BasicProfile._group_ids
+        missing = [name for name in names if name not in group_ids]
+        if missing:
+            group_ids.update(django.contrib.auth.models.Group.objects.filter(
+                name__in=missing).values_list('name', 'id'))
+        for name in names:
+            if name not in group_ids:
+                raise django.contrib.auth.models.Group.DoesNotExist(
+                    'No group named %s' % name)
+        return [group_ids[name] for name in names]
+
+    @classmethod
+    def role_mask(cls, names):
+        """
+        Returns the bitmask of role (Group) names. Unknown names are ignored
+        """
+        bits = dict(cls.ROLES)
+        mask = 0
+        for name in names:
+            mask |= bits.get(name, 0)
+        return mask
+
+    @classmethod
+    def role_masks_with(cls, name):
+        """
+        Returns every bitmask that includes a role (to filter on with an IN,
+        which unlike a bitwise AND can use the index on roles)
+        """
+        bit = cls.role_mask([name])
+        if not bit:
+            return []
+        all_roles = sum(role_bit for _, role_bit in cls.ROLES)
+        return [mask for mask in range(all_roles + 1) if mask & bit]
+
+    def role_names(self):
+        """
+        Names of the user's roles, from most to least privileged
+        """
+        return [name for name, bit in self.ROLES if self.roles & bit]
+
+    def has_role(self, *names):
+        return bool(self.roles & self.role_mask(names))
+
     def highest_role(self):
         """
         ADMIN > ARTIST > FAN
         """
-        groups = self.user.groups.all()
-        group_names = [i.name for i in groups]
-
-        if 'ADMIN' in group_names:
-            return 'ADMIN'
-        elif 'ARTIST' in group_names:
-            return 'ARTIST'
-        elif 'FAN' in group_names:
-            return 'FAN'
-        else:
-            # TODO: raise exception?
-            logger.error('User %s has invalid Group' % self.user.username)
-            return ''
+        names = self.role_names()
+        if names:
+            return names[0]
+        # TODO: raise exception?
+        logger.error('User %s has invalid Group' % self.user.username)
+        return ''
+
+    def add_role(self, name):
+        """
+        Add the user to a Group and record the role
+        """
+        # the stored roles are updated by sync_roles
+        self.user.groups.add(*BasicProfile.get_group_ids([name]))
+        self.roles |= self.role_mask([name])
+
+    @classmethod
+    def sync_roles(cls, user_ids):
+        """
+        Recompute the roles of the profiles of some users from their Groups
+        """
+        Membership = django.contrib.auth.models.User.groups.through
+        for i in range(0, len(user_ids), constants.MAX_IN_CLAUSE_SIZE):
+            chunk = user_ids[i:i + constants.MAX_IN_CLAUSE_SIZE]
+            names = {}
+            for user_id, name in Membership.objects.filter(
+                    user_id__in=chunk).values_list('user_id', 'group__name'):
+                names.setdefault(user_id, []).append(name)
+            # mask -> user ids, so there is one UPDATE per distinct mask
+            users_by_mask = {}
+            for user_id in chunk:
+                users_by_mask.setdefault(cls.role_mask(names.get(user_id, [])),
+                    []).append(user_id)
+            for mask, mask_user_ids in users_by_mask.items():
+                cls.objects.filter(user_id__in=mask_user_ids).update(
+                    roles=mask)
 
     @staticmethod
     def create_user(username, **kwargs):
         """
         Create a new User and Fan object
 
+        The User, its groups and the BasicProfile are written in one
+        transaction. Without a password, the user gets an unusable one (which
+        skips hashing): anonymous and Facebook users never log in with one
+
         kwargs:
             password
             groups (['group1_name', 'group2_name'])
 
         """
-        # TODO: what to make default password?
-        password = kwargs.get('password', 'password')
+        password = kwargs.get('password', None)
 
         email = kwargs.get('email', '')
 
@@ -158,28 +302,28 @@ class BasicProfile(models.Model):
         # if this user is an ORG_STEWARD or APPS_MALL_STEWARD, give them
         # access to the admin site
         groups = kwargs.get('groups', ['FAN'])
-        if 'ADMIN' in groups:
-            user = django.contrib.auth.models.User.objects.create_superuser(
-                username=username, email=email, password=password)
-            user.save()
-            # logger.warn('creating superuser: %s, password: %s' % (username, password))
-        else:
-            user = django.contrib.auth.models.User.objects.create_user(
-                username=username, email=email, password=password)
-            user.save()
-            # logger.info('creating user: %s' % username)
-
-        # add user to group(s) (i.e. Roles - FAN, ARTIST, ADMIN). If no
-        # specific Group is provided, we will default to FAN
-        for i in groups:
-            g = django.contrib.auth.models.Group.objects.get(name=i)
-            user.groups.add(g)
-
-        # get additional profile information (so far none)
-
-        # create the fan object and associate it with the User
-        f = BasicProfile(user=user)
-        f.save()
+        group_ids = BasicProfile.get_group_ids(groups)
+        User = django.contrib.auth.models.User
+        with transaction.atomic():
+            if 'ADMIN' in groups:
+                user = User.objects.create_superuser(
+                    username=username, email=email, password=password)
+                # logger.warn('creating superuser: %s, password: %s' % (username, password))
+            else:
+                user = User.objects.create_user(
+                    username=username, email=email, password=password)
+                # logger.info('creating user: %s' % username)
+
+            # add user to group(s) (i.e. Roles - FAN, ARTIST, ADMIN). If no
+            # specific Group is provided, we will default to FAN
+            User.groups.through.objects.bulk_create([User.groups.through(
+                user_id=user.id, group_id=group_id) for group_id in group_ids])
+
+            # get additional profile information (so far none)
+
+            # create the fan object and associate it with the User
+            f = BasicProfile(user=user, roles=BasicProfile.role_mask(groups))
+            f.save()
 
         # if 'ARTIST' in groups:
         #     # if the name is blank, just use their username (facebook id) for now
@@ -188,26 +332,219 @@ class BasicProfile(models.Model):
 
         return f
 
+
+def _sync_profile_roles(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    Keep BasicProfile.roles in step with the users' Groups, however they are
+    changed (e.g. through the user and group endpoints or the admin site)
+    """
+    if reverse and action == 'pre_clear':
+        # the group's users, before they are removed from it
+        instance._cleared_user_ids = list(instance.user_set.values_list('id',
+            flat=True))
+        return
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        user_ids = [instance.pk]
+    elif action == 'post_clear':
+        user_ids = instance.__dict__.pop('_cleared_user_ids', [])
+    else:
+        user_ids = list(pk_set)
+    BasicProfile.sync_roles(user_ids)
+
+m2m_changed.connect(_sync_profile_roles,
+    sender=django.contrib.auth.models.User.groups.through,
+    dispatch_uid='fanmobi_sync_profile_roles')
+
+
 class Message(models.Model):
     """
     A message (created by an artist for their users)
     """
     text = models.CharField(max_length=8192)
-    created_at = models.DateTimeField(auto_now=True)
+    # set once, so editing a message doesn't move it in keyset pages
+    created_at = models.DateTimeField(auto_now_add=True)
     attachment = models.URLField(max_length=2048, blank=True, null=True)
     artist = models.ForeignKey(ArtistProfile, related_name='messages')
+    # the unique (message_id, basicprofile_id) index on this table backs the
+    # NOT EXISTS probe in services.get_unread_messages
     dismissed_by = models.ManyToManyField(
         'BasicProfile',
         related_name='dismissed_messages',
         db_table='message_basic_profile'
     )
 
+    class Meta:
+        # keyset pagination of an artist's messages (see
+        # pagination.MessageKeysetPagination)
+        index_together = (('artist', 'created_at', 'id'),)
+
     def __repr__(self):
         return '%s:%s' % (self.artist.name, self.created_at)
 
     def __str__(self):
         return '%s:%s' % (self.artist.name, self.created_at)
 
+class ArchivedMessage(models.Model):
+    """
+    A message moved out of the Message table once it is old enough (see
+    services.archive_messages). Archived messages are never unread
+    """
+    # the id the message had
+    id = models.IntegerField(primary_key=True)
+    text = models.CharField(max_length=8192)
+    created_at = models.DateTimeField()
+    attachment = models.URLField(max_length=2048, blank=True, null=True)
+    artist_id = models.IntegerField(db_index=True)
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        db_table = 'message_archive'
+
+    def __repr__(self):
+        return '%s:%s' % (self.artist_id, self.created_at)
+
+    def __str__(self):
+        return '%s:%s' % (self.artist_id, self.created_at)
+
+class InboxEntry(models.Model):
+    """
+    A message delivered to a follower
+
+    Only written when settings.MESSAGE_FANOUT_ON_WRITE is enabled, in which
+    case a fan's unread messages are their entries that haven't been
+    dismissed
+    """
+    profile = models.ForeignKey(BasicProfile, related_name='inbox_entries')
+    message = models.ForeignKey(Message, related_name='inbox_entries')
+    # denormalized from message, so unfollowing can trim the inbox
+    artist = models.ForeignKey(ArtistProfile, related_name='+')
+    dismissed = models.BooleanField(default=False)
+
+    class Meta:
+        db_table = 'message_inbox'
+        unique_together = (('profile', 'message'),)
+        index_together = (('profile', 'dismissed', 'message'),
+            ('profile', 'artist'))
+
+    def __repr__(self):
+        return '%s:%s' % (self.profile_id, self.message_id)
+
+    def __str__(self):
+        return '%s:%s' % (self.profile_id, self.message_id)
+
+class FanInboxState(models.Model):
+    """
+    Per-fan inbox bookkeeping
+
+    unread_count is maintained as messages are created, deleted and
+    dismissed and as artists are followed and unfollowed (see
+    services.get_unread_count). It is repaired periodically by the
+    reconcile_unread_counts script
+
+    Every message with an id up to read_up_to is read, whether or not it has
+    a dismissal row (the compact_dismissals script replaces the rows of older
+    dismissals with this mark)
+    """
+    profile = models.OneToOneField(BasicProfile, primary_key=True,
+        related_name='inbox_state')
+    unread_count = models.IntegerField(default=0)
+    read_up_to = models.IntegerField(default=0)
+
+    def __repr__(self):
+        return '%s:%s' % (self.profile_id, self.unread_count)
+
+    def __str__(self):
+        return '%s:%s' % (self.profile_id, self.unread_count)
+
+class ArtistReadMark(models.Model):
+    """
+    The read-up-to mark a fan had when they unfollowed an artist
+
+    The artist's messages with an id up to read_up_to were read (the mark may
+    have replaced their dismissal rows), so they stay read if the fan follows
+    the artist again (see services._uncover_artists)
+    """
+    profile = models.ForeignKey(BasicProfile, related_name='artist_read_marks')
+    artist = models.ForeignKey(ArtistProfile, related_name='read_marks')
+    read_up_to = models.IntegerField()
+
+    class Meta:
+        db_table = 'artist_read_mark'
+        unique_together = (('profile', 'artist'),)
+
+    def __repr__(self):
+        return '%s:%s:%s' % (self.profile_id, self.artist_id, self.read_up_to)
+
+    def __str__(self):
+        return '%s:%s:%s' % (self.profile_id, self.artist_id, self.read_up_to)
+
+class JobCheckpoint(models.Model):
+    """
+    Where a batched maintenance job (identified by name) left off, so it can
+    resume after being interrupted
+    """
+    name = models.CharField(max_length=64, primary_key=True)
+    position = models.IntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __repr__(self):
+        return '%s:%s' % (self.name, self.position)
+
+    def __str__(self):
+        return '%s:%s' % (self.name, self.position)
+
+class ChangeLogEntry(models.Model):
+    """
+    An append-only record of a change that fans' clients need to sync (see
+    services.get_changes)
+
+    Entries reference objects by id (rather than by foreign key), so they
+    outlive the objects they describe. Changes to an artist's messages and
+    shows are recorded with the artist, follows and dismissals with the
+    profile of the fan
+    """
+    MESSAGE = 'message'
+    SHOW = 'show'
+    FOLLOW = 'follow'
+    DISMISSAL = 'dismissal'
+    KIND_CHOICES = (
+        (MESSAGE, 'Message'),
+        (SHOW, 'Show'),
+        (FOLLOW, 'Follow'),
+        (DISMISSAL, 'Dismissal'),
+    )
+
+    CREATED = 'created'
+    UPDATED = 'updated'
+    DELETED = 'deleted'
+    ACTION_CHOICES = (
+        (CREATED, 'Created'),
+        (UPDATED, 'Updated'),
+        (DELETED, 'Deleted'),
+    )
+
+    kind = models.CharField(max_length=16, choices=KIND_CHOICES)
+    action = models.CharField(max_length=16, choices=ACTION_CHOICES)
+    # id of the message, show, or (for follows) artist
+    object_id = models.IntegerField()
+    artist_id = models.IntegerField(null=True, blank=True)
+    profile_id = models.IntegerField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        db_table = 'change_log'
+        index_together = (('artist_id', 'id'), ('profile_id', 'id'))
+
+    def __repr__(self):
+        return '%s:%s %s:%s' % (self.id, self.kind, self.action,
+            self.object_id)
+
+    def __str__(self):
+        return '%s:%s %s:%s' % (self.id, self.kind, self.action,
+            self.object_id)
+
 # TODO: Ultimately, Venue should probably be a separate model with a unique name
 # For now (since we don't know who would manage those entries), just
 # denormalize
@@ -244,9 +581,18 @@ class Show(models.Model):
     end = models.DateTimeField()
     artist = models.ForeignKey(ArtistProfile, related_name='shows')
     # venue = models.ForeignKey(Venue, related_name='shows')
-    latitude = models.CharField(max_length=16, null=True, blank=True)
-    longitude = models.CharField(max_length=16, null=True, blank=True)
+    latitude = models.FloatField(null=True, blank=True)
+    longitude = models.FloatField(null=True, blank=True)
     venue_name = models.CharField(max_length=1024, blank=True, null=True)
+    # spatiotemporal index: the bucket containing start (see
+    # utils.get_time_bucket) and the grid cell of the location (see
+    # utils.get_geo_cell). These are kept in sync by save()
+    time_bucket = models.IntegerField(null=True, blank=True)
+    geo_cell = models.IntegerField(null=True, blank=True)
+
+    class Meta:
+        index_together = (('latitude', 'longitude'),
+            ('time_bucket', 'geo_cell'), ('artist', 'start', 'id'))
 
     def __repr__(self):
         return '%s:%s:%s' % (self.artist.name, self.venue.name, self.start)
@@ -254,6 +600,14 @@ class Show(models.Model):
     def __str__(self):
         return '%s:%s:%s' % (self.artist.name, self.venue.name, self.start)
 
+    def save(self, *args, **kwargs):
+        """
+        Keep the spatiotemporal index up to date on every write
+        """
+        self.time_bucket = utils.get_time_bucket(self.start)
+        self.geo_cell = utils.get_geo_cell(self.latitude, self.longitude)
+        super(Show, self).save(*args, **kwargs)
+
 class Image(models.Model):
     """
     Image
@@ -0,0 +1,125 @@
+"""
+Custom pagination
+"""
+import datetime
+
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+from rest_framework import exceptions
+from rest_framework import pagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+import main.errors as errors
+import main.utils as utils
+
+class KeysetPagination(pagination.BasePagination):
+    """
+    Cursor based pagination on a unique, composite ordering
+
+    Each page is read with a range condition on the ordering fields (the last
+    field must be unique, e.g. the id) instead of an OFFSET, and no total
+    count is computed, so every page costs the same no matter how deep it is.
+    The cursor is an opaque encoding of the ordering values of the last item
+    returned
+
+    Subclass and set `ordering`. Ordering fields must all sort in the same
+    direction. Responses look like:
+
+        {"next": "<url of the next page, or null>", "results": [...]}
+    """
+    ordering = ('id',)
+    cursor_query_param = 'cursor'
+    page_size_query_param = 'limit'
+    page_size = 20
+    max_page_size = 100
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params.get(
+                self.page_size_query_param, self.page_size))
+        except (TypeError, ValueError):
+            return self.page_size
+        return min(max(page_size, 1), self.max_page_size)
+
+    def get_fields(self):
+        """
+        Returns the ordering field names and whether they are descending
+        """
+        descending = self.ordering[0].startswith('-')
+        return [f.lstrip('-') for f in self.ordering], descending
+
+    def get_filter(self, queryset, position):
+        """
+        Build the condition for rows strictly after a position, i.e.
+        (a > x) or (a = x and b > y) or ...
+        """
+        fields, descending = self.get_fields()
+        lookup = '__lt' if descending else '__gt'
+        query = Q()
+        for i, name in enumerate(fields):
+            field = queryset.model._meta.get_field(name)
+            condition = Q(**{name + lookup: field.to_python(position[i])})
+            for j in range(i):
+                condition &= Q(**{fields[j]: queryset.model._meta.get_field(
+                    fields[j]).to_python(position[j])})
+            query |= condition
+        return query
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        fields, descending = self.get_fields()
+        cursor = request.query_params.get(self.cursor_query_param, None)
+        if cursor:
+            try:
+                position = utils.decode_cursor(cursor)
+                if not isinstance(position, list) or \
+                        len(position) != len(fields):
+                    raise errors.InvalidInput('Invalid cursor')
+                queryset = queryset.filter(self.get_filter(queryset,
+                    position))
+            except (errors.InvalidInput, ValidationError, ValueError,
+                    TypeError):
+                raise exceptions.ParseError('Invalid cursor')
+        page_size = self.get_page_size(request)
+        # fetch one extra row to know if there is a next page
+        page = list(queryset.order_by(*self.ordering)[:page_size + 1])
+        self.has_next = len(page) > page_size
+        page = page[:page_size]
+        self.next_position = None
+        if self.has_next:
+            self.next_position = [self.encode_value(getattr(page[-1], f))
+                for f in fields]
+        return page
+
+    def encode_value(self, value):
+        if isinstance(value, (datetime.datetime, datetime.date)):
+            return value.isoformat()
+        return value
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param,
+            utils.encode_cursor(self.next_position))
+
+    def get_paginated_response(self, data):
+        return Response({
+            'next': self.get_next_link(),
+            'results': data
+        })
+
+
+class MessageKeysetPagination(KeysetPagination):
+    """
+    Messages, newest first
+    """
+    ordering = ('-created_at', '-id')
+
+
+class ShowKeysetPagination(KeysetPagination):
+    """
+    Shows, by start time
+    """
+    ordering = ('start', 'id')
@@ -7,6 +7,7 @@ Can do things like if view.action == 'create'
 import logging
 
 from rest_framework import permissions
+import main.identity as identity
 import main.models as models
 import main.services as services
 
@@ -23,11 +24,12 @@ class ProfilePermissions(permissions.BasePermission):
         - FANs and ARTISTS can only view and edit their own info
     """
     def has_permission(self, request, view):
-        if request.method == 'POST' and not services.is_admin(request.user.username):
+        if request.method == 'POST' and not services.is_admin(
+                identity.get_identity(request)):
             return False
         return True
     def has_object_permission(self, request, view, obj):
-        if services.is_admin(request.user.username):
+        if services.is_admin(identity.get_identity(request)):
             return True
         if request.user.username == obj.user.username:
             return True
@@ -37,8 +39,7 @@ class IsAuthenticated(permissions.BasePermission):
     def has_permission(self, request, view):
         if not request.user.is_authenticated():
             return False
-        user_profile = services.get_profile(request.user.username)
-        if user_profile:
+        if identity.get_identity(request):
             return True
         else:
             return False
@@ -47,9 +48,10 @@ class IsAdminOrReadOnly(permissions.BasePermission):
     def has_permission(self, request, view):
         if not request.user.is_authenticated():
             return False
-        user_profile = services.get_profile(request.user.username)
-        if (request.method in SAFE_METHODS or \
-            user_profile.highest_role() in ['ADMIN']):
+        current = identity.get_identity(request)
+        if current is None:
+            return False
+        if (request.method in SAFE_METHODS or current.has_role('ADMIN')):
             return True
         return False
 
@@ -58,9 +60,11 @@ class IsArtistOrReadOnly(permissions.BasePermission):
     def has_permission(self, request, view):
         if not request.user.is_authenticated():
             return False
-        user_profile = services.get_profile(request.user.username)
+        current = identity.get_identity(request)
+        if current is None:
+            return False
         if (request.method in SAFE_METHODS or \
-            user_profile.highest_role() in ['ADMIN', 'ARTIST']):
+            current.has_role('ADMIN', 'ARTIST')):
             return True
 
         logger.debug('user %s is not an artist' % request.user.username)
@@ -74,10 +78,10 @@ class IsFan(permissions.BasePermission):
     def has_permission(self, request, view):
         if not request.user.is_authenticated():
             return False
-        profile = services.get_profile(request.user.username)
-        if profile is None:
+        current = identity.get_identity(request)
+        if current is None:
            return False
-        if 'FAN' in profile.user.groups.values_list('name', flat=True):
+        if current.has_role('FAN'):
             return True
         else:
             return False
@@ -90,10 +94,10 @@ class IsArtist(permissions.BasePermission):
     def has_permission(self, request, view):
         if not request.user.is_authenticated():
             return False
-        profile = services.get_profile(request.user.username)
-        if profile is None:
+        current = identity.get_identity(request)
+        if current is None:
             return False
-        if 'ARTIST' in profile.basic_profile.user.groups.values_list('name', flat=True):
+        if current.has_role('ARTIST'):
             return True
         else:
             return False
@@ -106,6 +110,6 @@ class IsAdmin(permissions.BasePermission):
     def has_permission(self, request, view):
         if not request.user.is_authenticated():
             return False
-        if services.is_admin(request.user.username):
+        if services.is_admin(identity.get_identity(request)):
             return True
         return False
@@ -0,0 +1,37 @@
+"""
+Custom renderers
+"""
+from rest_framework import renderers
+
+class EventStreamRenderer(renderers.BaseRenderer):
+    """
+    Lets views streaming server-sent events accept `text/event-stream`
+    requests. Streaming responses bypass rendering, so this only renders
+    error responses (as plain text)
+    """
+    media_type = 'text/event-stream'
+    format = 'event-stream'
+    charset = 'utf-8'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        return str(data).encode(self.charset)
+
+
+class CSVRenderer(EventStreamRenderer):
+    """
+    Lets views streaming CSV be selected with `?format=csv` (or an Accept
+    header). Only renders error responses
+    """
+    media_type = 'text/csv'
+    format = 'csv'
+
+
+class NDJSONRenderer(EventStreamRenderer):
+    """
+    Lets views streaming newline delimited JSON be selected with
+    `?format=ndjson` (or an Accept header). Only renders error responses
+    """
+    media_type = 'application/x-ndjson'
+    format = 'ndjson'
@@ -0,0 +1,34 @@
+"""
+Moves messages older than settings.MESSAGE_ARCHIVE_AFTER_DAYS to the message
+archive
+
+Messages are archived in batches (see services.archive_messages), each in its
+own transaction, so the job can be interrupted and run again at any time
+
+Usage: python manage.py runscript archive_messages
+"""
+import datetime
+import os
+import sys
+
+sys.path.insert(0, os.path.realpath(os.path.join(os.path.dirname(__file__), '../../')))
+
+from django.conf import settings
+from django.utils import timezone
+
+from main import services as services
+
+def run():
+    before = timezone.now() - datetime.timedelta(
+        days=settings.MESSAGE_ARCHIVE_AFTER_DAYS)
+    archived = 0
+    while True:
+        count = services.archive_messages(before)
+        if not count:
+            break
+        archived += count
+    print('Archived %d messages created before %s' % (archived, before))
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,78 @@
+"""
+Benchmark for main.auth.FanmobiAuthentication
+
+Authenticates the same session repeatedly (the work every request does before
+any view code runs) with different session engines, with and without the
+session user cache (main.cache.SessionUserCache), and reports the queries
+and time per request. The user is created in a transaction that is rolled
+back at the end
+
+Usage: python manage.py runscript benchmark_authentication
+"""
+import os
+import sys
+import time
+from importlib import import_module
+
+sys.path.insert(0, os.path.realpath(os.path.join(os.path.dirname(__file__), '../../')))
+
+from django.conf import settings
+from django.contrib.sessions.middleware import SessionMiddleware
+from django.db import connection
+from django.db import transaction
+from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext
+from django.test.utils import override_settings
+
+from main import auth as auth
+from main import models as models
+
+REQUESTS = 1000
+
+CONFIGURATIONS = (
+    ('db', 'django.contrib.sessions.backends.db', False),
+    ('cached_db', 'django.contrib.sessions.backends.cached_db', False),
+    ('cached_db+user', 'django.contrib.sessions.backends.cached_db', True),
+    ('signed_cookies', 'django.contrib.sessions.backends.signed_cookies',
+        False),
+)
+
+class Rollback(Exception):
+    pass
+
+def measure(name, engine, user_cache, username):
+    with override_settings(SESSION_ENGINE=engine,
+            SESSION_USER_CACHE_ENABLED=user_cache):
+        session = import_module(engine).SessionStore()
+        session['username'] = username
+        session.save()
+        middleware = SessionMiddleware()
+        authentication = auth.FanmobiAuthentication()
+        factory = RequestFactory()
+        with CaptureQueriesContext(connection) as queries:
+            start = time.perf_counter()
+            for i in range(REQUESTS):
+                request = factory.get('/')
+                request.COOKIES[settings.SESSION_COOKIE_NAME] = \
+                    session.session_key
+                middleware.process_request(request)
+                user, _ = authentication.authenticate(request)
+            elapsed = time.perf_counter() - start
+    print('%16s %12.2f %12.1f' % (name, len(queries) / REQUESTS,
+        elapsed / REQUESTS * 1000000))
+
+def run():
+    try:
+        with transaction.atomic():
+            models.BasicProfile.create_groups()
+            profile = models.BasicProfile.create_user('benchmark_user')
+            print('%16s %12s %12s' % ('', 'queries/req', 'us/req'))
+            for name, engine, user_cache in CONFIGURATIONS:
+                measure(name, engine, user_cache, profile.user.username)
+            raise Rollback()
+    except Rollback:
+        pass
+
+
+if __name__ == "__main__":
+    run()
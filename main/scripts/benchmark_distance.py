@@ -0,0 +1,56 @@
+"""
+Micro-benchmark comparing utils.is_inside_radius (one point per call) with
+utils.get_points_inside_radius (all points in one NumPy pass)
+
+Does not touch the database
+
+Usage: python manage.py runscript benchmark_distance
+"""
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.realpath(os.path.join(os.path.dirname(__file__), '../../')))
+
+from main import utils as utils
+
+# Baltimore
+CENTER_LAT = 39.2833
+CENTER_LON = -76.6167
+RADIUS_KM = 150
+SIZES = [1000, 100000, 1000000]
+
+def run():
+    random = np.random.RandomState(0)
+    print('%10s %12s %12s %10s' % ('points', 'scalar (s)', 'batch (s)',
+        'speedup'))
+    for size in SIZES:
+        # points scattered around the continental US
+        lats = random.uniform(25, 50, size)
+        lons = random.uniform(-125, -65, size)
+
+        start = time.perf_counter()
+        scalar_hits = 0
+        for lat, lon in zip(lats.tolist(), lons.tolist()):
+            if utils.is_inside_radius(CENTER_LAT, CENTER_LON, lat, lon,
+                    RADIUS_KM):
+                scalar_hits += 1
+        scalar_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        distances, mask = utils.get_points_inside_radius(CENTER_LAT,
+            CENTER_LON, lats, lons, RADIUS_KM)
+        batch_hits = int(mask.sum())
+        batch_time = time.perf_counter() - start
+
+        if scalar_hits != batch_hits:
+            print('WARNING: scalar found %d points, batch found %d' % (
+                scalar_hits, batch_hits))
+        print('%10d %12.4f %12.4f %9.1fx' % (size, scalar_time, batch_time,
+            scalar_time / batch_time))
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,72 @@
+"""
+Benchmark for first-launch logins (views.LoginView creating a new user)
+
+Compares the previous way of creating users (hashing the default password,
+one Group lookup per group, separate saves) with BasicProfile.create_user,
+then runs logins of new anonymous users through the login endpoint. Reports
+logins (or users created) per second. Everything is created in a transaction
+that is rolled back at the end
+
+Usage: python manage.py runscript benchmark_login
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.realpath(os.path.join(os.path.dirname(__file__), '../../')))
+
+import django.contrib.auth
+from django.contrib.sessions.middleware import SessionMiddleware
+from django.db import transaction
+from django.test import RequestFactory
+
+from main import models as models
+from main import views as views
+
+LOGINS = 200
+
+class Rollback(Exception):
+    pass
+
+def create_user_legacy(username, groups=('FAN',)):
+    user = django.contrib.auth.models.User.objects.create_user(
+        username=username, email='', password='password')
+    user.save()
+    for i in groups:
+        g = django.contrib.auth.models.Group.objects.get(name=i)
+        user.groups.add(g)
+    f = models.BasicProfile(user=user,
+        roles=models.BasicProfile.role_mask(groups))
+    f.save()
+    return f
+
+def login(username):
+    factory = RequestFactory()
+    request = factory.post('/api/login/', {'anonymous_id': username})
+    SessionMiddleware().process_request(request)
+    response = views.LoginView(request)
+    assert response.status_code == 200, response.data
+
+def measure(name, create):
+    start = time.perf_counter()
+    for i in range(LOGINS):
+        create('benchmark_%s_%d' % (name, i))
+    elapsed = time.perf_counter() - start
+    print('%20s %12.1f' % (name, LOGINS / elapsed))
+
+def run():
+    try:
+        with transaction.atomic():
+            if not django.contrib.auth.models.Group.objects.exists():
+                models.BasicProfile.create_groups()
+            print('%20s %12s' % ('', 'per second'))
+            measure('legacy create_user', create_user_legacy)
+            measure('create_user', models.BasicProfile.create_user)
+            measure('login', login)
+            raise Rollback()
+    except Rollback:
+        pass
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,94 @@
+"""
+Benchmark for services.get_unread_messages
+
+Creates a fan following 500 artists with 100k messages between them (some of
+them dismissed), then compares the single query unread inbox with the
+previous implementation, which materialized the followed artists and the
+dismissed messages into id lists. Everything is created in a transaction that
+is rolled back at the end
+
+Usage: python manage.py runscript benchmark_unread_messages
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.realpath(os.path.join(os.path.dirname(__file__), '../../')))
+
+from django.db import connection
+from django.db import transaction
+from django.test.utils import CaptureQueriesContext
+
+from main import models as models
+from main import services as services
+
+ARTISTS = 500
+MESSAGES = 100000
+# every DISMISS_EVERY'th message is dismissed by the fan
+DISMISS_EVERY = 111
+RUNS = 5
+
+class Rollback(Exception):
+    pass
+
+def get_unread_messages_legacy(profile_id):
+    artists = models.ArtistProfile.objects.filter(connected_users__in=[profile_id])
+    artist_ids = [a.id for a in artists]
+    messages = models.Message.objects.filter(artist__id__in=artist_ids)
+    dismissed_messages = messages.filter(dismissed_by__in=[profile_id])
+    return messages.exclude(id__in=[msg.id for msg in dismissed_messages])
+
+def create_data():
+    models.BasicProfile.create_groups()
+    fan = models.BasicProfile.create_user('benchmark_fan')
+    users = [models.BasicProfile.create_user('benchmark_band_%d' % i,
+        groups=['ARTIST']) for i in range(ARTISTS)]
+    models.ArtistProfile.objects.bulk_create([
+        models.ArtistProfile(basic_profile=u, name=u.user.username)
+        for u in users])
+    artist_ids = list(models.ArtistProfile.objects.filter(
+        basic_profile__in=users).values_list('id', flat=True))
+    Follow = models.ArtistProfile.connected_users.through
+    Follow.objects.bulk_create([Follow(artistprofile_id=a,
+        basicprofile_id=fan.id) for a in artist_ids])
+    models.Message.objects.bulk_create([models.Message(
+        artist_id=artist_ids[i % ARTISTS], text='message %d' % i)
+        for i in range(MESSAGES)])
+    message_ids = models.Message.objects.filter(
+        artist_id__in=artist_ids).values_list('id', flat=True)
+    Dismissed = models.Message.dismissed_by.through
+    Dismissed.objects.bulk_create([Dismissed(message_id=m,
+        basicprofile_id=fan.id) for m in message_ids[::DISMISS_EVERY]])
+    return fan
+
+def measure(name, get_messages, profile_id):
+    best = None
+    for i in range(RUNS):
+        with CaptureQueriesContext(connection) as queries:
+            start = time.perf_counter()
+            count = len(list(get_messages(profile_id).values_list('id',
+                flat=True)))
+            elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    print('%10s %10d %10d %12.4f' % (name, count, len(queries), best))
+    return count
+
+def run():
+    try:
+        with transaction.atomic():
+            fan = create_data()
+            print('%10s %10s %10s %12s' % ('', 'unread', 'queries',
+                'best (s)'))
+            legacy = measure('legacy', get_unread_messages_legacy, fan.id)
+            anti_join = measure('anti-join', services.get_unread_messages,
+                fan.id)
+            if legacy != anti_join:
+                print('WARNING: legacy found %d messages, anti-join found %d'
+                    % (legacy, anti_join))
+            raise Rollback()
+    except Rollback:
+        pass
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,52 @@
+"""
+Collapses message dismissal rows into per-fan read-up-to marks
+
+Fans are processed in batches of constants.COMPACTION_BATCH_SIZE (ordered by
+id), each batch in its own transaction along with the job's checkpoint, so an
+interrupted run resumes where it left off. Once every fan has been processed,
+the checkpoint is reset for the next run (see services.compact_dismissals)
+
+Usage: python manage.py runscript compact_dismissals
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.realpath(os.path.join(os.path.dirname(__file__), '../../')))
+
+from django.db import transaction
+
+from main import constants as constants
+from main import models as models
+from main import services as services
+
+JOB_NAME = 'compact_dismissals'
+
+def run():
+    checkpoint, created = models.JobCheckpoint.objects.get_or_create(
+        name=JOB_NAME)
+    if checkpoint.position:
+        print('Resuming after profile %d' % checkpoint.position)
+    Dismissed = models.Message.dismissed_by.through
+    fans = 0
+    deleted = 0
+    while True:
+        profile_ids = list(Dismissed.objects.filter(
+            basicprofile_id__gt=checkpoint.position).order_by(
+            'basicprofile_id').values_list('basicprofile_id',
+            flat=True).distinct()[:constants.COMPACTION_BATCH_SIZE])
+        if not profile_ids:
+            break
+        with transaction.atomic():
+            for profile_id in profile_ids:
+                deleted += services.compact_dismissals(profile_id)
+            checkpoint.position = profile_ids[-1]
+            checkpoint.save()
+        fans += len(profile_ids)
+    checkpoint.position = 0
+    checkpoint.save()
+    print('Compacted dismissals of %d fans, deleted %d rows' % (fans,
+        deleted))
+
+
+if __name__ == "__main__":
+    run()
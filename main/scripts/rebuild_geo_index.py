@@ -0,0 +1,49 @@
+"""
+Converts stored coordinates to numbers and rebuilds the spatial index
+
+Coordinates used to be stored as strings. After the coordinate columns are
+migrated to floats, any values that were blank or not valid numbers are set
+to null here, and the grid cell (and time bucket, for shows) of every profile
+and show is recomputed. Profiles and shows keep these up to date whenever they
+are saved, so this only needs to be run for rows written before that (or
+after changing constants.GEO_CELL_SIZE_DEGREES)
+
+Usage: python manage.py runscript rebuild_geo_index
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.realpath(os.path.join(os.path.dirname(__file__), '../../')))
+
+from main import models as models
+from main import utils as utils
+
+def run():
+    profiles = models.BasicProfile.objects.values_list('id',
+        'current_latitude', 'current_longitude')
+    updated = 0
+    for profile_id, lat, lon in profiles:
+        lat = utils.parse_coordinate(lat)
+        lon = utils.parse_coordinate(lon)
+        models.BasicProfile.objects.filter(id=profile_id).update(
+            current_latitude=lat, current_longitude=lon,
+            geo_cell=utils.get_geo_cell(lat, lon))
+        updated += 1
+    print('Rebuilt locations for %d profiles' % updated)
+
+    shows = models.Show.objects.values_list('id', 'latitude', 'longitude',
+        'start')
+    updated = 0
+    for show_id, lat, lon, start in shows:
+        lat = utils.parse_coordinate(lat)
+        lon = utils.parse_coordinate(lon)
+        models.Show.objects.filter(id=show_id).update(
+            latitude=lat, longitude=lon,
+            geo_cell=utils.get_geo_cell(lat, lon),
+            time_bucket=utils.get_time_bucket(start))
+        updated += 1
+    print('Rebuilt locations for %d shows' % updated)
+
+
+if __name__ == "__main__":
+    run()
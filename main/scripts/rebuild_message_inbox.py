@@ -0,0 +1,45 @@
+"""
+Rebuilds the message inbox (models.InboxEntry) of every follower
+
+Needed when settings.MESSAGE_FANOUT_ON_WRITE is turned on for a database that
+already has messages, since inbox entries are only written while it is
+enabled. Entries that already exist are kept (along with whether they have
+been dismissed), and entries for artists that are no longer followed are
+removed
+
+Usage: python manage.py runscript rebuild_message_inbox
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.realpath(os.path.join(os.path.dirname(__file__), '../../')))
+
+from django.db import transaction
+
+from main import models as models
+from main import services as services
+
+def run():
+    Follow = models.ArtistProfile.connected_users.through
+    created = 0
+    follows = Follow.objects.values_list('basicprofile_id', 'artistprofile_id')
+    for profile_id, artist_id in follows.iterator():
+        with transaction.atomic():
+            created += services.backfill_inbox(profile_id, artist_id)
+    print('Created %d inbox entries' % created)
+
+    removed = 0
+    entries = models.InboxEntry.objects.values_list('profile_id',
+        'artist_id').distinct()
+    for profile_id, artist_id in list(entries):
+        if not Follow.objects.filter(basicprofile_id=profile_id,
+                artistprofile_id=artist_id).exists():
+            stale = models.InboxEntry.objects.filter(profile_id=profile_id,
+                artist_id=artist_id)
+            removed += stale.count()
+            stale.delete()
+    print('Removed %d inbox entries' % removed)
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,36 @@
+"""
+Repairs the maintained unread message counters (models.FanInboxState)
+
+Counters are adjusted incrementally as messages and follows change, so they
+can drift (e.g. if a message is removed by cascading deletes). This recounts
+the unread messages of every fan with a counter and fixes the ones that are
+off. Run periodically (see the deploy cron job)
+
+Usage: python manage.py runscript reconcile_unread_counts
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.realpath(os.path.join(os.path.dirname(__file__), '../../')))
+
+from main import models as models
+from main import services as services
+
+def run():
+    checked = 0
+    repaired = 0
+    states = models.FanInboxState.objects.values_list('profile_id',
+        'unread_count')
+    for profile_id, unread_count in list(states):
+        actual = services.get_unread_messages(profile_id).count()
+        if actual != unread_count:
+            # only touch the counter if it hasn't moved since we read it
+            repaired += models.FanInboxState.objects.filter(
+                profile_id=profile_id, unread_count=unread_count).update(
+                unread_count=actual)
+        checked += 1
+    print('Checked %d unread counters, repaired %d' % (checked, repaired))
+
+
+if __name__ == "__main__":
+    run()
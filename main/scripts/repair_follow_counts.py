@@ -0,0 +1,48 @@
+"""
+Recomputes the denormalized follower and following counts
+
+ArtistProfile.follower_count and BasicProfile.following_count are adjusted
+as fans follow and unfollow artists. This recounts both from the artist_user
+table with one UPDATE each, and reports how many rows were off
+
+Usage: python manage.py runscript repair_follow_counts
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.realpath(os.path.join(os.path.dirname(__file__), '../../')))
+
+from django.db import connection
+from django.db import transaction
+
+from main import models as models
+
+def repair(model, counter, column):
+    """
+    Set model.counter to the number of artist_user rows whose column is the
+    row's id
+
+    Returns the number of rows that were repaired
+    """
+    follows = models.ArtistProfile.connected_users.through._meta.db_table
+    table = model._meta.db_table
+    count = '(SELECT COUNT(*) FROM {follows} WHERE {follows}.{column} = ' \
+        '{table}.id)'.format(follows=follows, column=column, table=table)
+    with connection.cursor() as cursor:
+        cursor.execute('UPDATE {table} SET {counter} = {count} WHERE '
+            '{counter} <> {count}'.format(table=table, counter=counter,
+            count=count))
+        return cursor.rowcount
+
+def run():
+    with transaction.atomic():
+        artists = repair(models.ArtistProfile, 'follower_count',
+            'artistprofile_id')
+        profiles = repair(models.BasicProfile, 'following_count',
+            'basicprofile_id')
+    print('Repaired follower counts of %d artists and following counts of %d '
+        'profiles' % (artists, profiles))
+
+
+if __name__ == "__main__":
+    run()
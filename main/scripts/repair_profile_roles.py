@@ -0,0 +1,46 @@
+"""
+Recomputes the denormalized role bitmask of every profile
+
+BasicProfile.roles mirrors the user's Groups, and is kept in sync whenever
+the groups change (see BasicProfile.sync_roles). Memberships written without
+signals (e.g. with bulk inserts or deletes, or straight to the database)
+need this to be run afterwards. Reports how many profiles were off
+
+Usage: python manage.py runscript repair_profile_roles
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.realpath(os.path.join(os.path.dirname(__file__), '../../')))
+
+import django.contrib.auth
+from django.db import transaction
+
+from main import models as models
+
+def repair():
+    """
+    Returns the number of profiles that were repaired
+    """
+    Membership = django.contrib.auth.models.User.groups.through
+    names = {}
+    for user_id, name in Membership.objects.values_list('user_id',
+            'group__name'):
+        names.setdefault(user_id, []).append(name)
+    repaired = 0
+    with transaction.atomic():
+        for profile_id, user_id, roles in models.BasicProfile.objects.values_list(
+                'id', 'user_id', 'roles').iterator():
+            mask = models.BasicProfile.role_mask(names.get(user_id, []))
+            if mask != roles:
+                models.BasicProfile.objects.filter(id=profile_id).update(
+                    roles=mask)
+                repaired += 1
+    return repaired
+
+def run():
+    print('Repaired the roles of %d profiles' % repair())
+
+
+if __name__ == "__main__":
+    run()
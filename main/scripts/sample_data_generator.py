@@ -69,7 +69,9 @@ def run():
     ############################################################################
     #                               Artists
     ############################################################################
-    kwargs = {'email': 'counting_crows@gmail.com', 'groups': ['ARTIST']}
+    # sample users get a password so they can use Basic Authentication (see
+    # endpoints.http)
+    kwargs = {'email': 'counting_crows@gmail.com', 'password': 'password', 'groups': ['ARTIST']}
     counting_crows_basic = models.BasicProfile.create_user(
         'counting_crows', **kwargs)
     counting_crows_artist = models.ArtistProfile(basic_profile=counting_crows_basic,
@@ -91,25 +93,25 @@ def run():
     ############################################################################
     #                               Users
     ############################################################################
-    kwargs = {'email': 'john@gmail.com', 'groups': ['FAN']}
+    kwargs = {'email': 'john@gmail.com', 'password': 'password', 'groups': ['FAN']}
     john = models.BasicProfile.create_user(
         'john', **kwargs)
 
-    kwargs = {'email': 'alice@gmail.com', 'groups': ['FAN']}
+    kwargs = {'email': 'alice@gmail.com', 'password': 'password', 'groups': ['FAN']}
     alice = models.BasicProfile.create_user(
         'alice', **kwargs)
 
-    kwargs = {'email': 'bob@gmail.com', 'groups': ['FAN']}
+    kwargs = {'email': 'bob@gmail.com', 'password': 'password', 'groups': ['FAN']}
     bob = models.BasicProfile.create_user(
         'bob', **kwargs)
 
-    counting_crows_artist.connected_users.add(bob)
+    services.follow_artist(counting_crows_artist.id, bob.id)
 
 
     ############################################################################
     #                               Admin
     ############################################################################
-    kwargs = {'email': 'none@none.com', 'groups': ['ADMIN']}
+    kwargs = {'email': 'none@none.com', 'password': 'password', 'groups': ['ADMIN']}
     john = models.BasicProfile.create_user(
         'admin', **kwargs)
 
@@ -117,10 +119,8 @@ def run():
     ############################################################################
     #                               Messages
     ############################################################################
-    msg = models.Message(
-        text='The Counting Crows are playing a show next week!',
-        artist=counting_crows_artist)
-    msg.save()
+    services.create_message(counting_crows_artist,
+        'The Counting Crows are playing a show next week!')
 
 
 if __name__ == "__main__":
@@ -2,21 +2,67 @@
 Serializers
 """
 import logging
+import math
 
 import django.contrib.auth
+from django.db import transaction
 
 from rest_framework import serializers
 from rest_framework.exceptions import APIException
 
 from PIL import Image
 
+import main.constants as constants
 import main.errors as errors
+import main.identity as identity
 import main.models as models
 import main.services as services
 
 # Get an instance of a logger
 logger = logging.getLogger('fanmobi')
 
+class CoordinateField(serializers.FloatField):
+    """
+    A coordinate in decimal degrees
+
+    Coordinates are stored as floats, but are sent and received as strings
+    for compatibility with existing clients. Values are sent in Python's
+    shortest float form, so trailing zeros are dropped ('39.2910' comes back
+    as '39.291')
+
+    Values outside [-limit, limit] are rejected
+    """
+    limit = None
+
+    def __init__(self, **kwargs):
+        kwargs.setdefault('required', False)
+        kwargs.setdefault('allow_null', True)
+        super(CoordinateField, self).__init__(**kwargs)
+
+    def to_internal_value(self, data):
+        if data == '':
+            return None
+        value = super(CoordinateField, self).to_internal_value(data)
+        if math.isnan(value) or math.isinf(value):
+            raise serializers.ValidationError('A finite number is required.')
+        if self.limit is not None and abs(value) > self.limit:
+            raise serializers.ValidationError(
+                'Ensure this value is between -%d and %d.' % (self.limit,
+                self.limit))
+        return value
+
+    def to_representation(self, value):
+        return str(float(value))
+
+
+class LatitudeField(CoordinateField):
+    limit = 90
+
+
+class LongitudeField(CoordinateField):
+    limit = 180
+
+
 class ImageSerializer(serializers.HyperlinkedModelSerializer):
     class Meta:
         model = models.Image
@@ -97,8 +143,12 @@ class BasicProfileSerializer(serializers.ModelSerializer):
     user = UserSerializer(required=False)
     avatar = ImageSerializer(required=False)
     icon = ImageSerializer(required=False)
+    current_latitude = LatitudeField()
+    current_longitude = LongitudeField()
     class Meta:
         model = models.BasicProfile
+        exclude = ('geo_cell', 'roles')
+        read_only_fields = ('following_count',)
 
     def validate(self, data):
         logger.debug('inside of BasicProfileSerializer.validate. data: %s' % data)
@@ -110,8 +160,16 @@ class BasicProfileSerializer(serializers.ModelSerializer):
         # TODO: create profile
 
     def update(self, instance, validated_data):
-        instance.current_latitude = validated_data.get('latitude', None)
-        instance.current_longitude = validated_data.get('longitude', None)
+        # the location is left alone unless both coordinates were given
+        if ('current_latitude' in validated_data and
+                'current_longitude' in validated_data):
+            current = identity.get_identity(self.context['request'])
+            artist_id = None
+            if current is not None and current.profile_id == instance.id:
+                artist_id = current.artist_id
+            services.update_location(instance,
+                validated_data['current_latitude'],
+                validated_data['current_longitude'], artist_id=artist_id)
         if 'avatar' in validated_data:
             logger.debug('avatar: %s' % validated_data['avatar'])
             try:
@@ -135,7 +193,8 @@ class BasicProfileSerializer(serializers.ModelSerializer):
                 raise APIException('Invalid icon')
         else:
             instance.icon = None
-        instance.save()
+        # location is written separately by services.update_location
+        instance.save(update_fields=['avatar', 'icon'])
         return instance
 
 
@@ -143,11 +202,13 @@ class BasicProfileShortSerializer(serializers.ModelSerializer):
     user = UserShortSerializer()
     avatar = ImageSerializer(required=False)
     icon = ImageSerializer(required=False)
+    current_latitude = LatitudeField()
+    current_longitude = LongitudeField()
     class Meta:
         model = models.BasicProfile
         fields = ('user', 'id', 'current_latitude', 'current_longitude',
-                'avatar', 'icon')
-        read_only_fields = ('id',)
+                'avatar', 'icon', 'following_count')
+        read_only_fields = ('id', 'following_count')
 
 
 class ArtistProfileSerializer(serializers.ModelSerializer):
@@ -161,8 +222,8 @@ class ArtistProfileSerializer(serializers.ModelSerializer):
             'twitter_id', 'soundcloud_id', 'youtube_id', 'itunes_url',
             'ticket_url', 'merch_url', 'paypal_email', 'next_show',
             'facebook_page_id', 'kickstarter_url', 'vimeo_url', 'google_play_url',
-            'instagram_id')
-        read_only_fields = ('id')
+            'instagram_id', 'follower_count')
+        read_only_fields = ('id', 'follower_count')
 
 
     def validate(self, data):
@@ -177,8 +238,8 @@ class ArtistProfileSerializer(serializers.ModelSerializer):
         username = data['basic_profile']['user'].get('username', None)
         if username != self.context['request'].user.username:
             raise serializers.ValidationError('currently, an artist profile can only be created or modified for the current user')
-        basic_profile = models.BasicProfile.objects.filter(
-            user__username=username).first()
+        current = identity.get_identity(self.context['request'])
+        basic_profile = current.profile if current else None
         if not basic_profile:
             raise serializers.ValidationError('cannot create Artist profile for invalid user')
         else:
@@ -231,8 +292,6 @@ class ArtistProfileSerializer(serializers.ModelSerializer):
                 u = models.BasicProfile.objects.get(user__username=i['user']['username'])
                 users.append(u)
             data['connected_users'] = users
-        else:
-            data['connected_users'] = []
 
         return data
 
@@ -267,12 +326,10 @@ class ArtistProfileSerializer(serializers.ModelSerializer):
             a.genres.add(i)
 
         # support updates to the underlying BasicProfile object
-        profile.current_latitude = validated_data['current_latitude']
-        profile.current_longitude = validated_data['current_longitude']
-        profile.save()
+        services.update_location(profile, validated_data['current_latitude'],
+            validated_data['current_longitude'], artist_id=a.id)
         # add user to ARTIST group
-        artist_group = django.contrib.auth.models.Group.objects.get(name='ARTIST')
-        profile.user.groups.add(artist_group)
+        profile.add_role('ARTIST')
 
         return a
 
@@ -304,17 +361,16 @@ class ArtistProfileSerializer(serializers.ModelSerializer):
             instance.genres.add(i)
         instance.save()
 
-        instance.connected_users.clear()
-        for i in validated_data['connected_users']:
-            instance.connected_users.add(i)
-        instance.save()
+        # followers are left alone unless they were given explicitly
+        if 'connected_users' in validated_data:
+            services.set_followers(instance.id,
+                [i.id for i in validated_data['connected_users']])
 
         # support updates to the underlying BasicProfile object
         profile = instance.basic_profile
         # support updates to the underlying BasicProfile object
-        profile.current_latitude = validated_data['current_latitude']
-        profile.current_longitude = validated_data['current_longitude']
-        profile.save()
+        services.update_location(profile, validated_data['current_latitude'],
+            validated_data['current_longitude'], artist_id=instance.id)
 
         return instance
 
@@ -322,8 +378,8 @@ class ArtistProfileSerializer(serializers.ModelSerializer):
 class ArtistProfileShortSerializer(serializers.ModelSerializer):
     class Meta:
         model = models.ArtistProfile
-        fields = ('name', 'id')
-        read_only_fields = ('name', 'id')
+        fields = ('name', 'id', 'follower_count')
+        read_only_fields = ('name', 'id', 'follower_count')
 
 
 # class VenueSerializer(serializers.ModelSerializer):
@@ -340,6 +396,8 @@ class ArtistProfileShortSerializer(serializers.ModelSerializer):
 class ShowSerializer(serializers.ModelSerializer):
     # artist = ArtistProfileShortSerializer()
     # venue = VenueShortSerializer()
+    latitude = LatitudeField()
+    longitude = LongitudeField()
     class Meta:
         model = models.Show
         fields = ('start', 'end', 'latitude', 'longitude', 'venue_name')
@@ -355,16 +413,24 @@ class ShowSerializer(serializers.ModelSerializer):
             data['latitude'] = data.get('latitude', None)
             data['longitude'] = data.get('longitude', None)
             data['venue_name'] = data.get('venue_name', None)
+            if data['start'] is None or data['end'] is None:
+                raise serializers.ValidationError('Show start and end are required')
+            duration = (data['end'] - data['start']).total_seconds()
+            if duration < 0:
+                raise serializers.ValidationError('Show cannot end before it starts')
+            # get_shows_in_radius only looks back far enough for this
+            if duration > constants.SHOW_MAX_DURATION_SECONDS:
+                raise serializers.ValidationError('Show cannot run longer than %d days' %
+                    (constants.SHOW_MAX_DURATION_SECONDS // (24 * 60 * 60)))
             return data
 
     def create(self, validated_data):
-        username = self.context['request'].user.username
-        user_profile = services.get_profile(username)
+        current = identity.get_identity(self.context['request'])
         try:
             artist = services.get_artist_by_id(self.context['artist_pk'])
             if artist is None:
               raise errors.InvalidInput('Invalid artist selection')
-            if artist.basic_profile.user.username != username and user_profile.highest_role() != 'ADMIN':
+            if not current.can_manage_artist(artist.id):
                 raise errors.PermissionDenied('Cannot create a show for a different artist')
 
             show = models.Show(
@@ -374,14 +440,16 @@ class ShowSerializer(serializers.ModelSerializer):
                 latitude=validated_data['latitude'],
                 longitude=validated_data['longitude'],
                 venue_name=validated_data['venue_name'])
-            show.save()
+            with transaction.atomic():
+                show.save()
+                services.log_change(models.ChangeLogEntry.SHOW,
+                    models.ChangeLogEntry.CREATED, show.id,
+                    artist_id=artist.id)
             return show
         except Exception:
             raise errors.InvalidInput('Unknown error')
 
     def update(self, instance, validated_data):
-        username = self.context['request'].user.username
-        user_profile = services.get_profile(username)
         if self.context['request'].method == 'PATCH':
             # TODO: support PATCH
             pass
@@ -391,10 +459,26 @@ class ShowSerializer(serializers.ModelSerializer):
             instance.venue_name = validated_data['venue_name']
             instance.longitude = validated_data['longitude']
             instance.latitude = validated_data['latitude']
-            instance.save()
+            with transaction.atomic():
+                instance.save()
+                services.log_change(models.ChangeLogEntry.SHOW,
+                    models.ChangeLogEntry.UPDATED, instance.id,
+                    artist_id=instance.artist_id)
             return instance
 
 
+class ShowWithArtistSerializer(ShowSerializer):
+    """
+    Read-only representation of a show that includes its artist
+    """
+    artist = ArtistProfileShortSerializer(read_only=True)
+    class Meta:
+        model = models.Show
+        fields = ('id', 'artist', 'start', 'end', 'latitude', 'longitude',
+            'venue_name')
+        read_only_fields = fields
+
+
 class MessageSerializer(serializers.ModelSerializer):
     """
     """
@@ -415,20 +499,17 @@ class MessageSerializer(serializers.ModelSerializer):
             return data
 
     def create(self, validated_data):
-        username = self.context['request'].user.username
-        user_profile = services.get_profile(username)
+        current = identity.get_identity(self.context['request'])
         try:
             artist = services.get_artist_by_id(self.context['artist_pk'])
             if artist is None:
               raise errors.InvalidInput('Invalid artist selection')
-            if artist.basic_profile.user.username != username and user_profile.highest_role() != 'ADMIN':
+            if not current.can_manage_artist(artist.id):
                 raise errors.PermissionDenied('Cannot create a message for a different artist')
 
-            message = models.Message(
-                artist=artist,
-                text=validated_data['text'],
+            message = services.create_message(artist,
+                validated_data['text'],
                 attachment=validated_data['attachment'])
-            message.save()
             return message
         except Exception:
             raise errors.InvalidInput('Unknown error')
@@ -2,13 +2,29 @@
 Access the ORM primarily through this
 """
 import logging
+import math
 import os.path
 
 from django.conf import settings
 
 import django.contrib.auth
+from django.db import IntegrityError
+from django.db import transaction
+from django.db.models import F
+from django.db.models import Max
+from django.db.models import Min
+from django.db.models import IntegerField
+from django.db.models import Q
+from django.db.models.expressions import RawSQL
 
+import main.broker as broker
+import main.buffers as buffers
+import main.cache as cache
+import main.constants as constants
+import main.errors as errors
+import main.geo_snapshot as geo_snapshot
 import main.models as models
+import main.utils as utils
 
 # Get an instance of a logger
 logger = logging.getLogger('fanmobi')
@@ -33,36 +49,71 @@ def get_profile_by_id(id):
     except models.BasicProfile.DoesNotExist:
         return None
 
-def is_admin(username):
-    try:
-        profile = get_profile(username)
-        groups = profile.user.groups.values_list('name', flat=True)
-        if 'ADMIN' in groups:
-            return True
-        return False
-    except Exception:
-        return False
+def update_location(profile, latitude, longitude, artist_id=None):
+    """
+    Record the current location of a profile
+
+    Only the location columns are written. If settings.LOCATION_BUFFER_ENABLED
+    is set, the location is buffered in memory and written in a later batch
+    (see buffers.LocationBuffer). The shared geo snapshot (if enabled) is
+    updated immediately
+
+    Args:
+        profile: models.BasicProfile (updated in place)
+        latitude: the latitude (in degrees), or None
+        longitude: the longitude (in degrees), or None
+        artist_id: id of the profile's models.ArtistProfile, if known.
+            Otherwise it is looked up (only for profiles with the ARTIST
+            role) to update the geo snapshot and query cache
+    """
+    latitude = utils.parse_coordinate(latitude)
+    longitude = utils.parse_coordinate(longitude)
+    old_cell = profile.geo_cell
+    profile.current_latitude = latitude
+    profile.current_longitude = longitude
+    profile.geo_cell = utils.get_geo_cell(latitude, longitude)
+    if settings.LOCATION_BUFFER_ENABLED:
+        buffers.location_buffer.add(profile.id, latitude, longitude)
+    else:
+        models.BasicProfile.objects.filter(id=profile.id).update(
+            current_latitude=latitude, current_longitude=longitude,
+            geo_cell=profile.geo_cell)
+    snapshot = geo_snapshot.get_snapshot()
+    query_cache = cache.get_geo_query_cache()
+    if (artist_id is None and (snapshot or query_cache) and
+            profile.has_role('ARTIST')):
+        artist_id = get_artist_id_by_profile_id(profile.id)
+    if artist_id is None:
+        # the rest only concerns artists
+        return
+    if snapshot:
+        try:
+            snapshot.update_location(profile.id, latitude, longitude,
+                artist_id=artist_id)
+        except Exception as e:
+            logger.error('unable to update geo snapshot: %s' % e)
+    if query_cache:
+        query_cache.invalidate_cells(old_cell, profile.geo_cell)
+
+def is_admin(identity):
+    """
+    Determine if a user is an ADMIN
+
+    Args:
+        identity: identity.Identity of the user (or None)
+    """
+    return identity is not None and identity.is_admin
 
-def can_access(current_username, requested_profile_id):
+def can_access(identity, requested_profile_id):
     """
     Determine if a user should have access to another user's profile
 
     Args:
-        current_username: username currently logged in
+        identity: identity.Identity of the user (or None), see
+            identity.get_identity
         requested_profile_id: id of models.Profile to access
     """
-    try:
-        requested_profile_id = int(requested_profile_id)
-    except ValueError:
-        return False
-    if is_admin(current_username):
-        return True
-    profile = get_profile_by_id(requested_profile_id)
-    if not profile:
-        return False
-    if profile.user.username != current_username:
-        return False
-    return True
+    return identity is not None and identity.can_access(requested_profile_id)
 
 def get_all_genres():
     return models.Genre.objects.all()
@@ -84,49 +135,1026 @@ def get_all_profiles():
 
 def get_profiles_by_role(role):
     return models.BasicProfile.objects.filter(
-        user__groups__name__exact=role)
+        roles__in=models.BasicProfile.role_masks_with(role))
 
 def get_all_artists():
     return models.ArtistProfile.objects.all()
 
+def get_bounding_box_filter(lat_field, lon_field, latitude, longitude,
+        radius):
+    """
+    Build a filter matching rows inside the bounding box of a circle
+
+    Args:
+        lat_field: name of the latitude field to filter on
+        lon_field: name of the longitude field to filter on
+        latitude: the latitude (in degrees) of the center point
+        longitude: the longitude (in degrees) of the center point
+        radius: the radius (in km)
+
+    Returns:
+        a django.db.models.Q
+    """
+    min_lat, max_lat, min_lon, max_lon = utils.get_bounding_box(latitude,
+        longitude, radius)
+    query = Q(**{lat_field + '__range': (min_lat, max_lat)})
+    if min_lon <= max_lon:
+        query &= Q(**{lon_field + '__range': (min_lon, max_lon)})
+    else:
+        # box crosses the antimeridian
+        query &= Q(**{lon_field + '__gte': min_lon}) | \
+            Q(**{lon_field + '__lte': max_lon})
+    return query
+
+def get_artists_in_radius(latitude, longitude, radius):
+    """
+    Get all artists within a radius of the given coordinates
+
+    If the shared geo snapshot is enabled and fresh, the matching artist ids
+    are read from it and only those artists are loaded. Otherwise, only
+    artists located in the grid cells that overlap the query circle, and
+    inside its latitude/longitude bounding box, are read from the database.
+    Those candidates are then checked exactly using the great circle distance
+
+    Args:
+        latitude: the latitude (in degrees) of the center point
+        longitude: the longitude (in degrees) of the center point
+        radius: the radius (in km)
+
+    Returns:
+        a list of models.ArtistProfile
+    """
+    # locations that haven't been written to the database yet
+    pending = buffers.location_buffer.pending()
+    snapshot = geo_snapshot.get_snapshot()
+    artist_ids = None
+    if snapshot:
+        try:
+            artist_ids = snapshot.get_artists_in_radius(latitude, longitude,
+                radius)
+        except Exception as e:
+            logger.error('unable to read geo snapshot: %s' % e)
+    if artist_ids is not None:
+        return get_artists_by_ids(artist_ids)
+
+    query = get_bounding_box_filter('basic_profile__current_latitude',
+        'basic_profile__current_longitude', latitude, longitude, radius)
+    cells = utils.get_cells_in_radius(latitude, longitude, radius)
+    if cells is not None:
+        query &= Q(basic_profile__geo_cell__in=cells)
+    if pending:
+        query |= Q(basic_profile__id__in=list(pending))
+    candidates = []
+    for a in models.ArtistProfile.objects.select_related(
+            'basic_profile__user').filter(query):
+        if a.basic_profile_id in pending:
+            lat, lon = pending[a.basic_profile_id]
+            a.basic_profile.current_latitude = lat
+            a.basic_profile.current_longitude = lon
+        candidates.append(a)
+    return _filter_inside_radius(latitude, longitude, radius, candidates)
+
+def _filter_inside_radius(latitude, longitude, radius, artists):
+    """
+    Keep the located artists within a radius of the given coordinates
+    """
+    located = [a for a in artists
+        if a.basic_profile.current_latitude is not None and
+        a.basic_profile.current_longitude is not None]
+    distances, mask = utils.get_points_inside_radius(latitude, longitude,
+        [a.basic_profile.current_latitude for a in located],
+        [a.basic_profile.current_longitude for a in located], radius)
+    return [a for a, inside in zip(located, mask) if inside]
+
+def get_artists_by_ids(artist_ids):
+    """
+    Load artists (with their profile and user) by id
+
+    Locations buffered in this process replace the stored ones
+
+    Returns:
+        a list of models.ArtistProfile (in no particular order)
+    """
+    pending = buffers.location_buffer.pending()
+    artists = []
+    # keep each IN clause within the database's parameter limit
+    for i in range(0, len(artist_ids), constants.MAX_IN_CLAUSE_SIZE):
+        artists.extend(models.ArtistProfile.objects.select_related(
+            'basic_profile__user').filter(
+            id__in=artist_ids[i:i + constants.MAX_IN_CLAUSE_SIZE]))
+    for a in artists:
+        if a.basic_profile_id in pending:
+            lat, lon = pending[a.basic_profile_id]
+            a.basic_profile.current_latitude = lat
+            a.basic_profile.current_longitude = lon
+    return artists
+
+def get_cached_artists_in_radius(latitude, longitude, radius):
+    """
+    Same as get_artists_in_radius, but served from the geo query cache (see
+    cache.GeoQueryCache) when it is enabled. The cache holds candidates for a
+    slightly larger circle, which are checked exactly against the given
+    point and radius
+    """
+    query_cache = cache.get_geo_query_cache()
+    if not query_cache:
+        return get_artists_in_radius(latitude, longitude, radius)
+    computed = []
+    def compute(latitude, longitude, radius):
+        computed.extend(get_artists_in_radius(latitude, longitude, radius))
+        return [a.id for a in computed]
+    artist_ids = query_cache.get_artist_ids(latitude, longitude, radius,
+        compute)
+    candidates = computed if computed else get_artists_by_ids(artist_ids)
+    return _filter_inside_radius(latitude, longitude, radius, candidates)
+
+def get_nearest_artists(latitude, longitude, limit, after=None):
+    """
+    Get the artists nearest to the given coordinates, ordered by distance
+
+    The search starts with the grid cells around the query point and grows
+    outward (doubling the search radius) until enough artists have been found
+    within the radius that is fully covered. Only the ids and coordinates of
+    candidates are read while searching
+
+    Args:
+        latitude: the latitude (in degrees) of the center point
+        longitude: the longitude (in degrees) of the center point
+        limit: the maximum number of artists to return
+        after: optional (distance, artist_id) of the last artist already
+            returned. Only artists ordered after it are returned
+
+    Returns:
+        a list of (models.ArtistProfile, distance in km) tuples
+    """
+    located = models.ArtistProfile.objects.filter(
+        basic_profile__geo_cell__isnull=False)
+    fields = ('id', 'basic_profile__current_latitude',
+        'basic_profile__current_longitude')
+    # locations that haven't been written to the database yet replace
+    # whatever the database has for those artists
+    pending = buffers.location_buffer.pending()
+    pending_rows = []
+    if pending:
+        pending_artists = models.ArtistProfile.objects.filter(
+            basic_profile__id__in=list(pending)).values_list('id',
+            'basic_profile__id')
+        for artist_id, profile_id in pending_artists:
+            lat, lon = pending[profile_id]
+            if lat is not None and lon is not None:
+                pending_rows.append((artist_id, lat, lon))
+        located = located.exclude(basic_profile__id__in=list(pending))
+    after = tuple(after) if after else (-1, -1)
+    max_radius = math.pi * constants.EARTH_RADIUS_KM
+    radius = max(constants.GEO_CELL_SIZE_DEGREES * math.pi / 180 *
+        constants.EARTH_RADIUS_KM, after[0])
+    visited_cells = set()
+    rows = []
+    while True:
+        cells = utils.get_cells_in_radius(latitude, longitude, radius)
+        if cells is None:
+            # too many cells to list, use the bounding box instead
+            rows = list(located.filter(get_bounding_box_filter(
+                'basic_profile__current_latitude',
+                'basic_profile__current_longitude', latitude, longitude,
+                radius)).values_list(*fields))
+        else:
+            new_cells = [c for c in cells if c not in visited_cells]
+            visited_cells.update(new_cells)
+            if new_cells:
+                rows.extend(located.filter(
+                    basic_profile__geo_cell__in=new_cells).values_list(*fields))
+        candidates = rows + pending_rows
+        distances = utils.get_distances(latitude, longitude,
+            [r[1] for r in candidates], [r[2] for r in candidates]).tolist()
+        # everything within the search radius has been seen
+        found = sorted((d, r[0]) for d, r in zip(distances, candidates)
+            if d <= radius and (d, r[0]) > after)
+        if len(found) >= limit or radius >= max_radius:
+            break
+        radius = min(radius * 2, max_radius)
+
+    found = found[:limit]
+    artists = models.ArtistProfile.objects.select_related(
+        'basic_profile').in_bulk([artist_id for d, artist_id in found])
+    return [(artists[artist_id], d) for d, artist_id in found
+        if artist_id in artists]
+
 # def get_all_venues():
 #     return models.Venue.objects.all()
 
 def get_all_shows():
     return models.Show.objects.all()
 
+def get_shows_in_radius(latitude, longitude, radius, start, end):
+    """
+    Get all shows within a radius of the given coordinates that are running
+    at some point between start and end, ordered by start time
+
+    Only shows in the time buckets covering the window (plus
+    constants.SHOW_TIME_BUCKET_LOOKBACK earlier buckets, for shows that are
+    already running: no show runs longer than
+    constants.SHOW_MAX_DURATION_SECONDS) and in the grid cells overlapping the query circle are
+    read from the database
+
+    Args:
+        latitude: the latitude (in degrees) of the center point
+        longitude: the longitude (in degrees) of the center point
+        radius: the radius (in km)
+        start: beginning of the time window (datetime)
+        end: end of the time window (datetime)
+
+    Returns:
+        a list of models.Show
+    """
+    first_bucket = utils.get_time_bucket(start) - \
+        constants.SHOW_TIME_BUCKET_LOOKBACK
+    last_bucket = utils.get_time_bucket(end)
+    candidates = models.Show.objects.select_related('artist').filter(
+        time_bucket__range=(first_bucket, last_bucket),
+        start__lte=end, end__gte=start).filter(
+        get_bounding_box_filter('latitude', 'longitude', latitude,
+            longitude, radius))
+    cells = utils.get_cells_in_radius(latitude, longitude, radius)
+    if cells is not None:
+        candidates = candidates.filter(geo_cell__in=cells)
+    candidates = list(candidates.order_by('start', 'id'))
+    distances, mask = utils.get_points_inside_radius(latitude, longitude,
+        [s.latitude for s in candidates], [s.longitude for s in candidates],
+        radius)
+    return [s for s, inside in zip(candidates, mask) if inside]
+
 def get_all_messages():
     return models.Message.objects.all()
 
+def get_unread_messages(profile_id):
+    """
+    Get all unread messages for a profile
+
+    Unread messages are messages from artists the profile follows, newer
+    than the profile's read-up-to mark, that the profile hasn't dismissed.
+    With settings.MESSAGE_FANOUT_ON_WRITE this is a range scan of the
+    profile's undismissed inbox entries. Otherwise it is evaluated as a
+    single query: a semi-join against artist_user and an anti-join (NOT
+    EXISTS) against message_basic_profile, which is backed by that table's
+    unique (message_id, basicprofile_id) index. Archived messages are never
+    unread
+
+    Args:
+        profile_id: id of the models.BasicProfile
+
+    Returns:
+        a queryset of models.Message
+    """
+    if settings.MESSAGE_FANOUT_ON_WRITE:
+        return models.Message.objects.filter(
+            inbox_entries__profile_id=profile_id,
+            inbox_entries__dismissed=False)
+    followed_artists = models.ArtistProfile.connected_users.through.objects.filter(
+        basicprofile_id=profile_id).values('artistprofile_id')
+    tables = {
+        'dismissed': models.Message.dismissed_by.through._meta.db_table,
+        'message': models.Message._meta.db_table,
+        'state': models.FanInboxState._meta.db_table
+    }
+    return models.Message.objects.filter(
+        artist_id__in=followed_artists).extra(
+        where=['{message}.id > COALESCE((SELECT read_up_to FROM {state} '
+                'WHERE {state}.profile_id = %s), 0)'.format(**tables),
+            'NOT EXISTS (SELECT 1 FROM {dismissed} WHERE '
+                '{dismissed}.message_id = {message}.id AND '
+                '{dismissed}.basicprofile_id = %s)'.format(**tables)],
+        params=[profile_id, profile_id])
+
 def get_all_unread_messages(username):
     profile = get_profile(username)
-    # get all artists connected to this user
-    artists = models.ArtistProfile.objects.filter(connected_users__in=[profile.id])
-    # get all messages from these artists
-    artist_ids = [a.id for a in artists]
-    messages = models.Message.objects.filter(artist__id__in=artist_ids)
-    # and remvove the messages that have been dismissed
-    dismissed_messages = messages.filter(dismissed_by__in=[profile.id])
-    unread_messages = messages.exclude(id__in=[msg.id for msg in dismissed_messages])
-    return unread_messages
-
-def mark_message_as_read(username, message):
-    profile = get_profile(username)
-    message.dismissed_by.add(profile)
+    return get_unread_messages(profile.id)
+
+def log_changes(kind, action, object_ids, artist_id=None, profile_id=None):
+    """
+    Append entries to the change log (with a single insert)
+
+    Args:
+        kind: one of the models.ChangeLogEntry kinds
+        action: one of the models.ChangeLogEntry actions
+        object_ids: ids of the changed objects
+        artist_id: id of the artist whose followers see the change
+        profile_id: id of the profile the change belongs to
+    """
+    models.ChangeLogEntry.objects.bulk_create([models.ChangeLogEntry(
+        kind=kind, action=action, object_id=object_id, artist_id=artist_id,
+        profile_id=profile_id) for object_id in object_ids])
+
+def log_change(kind, action, object_id, artist_id=None, profile_id=None):
+    log_changes(kind, action, [object_id], artist_id=artist_id,
+        profile_id=profile_id)
+
+def _get_in_chunks(queryset, ids):
+    """
+    Returns the objects of a queryset with the given ids (using IN clauses of
+    at most constants.MAX_IN_CLAUSE_SIZE ids)
+    """
+    ids = list(ids)
+    objects = []
+    for i in range(0, len(ids), constants.MAX_IN_CLAUSE_SIZE):
+        objects.extend(queryset.filter(
+            id__in=ids[i:i + constants.MAX_IN_CLAUSE_SIZE]))
+    return objects
+
+def get_changes(profile_id, since=None):
+    """
+    Get what a fan's client needs to bring its copy of the fan's followed
+    artists, unread messages and shows up to date
+
+    Without `since` (or if too many changes happened since then), everything
+    is returned (a full sync). Otherwise only the follows, dismissals, and
+    messages and shows of followed artists that were created, changed or
+    deleted after the `since` change are returned, along with all unread
+    messages and shows of newly followed artists
+
+    Args:
+        profile_id: id of the models.BasicProfile
+        since: the `token` returned by a previous sync
+
+    Returns:
+        a dict with keys:
+            token: pass this as `since` to the next sync
+            full: whether this is a full sync (discard any local copy)
+            follows: list of models.ArtistProfile followed
+            unfollows: list of ids of artists no longer followed
+            messages: list of models.Message created or changed
+            deleted_messages: list of ids of deleted messages
+            dismissed_messages: list of ids of messages dismissed
+            shows: list of models.Show created or changed
+            deleted_shows: list of ids of deleted shows
+    """
+    Log = models.ChangeLogEntry
+    token = Log.objects.aggregate(Max('id'))['id__max'] or 0
+    followed = models.ArtistProfile.connected_users.through.objects.filter(
+        basicprofile_id=profile_id).values_list('artistprofile_id',
+        flat=True)
+    changes = {
+        'token': token,
+        'full': since is None,
+        'unfollows': [],
+        'deleted_messages': [],
+        'dismissed_messages': [],
+        'deleted_shows': []
+    }
+
+    if since is not None:
+        entries = list(Log.objects.filter(id__gt=since, id__lte=token).filter(
+            Q(profile_id=profile_id, kind__in=[Log.FOLLOW, Log.DISMISSAL]) |
+            Q(artist_id__in=followed, kind__in=[Log.MESSAGE, Log.SHOW])
+            ).order_by('id').values_list('kind', 'action', 'object_id')[
+            :constants.SYNC_MAX_CHANGES + 1])
+        changes['full'] = len(entries) > constants.SYNC_MAX_CHANGES
+
+    if changes['full']:
+        changes['follows'] = list(models.ArtistProfile.objects.filter(
+            id__in=followed))
+        changes['messages'] = list(get_unread_messages(profile_id))
+        changes['shows'] = list(models.Show.objects.filter(
+            artist_id__in=followed))
+        return changes
+
+    # only the latest action on each object matters
+    latest = {}
+    for kind, action, object_id in entries:
+        latest[(kind, object_id)] = action
+    followed = set(followed)
+    new_artists = []
+    message_ids = []
+    show_ids = []
+    for (kind, object_id), action in latest.items():
+        if kind == Log.FOLLOW:
+            if action == Log.DELETED and object_id not in followed:
+                changes['unfollows'].append(object_id)
+            elif action == Log.CREATED and object_id in followed:
+                new_artists.append(object_id)
+        elif kind == Log.DISMISSAL:
+            changes['dismissed_messages'].append(object_id)
+        elif kind == Log.MESSAGE:
+            if action == Log.DELETED:
+                changes['deleted_messages'].append(object_id)
+            else:
+                message_ids.append(object_id)
+        elif kind == Log.SHOW:
+            if action == Log.DELETED:
+                changes['deleted_shows'].append(object_id)
+            else:
+                show_ids.append(object_id)
+
+    changes['follows'] = _get_in_chunks(models.ArtistProfile.objects,
+        new_artists)
+    messages = _get_in_chunks(models.Message.objects, message_ids)
+    shows = _get_in_chunks(models.Show.objects, show_ids)
+    if new_artists:
+        message_ids = set(message_ids)
+        show_ids = set(show_ids)
+        messages.extend(m for m in get_unread_messages(profile_id).filter(
+            artist_id__in=new_artists) if m.id not in message_ids)
+        shows.extend(s for s in models.Show.objects.filter(
+            artist_id__in=new_artists) if s.id not in show_ids)
+    changes['messages'] = messages
+    changes['shows'] = shows
+    return changes
+
+def get_unread_count(profile_id):
+    """
+    Get the number of unread messages of a profile
+
+    Read from the profile's maintained counter. The counter is created (by
+    counting the unread messages) the first time it is needed
+    """
+    state = models.FanInboxState.objects.filter(profile_id=profile_id).first()
+    if state is None:
+        state, created = models.FanInboxState.objects.get_or_create(
+            profile_id=profile_id, defaults={
+                'unread_count': get_unread_messages(profile_id).count()})
+    return state.unread_count
+
+def _adjust_unread_counts(profile_ids, delta):
+    """
+    Add delta to the unread counters of the given profiles
+
+    Args:
+        profile_ids: a profile id, or a queryset of profile ids (values or
+            values_list), evaluated as a subquery
+        delta: the change in unread messages
+    """
+    if not delta:
+        return
+    if isinstance(profile_ids, int):
+        states = models.FanInboxState.objects.filter(profile_id=profile_ids)
+    else:
+        states = models.FanInboxState.objects.filter(
+            profile_id__in=profile_ids)
+    # profiles without a counter get one with the right count when it is
+    # first read
+    states.update(unread_count=F('unread_count') + delta)
+
+def _adjust_unread_counts_for_removed(artist_id, message_ids):
+    """
+    Decrement the unread counters of an artist's followers by the number of
+    the artist's messages that are about to be removed and that they haven't
+    read (with a single UPDATE)
+
+    Args:
+        artist_id: id of the models.ArtistProfile
+        message_ids: ids of the artist's messages (at most
+            constants.MAX_IN_CLAUSE_SIZE)
+    """
+    tables = {
+        'dismissed': models.Message.dismissed_by.through._meta.db_table,
+        'message': models.Message._meta.db_table,
+        'state': models.FanInboxState._meta.db_table,
+        'ids': ', '.join(['%s'] * len(message_ids))
+    }
+    unread = RawSQL('SELECT COUNT(*) FROM {message} WHERE {message}.id IN '
+        '({ids}) AND {message}.id > {state}.read_up_to AND NOT EXISTS ('
+        'SELECT 1 FROM {dismissed} WHERE {dismissed}.message_id = '
+        '{message}.id AND {dismissed}.basicprofile_id = {state}.profile_id)'
+        .format(**tables), list(message_ids), output_field=IntegerField())
+    followers = models.ArtistProfile.connected_users.through.objects.filter(
+        artistprofile_id=artist_id).values('basicprofile_id')
+    # profiles without a counter get one with the right count when it is
+    # first read
+    models.FanInboxState.objects.filter(profile_id__in=followers).update(
+        unread_count=F('unread_count') - unread)
+
+def _count_unread_from_artists(profile_id, artist_ids):
+    dismissed = models.Message.dismissed_by.through.objects.filter(
+        basicprofile_id=profile_id).values('message_id')
+    return models.Message.objects.filter(artist_id__in=artist_ids,
+        id__gt=get_read_up_to(profile_id)).exclude(id__in=dismissed).count()
+
+def get_read_up_to(profile_id):
+    """
+    Returns the id up to which all messages are read for a profile
+    """
+    return models.FanInboxState.objects.filter(profile_id=profile_id
+        ).values_list('read_up_to', flat=True).first() or 0
+
+def compact_dismissals(profile_id):
+    """
+    Replace a profile's dismissal rows with its read-up-to mark
+
+    The mark is raised to just below the profile's oldest unread message (or
+    to the newest message of a followed artist, if everything is read), and
+    the dismissal rows (and, with settings.MESSAGE_FANOUT_ON_WRITE, the inbox
+    entries) of followed artists' messages up to it are deleted
+
+    Returns:
+        the number of dismissal rows deleted
+    """
+    Dismissed = models.Message.dismissed_by.through
+    followed = models.ArtistProfile.connected_users.through.objects.filter(
+        basicprofile_id=profile_id).values('artistprofile_id')
+    unread = get_unread_messages(profile_id)
+    with transaction.atomic():
+        oldest_unread = unread.aggregate(Min('id'))['id__min']
+        if oldest_unread is None:
+            mark = models.Message.objects.filter(artist_id__in=followed
+                ).aggregate(Max('id'))['id__max'] or 0
+        else:
+            mark = oldest_unread - 1
+        if mark <= get_read_up_to(profile_id):
+            return 0
+        models.FanInboxState.objects.get_or_create(profile_id=profile_id,
+            defaults={'unread_count': unread.count()})
+        models.FanInboxState.objects.filter(profile_id=profile_id).update(
+            read_up_to=mark)
+        covered = models.Message.objects.filter(artist_id__in=followed,
+            id__lte=mark).values('id')
+        rows = Dismissed.objects.filter(basicprofile_id=profile_id,
+            message_id__in=covered)
+        count = rows.count()
+        rows.delete()
+        if settings.MESSAGE_FANOUT_ON_WRITE:
+            models.InboxEntry.objects.filter(profile_id=profile_id,
+                message_id__lte=mark).delete()
+    return count
+
+def _remember_read_marks(profile_id, artist_ids):
+    """
+    Record a profile's read-up-to mark for artists it is unfollowing, so the
+    artists' messages covered by the mark stay read if it follows them again
+    """
+    mark = get_read_up_to(profile_id)
+    marks = models.ArtistReadMark.objects.filter(profile_id=profile_id,
+        artist_id__in=artist_ids)
+    marks.delete()
+    if mark:
+        marks.bulk_create([models.ArtistReadMark(profile_id=profile_id,
+            artist_id=artist_id, read_up_to=mark)
+            for artist_id in artist_ids])
+
+def _uncover_artists(profile_id, artist_ids,
+        limit=constants.UNCOVER_MAX_DISMISSALS):
+    """
+    Lower a profile's read-up-to mark below some artists' unread messages
+    (before following the artists), recreating the dismissal rows the mark
+    replaced for the messages of other followed artists
+
+    Messages of the artists that were read when the profile last unfollowed
+    them (see models.ArtistReadMark) stay read. At most limit rows are
+    recreated: past that, the mark is only lowered as far as the recreated
+    rows reach, so the artists' oldest messages under it stay read
+    """
+    Dismissed = models.Message.dismissed_by.through
+    mark = get_read_up_to(profile_id)
+    tables = {
+        'message': models.Message._meta.db_table,
+        'read_mark': models.ArtistReadMark._meta.db_table
+    }
+    # the mark each artist's messages were read up to when it was unfollowed
+    floor = ('COALESCE((SELECT read_up_to FROM {read_mark} WHERE '
+        '{read_mark}.profile_id = %s AND {read_mark}.artist_id = '
+        '{message}.artist_id), 0)'.format(**tables))
+    existing = Dismissed.objects.filter(basicprofile_id=profile_id).values(
+        'message_id')
+    messages = models.Message.objects.filter(artist_id__in=artist_ids
+        ).exclude(id__in=existing)
+    oldest = messages.filter(id__lte=mark).extra(
+        where=['{message}.id > '.format(**tables) + floor],
+        params=[profile_id]).aggregate(Min('id'))['id__min']
+    new_mark = mark if oldest is None else oldest - 1
+    # messages that must keep reading as read above the new mark: the
+    # artists' messages read before they were unfollowed, and the messages
+    # of other followed artists under the old mark
+    followed = models.ArtistProfile.connected_users.through.objects.filter(
+        basicprofile_id=profile_id).exclude(artistprofile_id__in=artist_ids
+        ).values('artistprofile_id')
+    read_ids = list(messages.filter(id__gt=new_mark).extra(
+        where=['{message}.id <= '.format(**tables) + floor],
+        params=[profile_id]).order_by('-id').values_list('id',
+        flat=True)[:limit + 1])
+    covered_ids = list(models.Message.objects.filter(artist_id__in=followed,
+        id__gt=new_mark, id__lte=mark).exclude(id__in=existing).order_by(
+        '-id').values_list('id', flat=True)[:limit + 1])
+    message_ids = sorted(read_ids + covered_ids, reverse=True)
+    if len(message_ids) > limit:
+        new_mark = min(mark, message_ids[limit])
+        message_ids = message_ids[:limit]
+    Dismissed.objects.bulk_create([Dismissed(message_id=message_id,
+        basicprofile_id=profile_id) for message_id in message_ids])
+    if new_mark != mark:
+        models.FanInboxState.objects.filter(profile_id=profile_id).update(
+            read_up_to=new_mark)
+    models.ArtistReadMark.objects.filter(profile_id=profile_id,
+        artist_id__in=artist_ids).delete()
+
+def archive_messages(before, limit=constants.MAX_IN_CLAUSE_SIZE):
+    """
+    Move (up to limit of) the oldest messages created before a date to the
+    archive (models.ArchivedMessage), in one transaction
+
+    Returns:
+        the number of messages archived
+    """
+    limit = min(limit, constants.MAX_IN_CLAUSE_SIZE)
+    with transaction.atomic():
+        messages = list(models.Message.objects.filter(created_at__lt=before
+            ).order_by('id')[:limit])
+        if not messages:
+            return 0
+        models.ArchivedMessage.objects.bulk_create([models.ArchivedMessage(
+            id=m.id, text=m.text, created_at=m.created_at,
+            attachment=m.attachment, artist_id=m.artist_id)
+            for m in messages])
+        by_artist = {}
+        for message in messages:
+            by_artist.setdefault(message.artist_id, []).append(message.id)
+        for artist_id, message_ids in by_artist.items():
+            _adjust_unread_counts_for_removed(artist_id, message_ids)
+        models.ChangeLogEntry.objects.bulk_create([models.ChangeLogEntry(
+            kind=models.ChangeLogEntry.MESSAGE,
+            action=models.ChangeLogEntry.DELETED, object_id=m.id,
+            artist_id=m.artist_id) for m in messages])
+        models.Message.objects.filter(id__in=[m.id for m in messages]
+            ).delete()
+    return len(messages)
+
+def _insert_dismissals(profile_id, message_ids):
+    """
+    Insert dismissal rows for a profile, skipping the messages that are
+    already dismissed (possibly by a concurrent request)
+
+    Returns:
+        the ids of the messages dismissed
+    """
+    Dismissed = models.Message.dismissed_by.through
+    while message_ids:
+        try:
+            with transaction.atomic():
+                Dismissed.objects.bulk_create([Dismissed(
+                    message_id=message_id, basicprofile_id=profile_id)
+                    for message_id in message_ids])
+            return message_ids
+        except IntegrityError:
+            existing = set()
+            for i in range(0, len(message_ids), constants.MAX_IN_CLAUSE_SIZE):
+                existing.update(Dismissed.objects.filter(
+                    basicprofile_id=profile_id, message_id__in=message_ids[
+                    i:i + constants.MAX_IN_CLAUSE_SIZE]).values_list(
+                    'message_id', flat=True))
+            if not existing:
+                raise
+            message_ids = [i for i in message_ids if i not in existing]
+    return message_ids
+
+def mark_message_as_read(profile_id, message):
+    with transaction.atomic():
+        if message.id <= get_read_up_to(profile_id) or \
+                not _insert_dismissals(profile_id, [message.id]):
+            return
+        _adjust_unread_counts(profile_id, -1)
+        log_change(models.ChangeLogEntry.DISMISSAL,
+            models.ChangeLogEntry.CREATED, message.id, profile_id=profile_id)
+        if settings.MESSAGE_FANOUT_ON_WRITE:
+            models.InboxEntry.objects.filter(profile_id=profile_id,
+                message=message).update(dismissed=True)
     return
 
+def dismiss_messages(profile_id, message_ids=None, up_to=None):
+    """
+    Mark several unread messages as read for a profile
 
-def delete_show(username, show):
-    profile = get_profile(username)
-    if username != show.artist.basic_profile.user.username and profile.highest_role() not in ['ADMIN']:
+    All dismissals are written with one bulk insert, in a single transaction
+    (messages dismissed by a concurrent request in the meantime are skipped)
+
+    Args:
+        profile_id: id of the models.BasicProfile
+        message_ids: ids of the messages to dismiss (ids that aren't unread
+            messages of the profile are ignored)
+        up_to: dismiss every unread message with an id less than or equal
+            to this instead
+
+    Returns:
+        the number of messages dismissed
+    """
+    if (message_ids is None) == (up_to is None):
+        raise errors.InvalidInput('Provide either message ids or up_to')
+    unread = get_unread_messages(profile_id)
+    with transaction.atomic():
+        if up_to is not None:
+            ids = list(unread.filter(id__lte=up_to).values_list('id',
+                flat=True))
+        else:
+            message_ids = list(set(message_ids))
+            ids = []
+            for i in range(0, len(message_ids), constants.MAX_IN_CLAUSE_SIZE):
+                ids.extend(unread.filter(id__in=message_ids[
+                    i:i + constants.MAX_IN_CLAUSE_SIZE]).values_list('id',
+                    flat=True))
+        ids = _insert_dismissals(profile_id, ids)
+        _adjust_unread_counts(profile_id, -len(ids))
+        log_changes(models.ChangeLogEntry.DISMISSAL,
+            models.ChangeLogEntry.CREATED, ids, profile_id=profile_id)
+        if settings.MESSAGE_FANOUT_ON_WRITE:
+            for i in range(0, len(ids), constants.MAX_IN_CLAUSE_SIZE):
+                models.InboxEntry.objects.filter(profile_id=profile_id,
+                    message_id__in=ids[i:i + constants.MAX_IN_CLAUSE_SIZE]
+                    ).update(dismissed=True)
+    return len(ids)
+
+def create_message(artist, text, attachment=None):
+    """
+    Create a message from an artist, delivering it to the inbox of every
+    follower if settings.MESSAGE_FANOUT_ON_WRITE is enabled
+
+    Returns:
+        the new models.Message
+    """
+    with transaction.atomic():
+        message = models.Message(artist=artist, text=text,
+            attachment=attachment)
+        message.save()
+        log_change(models.ChangeLogEntry.MESSAGE,
+            models.ChangeLogEntry.CREATED, message.id, artist_id=artist.id)
+        followers = models.ArtistProfile.connected_users.through.objects.filter(
+            artistprofile_id=artist.id).values_list('basicprofile_id',
+            flat=True)
+        _adjust_unread_counts(followers, 1)
+        if settings.MESSAGE_FANOUT_ON_WRITE:
+            _create_inbox_entries(models.InboxEntry(profile_id=profile_id,
+                message_id=message.id, artist_id=artist.id)
+                for profile_id in followers.iterator())
+    broker.get_broker().publish(message.id, artist.id)
+    return message
+
+def _create_inbox_entries(entries):
+    """
+    Bulk insert inbox entries from an iterable, in batches of
+    constants.INBOX_FANOUT_BATCH_SIZE
+
+    Returns the number of entries inserted
+    """
+    count = 0
+    batch = []
+    for entry in entries:
+        batch.append(entry)
+        if len(batch) >= constants.INBOX_FANOUT_BATCH_SIZE:
+            models.InboxEntry.objects.bulk_create(batch)
+            count += len(batch)
+            batch = []
+    if batch:
+        models.InboxEntry.objects.bulk_create(batch)
+        count += len(batch)
+    return count
+
+def backfill_inbox(profile_id, artist_id):
+    """
+    Deliver all of an artist's messages that a profile hasn't dismissed (and
+    that aren't already there) to the profile's inbox
+
+    Returns the number of entries created
+    """
+    existing = models.InboxEntry.objects.filter(profile_id=profile_id,
+        artist_id=artist_id).values('message_id')
+    dismissed = models.Message.dismissed_by.through.objects.filter(
+        basicprofile_id=profile_id).values('message_id')
+    messages = models.Message.objects.filter(artist_id=artist_id,
+        id__gt=get_read_up_to(profile_id)).exclude(
+        id__in=existing).exclude(id__in=dismissed).values_list('id',
+        flat=True)
+    return _create_inbox_entries(models.InboxEntry(profile_id=profile_id,
+        message_id=message_id, artist_id=artist_id)
+        for message_id in messages.iterator())
+
+def follow_artist(artist_id, profile_id):
+    """
+    Make a profile follow an artist
+
+    Returns:
+        False if the profile was already following the artist, True otherwise
+    """
+    Follow = models.ArtistProfile.connected_users.through
+    with transaction.atomic():
+        if Follow.objects.filter(artistprofile_id=artist_id,
+                basicprofile_id=profile_id).exists():
+            return False
+        _uncover_artists(profile_id, [artist_id])
+        Follow.objects.create(artistprofile_id=artist_id,
+            basicprofile_id=profile_id)
+        _adjust_follow_counts(profile_id, [artist_id], 1)
+        log_change(models.ChangeLogEntry.FOLLOW,
+            models.ChangeLogEntry.CREATED, artist_id, artist_id=artist_id,
+            profile_id=profile_id)
+        _adjust_unread_counts(profile_id,
+            _count_unread_from_artists(profile_id, [artist_id]))
+        if settings.MESSAGE_FANOUT_ON_WRITE:
+            backfill_inbox(profile_id, artist_id)
+    return True
+
+def unfollow_artist(artist_id, profile_id):
+    """
+    Make a profile stop following an artist, removing the artist's messages
+    from the profile's inbox
+
+    Returns:
+        False if the profile wasn't following the artist, True otherwise
+    """
+    Follow = models.ArtistProfile.connected_users.through
+    with transaction.atomic():
+        follow = Follow.objects.filter(artistprofile_id=artist_id,
+            basicprofile_id=profile_id)
+        if not follow.exists():
+            return False
+        follow.delete()
+        _remember_read_marks(profile_id, [artist_id])
+        _adjust_follow_counts(profile_id, [artist_id], -1)
+        log_change(models.ChangeLogEntry.FOLLOW,
+            models.ChangeLogEntry.DELETED, artist_id, artist_id=artist_id,
+            profile_id=profile_id)
+        _adjust_unread_counts(profile_id,
+            -_count_unread_from_artists(profile_id, [artist_id]))
+        models.InboxEntry.objects.filter(profile_id=profile_id,
+            artist_id=artist_id).delete()
+    return True
+
+def _adjust_follow_counts(profile_id, artist_ids, delta):
+    """
+    Add delta to the follower counts of some artists, and delta per artist to
+    the following count of a profile
+    """
+    models.ArtistProfile.objects.filter(id__in=artist_ids).update(
+        follower_count=F('follower_count') + delta)
+    models.BasicProfile.objects.filter(id=profile_id).update(
+        following_count=F('following_count') + delta * len(artist_ids))
+
+def _log_follows(profile_id, artist_ids, action):
+    models.ChangeLogEntry.objects.bulk_create([models.ChangeLogEntry(
+        kind=models.ChangeLogEntry.FOLLOW, action=action, object_id=artist_id,
+        artist_id=artist_id, profile_id=profile_id)
+        for artist_id in artist_ids])
+
+def follow_artists(profile_id, artist_ids):
+    """
+    Make a profile follow several artists, in one transaction
+
+    Unknown artists and artists the profile already follows are skipped.
+    Follows are written with a single bulk insert
+
+    Args:
+        profile_id: id of the models.BasicProfile
+        artist_ids: ids of the artists (at most constants.MAX_IN_CLAUSE_SIZE)
+
+    Returns:
+        the ids of the artists newly followed
+    """
+    if len(artist_ids) > constants.MAX_IN_CLAUSE_SIZE:
+        raise errors.InvalidInput('Cannot follow more than %d artists at once'
+            % constants.MAX_IN_CLAUSE_SIZE)
+    Follow = models.ArtistProfile.connected_users.through
+    with transaction.atomic():
+        followed = Follow.objects.filter(basicprofile_id=profile_id,
+            artistprofile_id__in=artist_ids).values('artistprofile_id')
+        new_ids = list(models.ArtistProfile.objects.filter(
+            id__in=artist_ids).exclude(id__in=followed).values_list('id',
+            flat=True))
+        if not new_ids:
+            return []
+        _uncover_artists(profile_id, new_ids)
+        Follow.objects.bulk_create([Follow(artistprofile_id=artist_id,
+            basicprofile_id=profile_id) for artist_id in new_ids])
+        _adjust_follow_counts(profile_id, new_ids, 1)
+        _log_follows(profile_id, new_ids, models.ChangeLogEntry.CREATED)
+        _adjust_unread_counts(profile_id,
+            _count_unread_from_artists(profile_id, new_ids))
+        if settings.MESSAGE_FANOUT_ON_WRITE:
+            for artist_id in new_ids:
+                backfill_inbox(profile_id, artist_id)
+    return new_ids
+
+def import_follows(profile_id, artist_ids=(), facebook_page_ids=()):
+    """
+    Make a profile follow artists given by id and/or facebook page id
+
+    Artists are resolved with a single lookup on the id and facebook_page_id
+    indexes, then followed with follow_artists
+
+    Args:
+        profile_id: id of the models.BasicProfile
+        artist_ids: ids of the artists
+        facebook_page_ids: facebook page ids of the artists (at most
+            constants.MAX_IN_CLAUSE_SIZE ids and page ids together)
+
+    Returns:
+        a dict with the ids of the artists matched and newly followed, and
+        the artist ids and facebook page ids that matched no artist
+    """
+    artist_ids = set(artist_ids)
+    facebook_page_ids = set(facebook_page_ids)
+    if len(artist_ids) + len(facebook_page_ids) > \
+            constants.MAX_IN_CLAUSE_SIZE:
+        raise errors.InvalidInput('Cannot import more than %d artists at once'
+            % constants.MAX_IN_CLAUSE_SIZE)
+    matches = []
+    if artist_ids or facebook_page_ids:
+        matches = list(models.ArtistProfile.objects.filter(
+            Q(id__in=artist_ids) | Q(facebook_page_id__in=facebook_page_ids)
+            ).values_list('id', 'facebook_page_id'))
+    matched_ids = sorted(set(artist_id for artist_id, _ in matches))
+    followed = follow_artists(profile_id, matched_ids)
+    return {
+        'matched': matched_ids,
+        'followed': sorted(followed),
+        'unmatched_ids': sorted(artist_ids - set(matched_ids)),
+        'unmatched_facebook_page_ids': sorted(facebook_page_ids -
+            set(page_id for _, page_id in matches))
+    }
+
+def unfollow_artists(profile_id, artist_ids):
+    """
+    Make a profile stop following several artists, in one transaction
+
+    Follows are removed with a single bulk delete. Artists the profile
+    doesn't follow are skipped
+
+    Args:
+        profile_id: id of the models.BasicProfile
+        artist_ids: ids of the artists (at most constants.MAX_IN_CLAUSE_SIZE)
+
+    Returns:
+        the ids of the artists unfollowed
+    """
+    if len(artist_ids) > constants.MAX_IN_CLAUSE_SIZE:
+        raise errors.InvalidInput('Cannot unfollow more than %d artists at '
+            'once' % constants.MAX_IN_CLAUSE_SIZE)
+    Follow = models.ArtistProfile.connected_users.through
+    with transaction.atomic():
+        follows = Follow.objects.filter(basicprofile_id=profile_id,
+            artistprofile_id__in=artist_ids)
+        removed_ids = list(follows.values_list('artistprofile_id', flat=True))
+        if not removed_ids:
+            return []
+        follows.delete()
+        _remember_read_marks(profile_id, removed_ids)
+        _adjust_follow_counts(profile_id, removed_ids, -1)
+        _log_follows(profile_id, removed_ids, models.ChangeLogEntry.DELETED)
+        _adjust_unread_counts(profile_id,
+            -_count_unread_from_artists(profile_id, removed_ids))
+        models.InboxEntry.objects.filter(profile_id=profile_id,
+            artist_id__in=removed_ids).delete()
+    return removed_ids
+
+def iter_followers(artist_id, chunk_size=constants.EXPORT_CHUNK_SIZE):
+    """
+    Iterate over the followers of an artist, ordered by profile id
+
+    Followers are read straight from the artist_user table (joined with the
+    user) in keyset chunks of chunk_size rows, so memory use doesn't grow
+    with the number of followers
+
+    Yields:
+        (profile id, username, email) tuples
+    """
+    Follow = models.ArtistProfile.connected_users.through
+    last_id = 0
+    while True:
+        rows = list(Follow.objects.filter(artistprofile_id=artist_id,
+            basicprofile_id__gt=last_id).order_by('basicprofile_id'
+            ).values_list('basicprofile_id', 'basicprofile__user__username',
+            'basicprofile__user__email')[:chunk_size])
+        for row in rows:
+            yield row
+        if len(rows) < chunk_size:
+            return
+        last_id = rows[-1][0]
+
+def set_followers(artist_id, profile_ids):
+    """
+    Replace the followers of an artist
+    """
+    profile_ids = set(profile_ids)
+    current = set(models.ArtistProfile.connected_users.through.objects.filter(
+        artistprofile_id=artist_id).values_list('basicprofile_id', flat=True))
+    with transaction.atomic():
+        for profile_id in current - profile_ids:
+            unfollow_artist(artist_id, profile_id)
+        for profile_id in profile_ids - current:
+            follow_artist(artist_id, profile_id)
+
+
+def delete_show(identity, show):
+    if not identity.can_manage_artist(show.artist_id):
         raise errors.PermissionDenied('Cannot delete a show for another artist')
-    show.delete()
+    with transaction.atomic():
+        log_change(models.ChangeLogEntry.SHOW, models.ChangeLogEntry.DELETED,
+            show.id, artist_id=show.artist_id)
+        show.delete()
 
-def delete_message(username, message):
-    profile = get_profile(username)
-    if username != message.artist.basic_profile.user.username and profile.highest_role() not in ['ADMIN']:
+def delete_message(identity, message):
+    if not identity.can_manage_artist(message.artist_id):
         raise errors.PermissionDenied('Cannot delete a message for another artist')
-    message.delete()
+    with transaction.atomic():
+        _adjust_unread_counts_for_removed(message.artist_id, [message.id])
+        log_change(models.ChangeLogEntry.MESSAGE,
+            models.ChangeLogEntry.DELETED, message.id,
+            artist_id=message.artist_id)
+        message.delete()
 
 def get_all_images():
     images = models.Image.objects.all()
@@ -162,6 +1190,13 @@ def user_is_artist(username):
         return True
     return False
 
+def get_artist_id_by_profile_id(profile_id):
+    """
+    Returns the artist id for a given profile id, or None
+    """
+    return models.ArtistProfile.objects.filter(
+        basic_profile__id=profile_id).values_list('id', flat=True).first()
+
 def get_artist_id_by_username(username):
     """
     Returns the artist id for a given username, or null
@@ -1,12 +1,61 @@
 """
-Utils tests
+Tests
 """
+import datetime
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+import django.contrib.auth
+from django.conf import settings
 from django.test import TestCase
+from django.test import override_settings
+from django.utils import timezone
+from rest_framework.test import APIClient
 from django.db.utils import IntegrityError
+from django.db import connection
 from django.db import transaction
+from django.test.utils import CaptureQueriesContext
 
+from main import broker as broker
+from main import buffers as buffers
+from main import cache as cache
+from main import errors as errors
+from main import geo_snapshot as geo_snapshot
+from main import identity as identity
 from main import models as models
+from main import serializers as serializers
+from main import services as services
+from main import tokens as tokens
 from main import utils as utils
+from main.scripts import repair_follow_counts
+from main.scripts import repair_profile_roles
+
+
+def create_artist(username, lat, lon):
+    """
+    Create an artist (with its user and profile) at a location
+    """
+    profile = models.BasicProfile.create_user(username,
+        groups=['ARTIST'])
+    profile.current_latitude = lat
+    profile.current_longitude = lon
+    profile.save()
+    artist = models.ArtistProfile(basic_profile=profile, name=username)
+    artist.save()
+    return artist
+
+def login(username):
+    """
+    Returns an APIClient logged in (with a session) as a user
+    """
+    client = APIClient()
+    client.post('/api/login/', {'anonymous_id': username}, format='json')
+    return client
+
 
 class UtilsTest(TestCase):
 
@@ -61,8 +110,1299 @@ class UtilsTest(TestCase):
             dc_lat, dc_lon, '54')
         self.assertFalse(res)
 
+    def test_get_points_inside_radius(self):
+        baltimore = ('39.2833', '-76.6167')
+        lats = ['39.2910', '38.9047', '39.2833']
+        lons = ['-76.6107', '-77.0164', '-76.6167']
+        distances, mask = utils.get_points_inside_radius(baltimore[0],
+            baltimore[1], lats, lons, '1')
+        self.assertEqual(list(mask), [True, False, True])
+        self.assertAlmostEqual(distances[0], 0.9999, places=3)
+        self.assertAlmostEqual(distances[1], 54.4252, places=3)
+        self.assertEqual(distances[2], 0)
+
+        # matches the scalar version
+        for lat, lon in zip(lats, lons):
+            self.assertEqual(utils.is_inside_radius(baltimore[0],
+                baltimore[1], lat, lon, '55'), True)
+        distances, mask = utils.get_points_inside_radius(baltimore[0],
+            baltimore[1], lats, lons, '54')
+        self.assertEqual(list(mask), [True, False, True])
+
+        distances, mask = utils.get_points_inside_radius(baltimore[0],
+            baltimore[1], [], [], '1')
+        self.assertEqual(len(mask), 0)
+
+    def test_get_geo_cell(self):
+        # Baltimore and Baltimore City Hall share a cell, DC does not
+        self.assertEqual(utils.get_geo_cell('39.2833', '-76.6167'),
+            utils.get_geo_cell('39.2910', '-76.6107'))
+        self.assertNotEqual(utils.get_geo_cell('39.2833', '-76.6167'),
+            utils.get_geo_cell('38.9047', '-77.0164'))
+        self.assertIsNone(utils.get_geo_cell('', '-76.6167'))
+        self.assertIsNone(utils.get_geo_cell(None, None))
+
+    def test_get_cells_in_radius(self):
+        cells = utils.get_cells_in_radius('39.2833', '-76.6167', '55')
+        self.assertIn(utils.get_geo_cell('39.2833', '-76.6167'), cells)
+        self.assertIn(utils.get_geo_cell('38.9047', '-77.0164'), cells)
+
+        # a circle crossing the antimeridian includes cells on both sides
+        cells = utils.get_cells_in_radius('0', '179.9', '50')
+        self.assertIn(utils.get_geo_cell('0', '179.9'), cells)
+        self.assertIn(utils.get_geo_cell('0', '-179.9'), cells)
+
+        # huge circles are not worth indexing
+        self.assertIsNone(utils.get_cells_in_radius('0', '0', '10000'))
+
+
+class GeoQueryTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        models.BasicProfile.create_groups()
+        cls.baltimore = create_artist('baltimore_band', '39.2910',
+            '-76.6107')
+        cls.dc = create_artist('dc_band', '38.9047', '-77.0164')
+        cls.nowhere = create_artist('nowhere_band', None, None)
+
+    def test_get_artists_in_radius(self):
+        artists = services.get_artists_in_radius('39.2833', '-76.6167', '1')
+        self.assertEqual([a.id for a in artists], [self.baltimore.id])
+
+        artists = services.get_artists_in_radius('39.2833', '-76.6167', '55')
+        self.assertEqual(sorted([a.id for a in artists]),
+            sorted([self.baltimore.id, self.dc.id]))
+
+        # large radius skips the index but gives the same answer
+        artists = services.get_artists_in_radius('39.2833', '-76.6167',
+            '10000')
+        self.assertEqual(sorted([a.id for a in artists]),
+            sorted([self.baltimore.id, self.dc.id]))
+
+    def test_location_write_updates_cell(self):
+        profile = self.dc.basic_profile
+        profile.current_latitude = '39.2833'
+        profile.current_longitude = '-76.6167'
+        profile.save()
+        self.assertEqual(profile.geo_cell,
+            utils.get_geo_cell('39.2833', '-76.6167'))
+        artists = services.get_artists_in_radius('39.2833', '-76.6167', '1')
+        self.assertEqual(sorted([a.id for a in artists]),
+            sorted([self.baltimore.id, self.dc.id]))
+
+    def test_profile_update_without_location(self):
+        client = login('dc_band')
+        url = '/api/profile/%s/' % self.dc.basic_profile.id
+        response = client.put(url, {}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['current_latitude'], '38.9047')
+        profile = models.BasicProfile.objects.get(id=self.dc.basic_profile.id)
+        self.assertEqual(profile.current_longitude, -77.0164)
+        self.assertEqual(profile.geo_cell,
+            utils.get_geo_cell('38.9047', '-77.0164'))
+
+        response = client.put(url, {'current_latitude': '',
+            'current_longitude': ''}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertIsNone(models.BasicProfile.objects.get(
+            id=self.dc.basic_profile.id).current_latitude)
+
+    @override_settings(GEO_QUERY_CACHE_ENABLED=True)
+    def test_location_write_queries(self):
+        fan = models.BasicProfile.create_user('wandering_fan')
+        # only the location is written for a fan
+        with CaptureQueriesContext(connection) as queries:
+            services.update_location(fan, '39.2833', '-76.6167')
+        self.assertEqual(len(queries), 1)
+        # an artist's id is looked up when it isn't given
+        profile = models.BasicProfile.objects.get(id=self.dc.basic_profile.id)
+        with CaptureQueriesContext(connection) as queries:
+            services.update_location(profile, '39.2833', '-76.6167')
+        self.assertEqual(len(queries), 2)
+        with CaptureQueriesContext(connection) as queries:
+            services.update_location(profile, '39.2833', '-76.6167',
+                artist_id=self.dc.id)
+        self.assertEqual(len(queries), 1)
+
+    def test_coordinates_serialized_as_strings(self):
+        data = serializers.BasicProfileShortSerializer(
+            self.baltimore.basic_profile).data
+        self.assertEqual(data['current_latitude'], '39.291')
+        self.assertEqual(data['current_longitude'], '-76.6107')
+        data = serializers.BasicProfileShortSerializer(
+            self.nowhere.basic_profile).data
+        self.assertIsNone(data['current_latitude'])
+
+    def test_bounding_box_crosses_antimeridian(self):
+        fiji = create_artist('fiji_band', '-17.7134', '178.065')
+        artists = services.get_artists_in_radius('-17.7134', '-179.9', '250')
+        self.assertEqual([a.id for a in artists], [fiji.id])
+
+    def test_get_nearest_artists(self):
+        fiji = create_artist('fiji_band', '-17.7134', '178.065')
+        nearest = services.get_nearest_artists('39.2833', '-76.6167', 2)
+        self.assertEqual([a.id for a, d in nearest],
+            [self.baltimore.id, self.dc.id])
+        self.assertAlmostEqual(nearest[1][1], 54.4252, places=3)
+
+        # continue after the last result (requires searching the globe)
+        last_artist, last_distance = nearest[-1]
+        nearest = services.get_nearest_artists('39.2833', '-76.6167', 2,
+            after=(last_distance, last_artist.id))
+        self.assertEqual([a.id for a, d in nearest], [fiji.id])
+
+    def test_nearest_artists_view(self):
+        client = login('dc_band')
+        url = '/api/nearest-artists/?latitude=39.2833&longitude=-76.6167&limit=1'
+        response = client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['results'][0]['id'], self.baltimore.id)
+        self.assertEqual(response.data['results'][0]['distance'], 1.0)
+
+        response = client.get(url + '&cursor=' + response.data['next'])
+        self.assertEqual([a['id'] for a in response.data['results']],
+            [self.dc.id])
+
+        response = client.get(url + '&cursor=garbage')
+        self.assertEqual(response.status_code, 400)
+        response = client.get(url + '&cursor=' +
+            utils.encode_cursor(['a', self.dc.id]))
+        self.assertEqual(response.status_code, 400)
+
+    def test_non_finite_coordinates(self):
+        client = login('dc_band')
+        for url in ['/api/nearest-artists/?latitude=%s&longitude=0',
+                '/api/artists-in-radius/?latitude=%s&longitude=0&radius=1',
+                '/api/shows-in-radius/?latitude=%s&longitude=0&radius=1']:
+            for value in ['nan', 'inf']:
+                response = client.get(url % value)
+                self.assertEqual(response.status_code, 400)
+        response = client.put('/api/profile/%s/' % self.dc.basic_profile.id,
+            {'current_latitude': 'nan', 'current_longitude': '0'},
+            format='json')
+        self.assertEqual(response.status_code, 400)
+
+    def test_coordinate_ranges(self):
+        client = login('dc_band')
+        url = '/api/profile/%s/' % self.dc.basic_profile.id
+        for latitude, longitude in [('90.5', '0'), ('-91', '0'), ('0', '180.5'),
+                ('0', '-181')]:
+            response = client.put(url, {'current_latitude': latitude,
+                'current_longitude': longitude}, format='json')
+            self.assertEqual(response.status_code, 400)
+        response = client.put(url, {'current_latitude': '-90',
+            'current_longitude': '180'}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual((response.data['current_latitude'],
+            response.data['current_longitude']), ('-90.0', '180.0'))
+
+
+@override_settings(LOCATION_BUFFER_ENABLED=True,
+    LOCATION_BUFFER_FLUSH_SECONDS=3600)
+class LocationBufferTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        models.BasicProfile.create_groups()
+        cls.artist = create_artist('moving_band', '38.9047',
+            '-77.0164')
+
+    def tearDown(self):
+        buffers.location_buffer.clear()
+
+    def test_buffered_location_update(self):
+        client = login('moving_band')
+        profile_id = self.artist.basic_profile.id
+        for lat, lon in [('39.0', '-77.0'), ('39.2910', '-76.6107')]:
+            response = client.put('/api/profile/%s/' % profile_id,
+                {'current_latitude': lat, 'current_longitude': lon},
+                format='json')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(float(response.data['current_latitude']),
+                float(lat))
+
+        # only the latest position is kept, and it is not written yet
+        self.assertEqual(buffers.location_buffer.pending(),
+            {profile_id: (39.291, -76.6107)})
+        profile = models.BasicProfile.objects.get(id=profile_id)
+        self.assertEqual(profile.current_latitude, 38.9047)
+
+        # but radius queries see it
+        artists = services.get_artists_in_radius('39.2833', '-76.6167', '1')
+        self.assertEqual([a.id for a in artists], [self.artist.id])
+        nearest = services.get_nearest_artists('39.2833', '-76.6167', 1)
+        self.assertAlmostEqual(nearest[0][1], 0.9999, places=3)
+
+        self.assertEqual(buffers.location_buffer.flush(), 1)
+        profile = models.BasicProfile.objects.get(id=profile_id)
+        self.assertEqual(profile.current_latitude, 39.291)
+        self.assertEqual(profile.geo_cell,
+            utils.get_geo_cell('39.2910', '-76.6107'))
+        artists = services.get_artists_in_radius('39.2833', '-76.6167', '1')
+        self.assertEqual([a.id for a in artists], [self.artist.id])
+
+    def test_flush_keeps_locations_visible(self):
+        profile_id = self.artist.basic_profile.id
+        test = self
+        class WatchedBuffer(buffers.LocationBuffer):
+            def _write(self, batch):
+                if batch[profile_id] == (39.0, -77.0):
+                    # still visible while it is being written
+                    test.assertEqual(self.get(profile_id), (39.0, -77.0))
+                    # moved again during the write
+                    self.add(profile_id, 39.5, -77.5)
+                super(WatchedBuffer, self)._write(batch)
+        location_buffer = WatchedBuffer()
+        # don't start the background flusher
+        location_buffer._flusher = True
+        location_buffer.add(profile_id, 39.0, -77.0)
+        self.assertEqual(location_buffer.flush(), 1)
+        self.assertEqual(models.BasicProfile.objects.get(
+            id=profile_id).current_latitude, 39.0)
+        self.assertEqual(location_buffer.pending(),
+            {profile_id: (39.5, -77.5)})
+        self.assertEqual(location_buffer.flush(), 1)
+        self.assertEqual(location_buffer.pending(), {})
+
+class GeoSnapshotTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        models.BasicProfile.create_groups()
+        cls.baltimore = create_artist('baltimore_band',
+            '39.2910', '-76.6107')
+        cls.dc = create_artist('dc_band', '38.9047', '-77.0164')
+        cls.nowhere = create_artist('nowhere_band', None, None)
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'geo_snapshot.bin')
+        self.settings_override = override_settings(GEO_SNAPSHOT_PATH=self.path)
+        self.settings_override.enable()
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.tmp_dir)
+
+    def get_snapshot(self):
+        snapshot = geo_snapshot.get_snapshot()
+        # the test data isn't visible to other threads, so record background
+        # rebuilds instead of starting them
+        self.rebuilds = []
+        snapshot.rebuild_in_background = lambda: self.rebuilds.append(True)
+        return snapshot
+
+    def test_snapshot_lookup(self):
+        snapshot = self.get_snapshot()
+        # no snapshot yet - falls back and starts building one
+        self.assertIsNone(snapshot.get_artists_in_radius('39.2833',
+            '-76.6167', '55'))
+        self.assertEqual(self.rebuilds, [True])
+        self.assertFalse(os.path.exists(self.path))
+        snapshot.rebuild()
+        self.assertEqual(sorted(snapshot.get_artists_in_radius('39.2833',
+            '-76.6167', '55')), sorted([self.baltimore.id, self.dc.id]))
+
+        # the query path reads candidates from the snapshot
+        with self.assertNumQueries(1):
+            artists = services.get_artists_in_radius('39.2833', '-76.6167',
+                '1')
+        self.assertEqual([a.id for a in artists], [self.baltimore.id])
+
+    def test_snapshot_updated_in_place(self):
+        snapshot = self.get_snapshot()
+        snapshot.rebuild()
+        services.update_location(self.dc.basic_profile, '39.2833',
+            '-76.6167')
+        services.update_location(self.nowhere.basic_profile, '39.2833',
+            '-76.6167')
+        self.assertEqual(sorted(snapshot.get_artists_in_radius('39.2833',
+            '-76.6167', '1')),
+            sorted([self.baltimore.id, self.dc.id, self.nowhere.id]))
+
+        # new artists are appended
+        newcomer = create_artist('new_band', None, None)
+        services.update_location(newcomer.basic_profile, '39.2833',
+            '-76.6167', artist_id=newcomer.id)
+        self.assertIn(newcomer.id, snapshot.get_artists_in_radius('39.2833',
+            '-76.6167', '1'))
+
+    @override_settings(GEO_SNAPSHOT_MAX_AGE_SECONDS=-1)
+    def test_stale_snapshot_falls_back(self):
+        snapshot = self.get_snapshot()
+        snapshot.rebuild()
+        self.assertIsNone(snapshot.get_artists_in_radius('39.2833',
+            '-76.6167', '1'))
+        self.assertEqual(self.rebuilds, [True])
+        artists = services.get_artists_in_radius('39.2833', '-76.6167', '1')
+        self.assertEqual([a.id for a in artists], [self.baltimore.id])
+
+class GeoQueryCacheTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        models.BasicProfile.create_groups()
+        cls.baltimore = create_artist('baltimore_band',
+            '39.2910', '-76.6107')
+        cls.dc = create_artist('dc_band', '38.9047', '-77.0164')
+
+    def setUp(self):
+        cache.get_geo_query_cache().clear()
+
+    def test_lru_cache(self):
+        lru = cache.LRUCache(2, ttl=None)
+        lru.set('a', 1)
+        lru.set('b', 2)
+        lru.get('a')
+        lru.set('c', 3)
+        self.assertEqual(lru.get('a'), 1)
+        self.assertIsNone(lru.get('b'))
+        lru = cache.LRUCache(2, ttl=-1)
+        lru.set('a', 1)
+        self.assertIsNone(lru.get('a'))
+
+    def test_nearby_queries_share_an_entry(self):
+        query_cache = cache.GeoQueryCache()
+        calls = []
+        def compute(lat, lon, radius):
+            calls.append((lat, lon, radius))
+            return [1]
+        query_cache.get_artist_ids('39.28331', '-76.61672', '1', compute)
+        query_cache.get_artist_ids('39.28339', '-76.61678', '0.95', compute)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(query_cache.stats()['hits'], 1)
+        self.assertEqual(query_cache.stats()['misses'], 1)
+
+        # moves in an overlapping cell invalidate the entry
+        query_cache.invalidate_cells(utils.get_geo_cell('34.05', '-118.24'))
+        query_cache.get_artist_ids('39.2833', '-76.6167', '1', compute)
+        self.assertEqual(len(calls), 1)
+        query_cache.invalidate_cells(utils.get_geo_cell('39.29', '-76.61'))
+        query_cache.get_artist_ids('39.2833', '-76.6167', '1', compute)
+        self.assertEqual(len(calls), 2)
+
+    def test_cached_results_are_exact(self):
+        distance = utils.get_distances('39.2833', '-76.6167', [39.2910],
+            [-76.6107])[0]
+        # the same cache entry, on either side of the artist
+        for radius, expected in [(distance - 0.001, []),
+                (distance + 0.001, [self.baltimore.id])]:
+            artists = services.get_cached_artists_in_radius('39.2833',
+                '-76.6167', radius)
+            self.assertEqual([a.id for a in artists], expected)
+        self.assertEqual(cache.get_geo_query_cache().stats()['hits'], 1)
+        # radii smaller than the radius step still match
+        artists = services.get_cached_artists_in_radius('39.2910',
+            '-76.6107', '0.01')
+        self.assertEqual([a.id for a in artists], [self.baltimore.id])
+
+    def test_concurrent_misses_compute_once(self):
+        query_cache = cache.GeoQueryCache()
+        calls = []
+        results = []
+        def compute(lat, lon, radius):
+            calls.append(1)
+            time.sleep(0.1)
+            return [1, 2]
+        def query():
+            results.append(query_cache.get_artist_ids('39.2833', '-76.6167',
+                '1', compute))
+        threads = [threading.Thread(target=query) for i in range(5)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [[1, 2]] * 5)
+        self.assertEqual(query_cache.stats()['coalesced'], 4)
+
+    def test_artist_move_invalidates_view_results(self):
+        client = login('dc_band')
+        url = '/api/artists-in-radius/?latitude=39.2833&longitude=-76.6167&radius=2'
+        response = client.get(url)
+        self.assertEqual([a['id'] for a in response.data], [self.baltimore.id])
+        response = client.get(url)
+        self.assertEqual([a['id'] for a in response.data], [self.baltimore.id])
+        self.assertEqual(cache.get_geo_query_cache().stats()['hits'], 1)
+
+        services.update_location(self.dc.basic_profile, '39.2833', '-76.6167')
+        response = client.get(url)
+        self.assertEqual(sorted([a['id'] for a in response.data]),
+            sorted([self.baltimore.id, self.dc.id]))
+
+class ShowQueryTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        models.BasicProfile.create_groups()
+        cls.artist = create_artist('touring_band', None, None)
+        now = timezone.now()
+        cls.tonight = cls.create_show(now + datetime.timedelta(hours=2),
+            '38.918229', '-77.023795')
+        cls.running = cls.create_show(now - datetime.timedelta(hours=1),
+            '39.290128', '-76.607246')
+        cls.next_month = cls.create_show(now + datetime.timedelta(days=30),
+            '39.290128', '-76.607246')
+        cls.far_away = cls.create_show(now + datetime.timedelta(days=1),
+            '34.0522', '-118.2437')
+
+    @classmethod
+    def create_show(cls, start, lat, lon):
+        show = models.Show(artist=cls.artist, start=start,
+            end=start + datetime.timedelta(hours=3), latitude=lat,
+            longitude=lon)
+        show.save()
+        return show
+
+    def test_get_shows_in_radius(self):
+        now = timezone.now()
+        shows = services.get_shows_in_radius('39.2833', '-76.6167', '100',
+            now, now + datetime.timedelta(days=7))
+        self.assertEqual([s.id for s in shows],
+            [self.running.id, self.tonight.id])
+
+        shows = services.get_shows_in_radius('39.2833', '-76.6167', '100',
+            now, now + datetime.timedelta(days=31))
+        self.assertEqual([s.id for s in shows],
+            [self.running.id, self.tonight.id, self.next_month.id])
+
+    def test_multi_day_show(self):
+        now = timezone.now()
+        festival = models.Show(artist=self.artist,
+            start=now - datetime.timedelta(days=5),
+            end=now + datetime.timedelta(days=1), latitude='39.290128',
+            longitude='-76.607246')
+        festival.save()
+        shows = services.get_shows_in_radius('39.2833', '-76.6167', '100',
+            now, now + datetime.timedelta(days=1))
+        self.assertEqual([s.id for s in shows],
+            [festival.id, self.running.id, self.tonight.id])
+
+        client = login('touring_band')
+        url = '/api/artist/%s/show/' % self.artist.id
+        for days, status in [(2, 201), (8, 400)]:
+            response = client.post(url, {'start': now.isoformat(),
+                'end': (now + datetime.timedelta(days=days)).isoformat(),
+                'latitude': '39.290128', 'longitude': '-76.607246'},
+                format='json')
+            self.assertEqual(response.status_code, status)
+
+    def test_show_update_moves_index(self):
+        now = timezone.now()
+        show = self.far_away
+        show.latitude = '39.2833'
+        show.longitude = '-76.6167'
+        show.save()
+        shows = services.get_shows_in_radius('39.2833', '-76.6167', '1',
+            now, now + datetime.timedelta(days=7))
+        self.assertEqual([s.id for s in shows], [show.id])
+        show.delete()
+        shows = services.get_shows_in_radius('39.2833', '-76.6167', '1',
+            now, now + datetime.timedelta(days=7))
+        self.assertEqual(shows, [])
+
+class UnreadMessagesTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        models.BasicProfile.create_groups()
+        cls.fan = models.BasicProfile.create_user('inbox_fan')
+        cls.followed = create_artist('followed_band', None, None)
+        cls.other = create_artist('other_band', None, None)
+        cls.followed.connected_users.add(cls.fan)
+        cls.read = models.Message.objects.create(artist=cls.followed,
+            text='read')
+        cls.read.dismissed_by.add(cls.fan)
+        cls.unread = models.Message.objects.create(artist=cls.followed,
+            text='unread')
+        models.Message.objects.create(artist=cls.other, text='not followed')
+
+    def test_get_unread_messages(self):
+        with self.assertNumQueries(1):
+            messages = list(services.get_unread_messages(self.fan.id))
+        self.assertEqual([m.id for m in messages], [self.unread.id])
+
+    def test_dismiss_message(self):
+        client = login('inbox_fan')
+        url = '/api/profile/%s/message/' % self.fan.id
+        response = client.get(url)
+        self.assertEqual([m['id'] for m in response.data['results']],
+            [self.unread.id])
+        response = client.delete('%s%s/' % (url, self.unread.id))
+        self.assertEqual(response.status_code, 204)
+        response = client.get(url)
+        self.assertEqual(response.data['results'], [])
+
+        client = login('other_band')
+        response = client.delete('%s%s/' % (url, self.unread.id))
+        self.assertEqual(response.status_code, 403)
+
+    def test_dismiss_many(self):
+        newer = [models.Message.objects.create(artist=self.followed,
+            text='newer %d' % i) for i in range(3)]
+        client = login('inbox_fan')
+        url = '/api/profile/%s/message/dismiss/' % self.fan.id
+        response = client.post(url, {'ids': [self.unread.id, self.read.id,
+            newer[0].id]}, format='json')
+        self.assertEqual(response.data, {'dismissed': 2})
+        response = client.post(url, {'up_to': newer[1].id}, format='json')
+        self.assertEqual(response.data, {'dismissed': 1})
+        self.assertEqual([m.id for m in
+            services.get_unread_messages(self.fan.id)], [newer[2].id])
+        response = client.post(url, {'ids': ['x']}, format='json')
+        self.assertEqual(response.status_code, 400)
+        response = client.post(url, {}, format='json')
+        self.assertEqual(response.status_code, 400)
+
+@override_settings(MESSAGE_FANOUT_ON_WRITE=True)
+class MessageInboxTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        models.BasicProfile.create_groups()
+        cls.fan = models.BasicProfile.create_user('inbox_fan')
+        cls.artist = create_artist('fanout_band', None, None)
+        cls.old = models.Message.objects.create(artist=cls.artist,
+            text='before following')
+
+    def test_fanout(self):
+        self.assertTrue(services.follow_artist(self.artist.id, self.fan.id))
+        self.assertFalse(services.follow_artist(self.artist.id, self.fan.id))
+        message = services.create_message(self.artist, 'new show')
+        self.assertEqual(models.InboxEntry.objects.filter(
+            profile=self.fan).count(), 2)
+        with self.assertNumQueries(1):
+            messages = list(services.get_unread_messages(self.fan.id))
+        self.assertEqual(sorted([m.id for m in messages]),
+            sorted([self.old.id, message.id]))
+
+        services.mark_message_as_read(self.fan.id, message)
+        self.assertEqual([m.id for m in
+            services.get_unread_messages(self.fan.id)], [self.old.id])
+
+        self.assertTrue(services.unfollow_artist(self.artist.id, self.fan.id))
+        self.assertFalse(services.unfollow_artist(self.artist.id,
+            self.fan.id))
+        self.assertEqual(models.InboxEntry.objects.filter(
+            profile=self.fan).count(), 0)
+
+        # dismissed messages stay dismissed when following again
+        services.follow_artist(self.artist.id, self.fan.id)
+        self.assertEqual([m.id for m in
+            services.get_unread_messages(self.fan.id)], [self.old.id])
+
+class UnreadCountTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        models.BasicProfile.create_groups()
+        cls.fan = models.BasicProfile.create_user('counting_fan')
+        cls.artist = create_artist('counted_band', None, None)
+        models.Message.objects.create(artist=cls.artist, text='old')
+
+    def assertUnreadCount(self, count):
+        self.assertEqual(services.get_unread_count(self.fan.id), count)
+        self.assertEqual(services.get_unread_messages(self.fan.id).count(),
+            count)
+
+    def test_counter(self):
+        self.assertUnreadCount(0)
+        services.follow_artist(self.artist.id, self.fan.id)
+        self.assertUnreadCount(1)
+        first = services.create_message(self.artist, 'first')
+        second = services.create_message(self.artist, 'second')
+        self.assertUnreadCount(3)
+        services.mark_message_as_read(self.fan.id, first)
+        services.mark_message_as_read(self.fan.id, first)
+        self.assertUnreadCount(2)
+        band = identity.Identity.for_user(self.artist.basic_profile.user)
+        services.delete_message(band, first)
+        services.delete_message(band, second)
+        self.assertUnreadCount(1)
+        third = services.create_message(self.artist, 'third')
+        self.assertUnreadCount(2)
+        services.dismiss_messages(self.fan.id, message_ids=[third.id])
+        self.assertUnreadCount(1)
+        services.unfollow_artist(self.artist.id, self.fan.id)
+        self.assertUnreadCount(0)
+
+    def test_unread_count_view(self):
+        services.follow_artist(self.artist.id, self.fan.id)
+        client = login('counting_fan')
+        response = client.get('/api/profile/%s/message/unread_count/' %
+            self.fan.id)
+        self.assertEqual(response.data, {'unread_count': 1})
+
+class KeysetPaginationTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        models.BasicProfile.create_groups()
+        cls.artist = create_artist('prolific_band', None, None)
+        cls.messages = [models.Message.objects.create(artist=cls.artist,
+            text='message %d' % i) for i in range(5)]
+        # two messages with the same timestamp (split across pages), ordered
+        # by id
+        models.Message.objects.filter(id__in=[cls.messages[1].id,
+            cls.messages[2].id]).update(created_at=cls.messages[1].created_at)
+
+    def test_message_pages(self):
+        client = login('prolific_band')
+        url = '/api/artist/%s/message/?limit=3' % self.artist.id
+        ids = []
+        while url:
+            response = client.get(url)
+            self.assertLessEqual(len(response.data['results']), 3)
+            ids.extend(m['id'] for m in response.data['results'])
+            url = response.data['next']
+        self.assertEqual(ids, [m.id for m in reversed(self.messages)])
+
+        response = client.get('/api/artist/%s/message/?cursor=bogus' %
+            self.artist.id)
+        self.assertEqual(response.status_code, 400)
+
+    def test_edit_keeps_message_position(self):
+        message = models.Message.objects.get(id=self.messages[0].id)
+        created_at = message.created_at
+        message.text = 'edited'
+        message.save()
+        self.assertEqual(models.Message.objects.get(id=message.id).created_at,
+            created_at)
+
+class SyncTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        models.BasicProfile.create_groups()
+        cls.fan = models.BasicProfile.create_user('syncing_fan')
+        cls.artist = create_artist('synced_band', None, None)
+        cls.other = create_artist('unsynced_band', None, None)
+        services.follow_artist(cls.artist.id, cls.fan.id)
+        cls.message = services.create_message(cls.artist, 'hello')
+
+    def sync(self, client, token=None):
+        url = '/api/profile/%s/sync/' % self.fan.id
+        if token:
+            url += '?token=%s' % token
+        response = client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def test_sync(self):
+        client = login('syncing_fan')
+        data = self.sync(client)
+        self.assertTrue(data['full'])
+        self.assertEqual([a['id'] for a in data['follows']], [self.artist.id])
+        self.assertEqual([m['id'] for m in data['messages']],
+            [self.message.id])
+
+        data = self.sync(client, data['token'])
+        self.assertFalse(data['full'])
+        self.assertEqual((data['follows'], data['messages']), ([], []))
+
+        token = data['token']
+        later = services.create_message(self.artist, 'later')
+        services.create_message(self.other, 'not followed')
+        services.mark_message_as_read(self.fan.id, self.message)
+        services.delete_message(identity.Identity.for_user(
+            self.artist.basic_profile.user), later)
+        other_message = services.create_message(self.other, 'backfilled')
+        services.follow_artist(self.other.id, self.fan.id)
+        services.unfollow_artist(self.artist.id, self.fan.id)
+        data = self.sync(client, token)
+        self.assertFalse(data['full'])
+        self.assertEqual([a['id'] for a in data['follows']], [self.other.id])
+        self.assertEqual(data['unfollows'], [self.artist.id])
+        self.assertEqual(data['dismissed_messages'], [self.message.id])
+        self.assertEqual(sorted([m['id'] for m in data['messages']]),
+            sorted([m.id for m in models.Message.objects.filter(
+            artist=self.other)]))
+        self.assertIn(other_message.id, [m['id'] for m in data['messages']])
+
+        response = client.get('/api/profile/%s/sync/?token=bogus' %
+            self.fan.id)
+        self.assertEqual(response.status_code, 400)
+
+@override_settings(MESSAGE_BROKER='local', MESSAGE_STREAM_HEARTBEAT_SECONDS=0.1)
+class MessageStreamTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        models.BasicProfile.create_groups()
+        cls.fan = models.BasicProfile.create_user('streaming_fan')
+        cls.artist = create_artist('streamed_band', None, None)
+        cls.other = create_artist('quiet_band', None, None)
+        services.follow_artist(cls.artist.id, cls.fan.id)
+        cls.missed = services.create_message(cls.artist, 'missed')
+
+    def test_local_broker(self):
+        local = broker.LocalBroker()
+        with local.subscribe([self.artist.id]) as subscription:
+            local.publish(1, self.other.id)
+            local.publish(2, self.artist.id)
+            self.assertEqual(subscription.get(timeout=0), 2)
+            self.assertIsNone(subscription.get(timeout=0))
+            self.assertEqual(local.subscriber_count(), 1)
+        self.assertEqual(local.subscriber_count(), 0)
+
+    def test_change_log_broker(self):
+        change_log = broker.ChangeLogBroker()
+        # don't start the background poller
+        change_log._poller = True
+        subscription = change_log.subscribe([self.artist.id])
+        # logged before the first poll, but after subscribing
+        message = services.create_message(self.artist, 'logged')
+        services.create_message(self.other, 'not followed')
+        self.assertEqual(change_log.poll(), 2)
+        self.assertEqual(subscription.get(timeout=0), message.id)
+        self.assertIsNone(subscription.get(timeout=0))
+        subscription.close()
+
+        # messages logged while nobody was subscribed aren't delivered
+        services.create_message(self.artist, 'unheard')
+        with change_log.subscribe([self.artist.id]) as subscription:
+            self.assertEqual(change_log.poll(), 0)
+            self.assertIsNone(subscription.get(timeout=0))
+
+    def test_stream(self):
+        client = login('streaming_fan')
+        response = client.get('/api/profile/%s/message/stream/' % self.fan.id,
+            HTTP_ACCEPT='text/event-stream', HTTP_LAST_EVENT_ID='0')
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        events = iter(response.streaming_content)
+        self.assertTrue(next(events).startswith(b'retry:'))
+        self.assertTrue(next(events).startswith(
+            ('id: %d\n' % self.missed.id).encode('utf-8')))
+        self.assertEqual(next(events), b': keepalive\n\n')
+        message = services.create_message(self.artist, 'live')
+        event = next(events)
+        self.assertTrue(event.startswith(
+            ('id: %d\nevent: message\n' % message.id).encode('utf-8')))
+        self.assertIn(b'"live"', event)
+        response.close()
+        self.assertEqual(broker.get_broker().subscriber_count(), 0)
+
+class RetentionTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        models.BasicProfile.create_groups()
+        cls.fan = models.BasicProfile.create_user('tidy_fan')
+        cls.artist = create_artist('chatty_band', None, None)
+        cls.other = create_artist('later_band', None, None)
+        services.follow_artist(cls.artist.id, cls.fan.id)
+        cls.old_other = services.create_message(cls.other, 'old news')
+        cls.messages = [services.create_message(cls.artist, 'message %d' % i)
+            for i in range(4)]
+
+    def unread_ids(self):
+        return sorted(services.get_unread_messages(self.fan.id).values_list(
+            'id', flat=True))
+
+    def test_compact_dismissals(self):
+        services.dismiss_messages(self.fan.id, message_ids=[
+            self.messages[0].id, self.messages[1].id, self.messages[3].id])
+        self.assertEqual(services.get_unread_count(self.fan.id), 1)
+        self.assertEqual(services.compact_dismissals(self.fan.id), 2)
+        self.assertEqual(services.get_read_up_to(self.fan.id),
+            self.messages[2].id - 1)
+        self.assertEqual(self.unread_ids(), [self.messages[2].id])
+        self.assertEqual(services.compact_dismissals(self.fan.id), 0)
+
+        # following an artist with messages under the mark lowers it
+        services.follow_artist(self.other.id, self.fan.id)
+        self.assertEqual(self.unread_ids(), [self.old_other.id,
+            self.messages[2].id])
+        self.assertEqual(services.get_unread_count(self.fan.id), 2)
+
+    def test_refollow_after_compaction(self):
+        services.mark_message_as_read(self.fan.id, self.messages[0])
+        services.compact_dismissals(self.fan.id)
+        services.unfollow_artist(self.artist.id, self.fan.id)
+        services.follow_artist(self.artist.id, self.fan.id)
+        # read before unfollowing, so still read
+        self.assertEqual(self.unread_ids(), [m.id for m in self.messages[1:]])
+        self.assertEqual(services.get_unread_count(self.fan.id), 3)
+        self.assertFalse(models.ArtistReadMark.objects.exists())
+
+        # still read when the mark was lowered in between
+        services.unfollow_artist(self.artist.id, self.fan.id)
+        services.follow_artist(self.other.id, self.fan.id)
+        self.assertEqual(services.get_read_up_to(self.fan.id),
+            self.old_other.id - 1)
+        services.follow_artist(self.artist.id, self.fan.id)
+        self.assertEqual(self.unread_ids(), [self.old_other.id] +
+            [m.id for m in self.messages[1:]])
+        self.assertEqual(services.get_unread_count(self.fan.id), 4)
+
+    def test_uncover_artists_limit(self):
+        services.dismiss_messages(self.fan.id, message_ids=[
+            self.messages[0].id, self.messages[1].id, self.messages[2].id])
+        services.compact_dismissals(self.fan.id)
+        Dismissed = models.Message.dismissed_by.through
+        services._uncover_artists(self.fan.id, [self.other.id], limit=2)
+        # only two rows recreated, so the mark stays above the oldest one
+        self.assertEqual(Dismissed.objects.filter(
+            basicprofile_id=self.fan.id).count(), 2)
+        self.assertEqual(services.get_read_up_to(self.fan.id),
+            self.messages[0].id)
+        self.assertEqual(self.unread_ids(), [self.messages[3].id])
+
+    def test_concurrent_dismissals(self):
+        Dismissed = models.Message.dismissed_by.through
+        get_unread_messages = services.get_unread_messages
+        def get_then_dismiss(profile_id):
+            unread = models.Message.objects.filter(id__in=list(
+                get_unread_messages(profile_id).values_list('id', flat=True)))
+            # another request dismisses a message in the meantime
+            Dismissed.objects.create(message_id=self.messages[0].id,
+                basicprofile_id=profile_id)
+            services._adjust_unread_counts(profile_id, -1)
+            return unread
+        self.assertEqual(services.get_unread_count(self.fan.id), 4)
+        services.get_unread_messages = get_then_dismiss
+        try:
+            self.assertEqual(services.dismiss_messages(self.fan.id,
+                message_ids=[self.messages[0].id, self.messages[1].id]), 1)
+        finally:
+            services.get_unread_messages = get_unread_messages
+        self.assertEqual(services.get_unread_count(self.fan.id), 2)
+        self.assertEqual(self.unread_ids(), [self.messages[2].id,
+            self.messages[3].id])
+
+        # already dismissed
+        services.mark_message_as_read(self.fan.id, self.messages[1])
+        self.assertEqual(services.get_unread_count(self.fan.id), 2)
+
+    def test_archive_messages(self):
+        services.follow_artist(self.other.id, self.fan.id)
+        services.mark_message_as_read(self.fan.id, self.messages[0])
+        self.assertEqual(services.get_unread_count(self.fan.id), 4)
+        before = timezone.now() + datetime.timedelta(seconds=1)
+        self.assertEqual(services.archive_messages(before, limit=3), 3)
+        self.assertEqual(models.ArchivedMessage.objects.count(), 3)
+        self.assertEqual(self.unread_ids(), [self.messages[2].id,
+            self.messages[3].id])
+        self.assertEqual(services.get_unread_count(self.fan.id), 2)
+        Log = models.ChangeLogEntry
+        self.assertEqual(sorted(Log.objects.filter(kind=Log.MESSAGE,
+            action=Log.DELETED).values_list('object_id', 'artist_id')),
+            [(self.old_other.id, self.other.id),
+            (self.messages[0].id, self.artist.id),
+            (self.messages[1].id, self.artist.id)])
+
+class BulkFollowTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        models.BasicProfile.create_groups()
+        cls.fan = models.BasicProfile.create_user('eager_fan')
+        cls.artists = [create_artist('bulk_band_%d' % i, None,
+            None) for i in range(3)]
+        for artist in cls.artists:
+            services.create_message(artist, 'hi from %s' % artist.name)
+
+    def test_bulk_follow(self):
+        client = login('eager_fan')
+        url = '/api/profile/%s/connected/bulk/' % self.fan.id
+        ids = [a.id for a in self.artists]
+        response = client.post(url, {'follow': ids[:2] + [0]}, format='json')
+        self.assertEqual(sorted(response.data['followed']), ids[:2])
+        self.assertEqual(services.get_unread_count(self.fan.id), 2)
+
+        response = client.post(url, {'follow': ids, 'unfollow': ids[:1]},
+            format='json')
+        self.assertEqual(response.data, {'followed': ids[2:],
+            'unfollowed': ids[:1]})
+        self.assertEqual(sorted(models.ArtistProfile.objects.filter(
+            connected_users=self.fan).values_list('id', flat=True)), ids[1:])
+        self.assertEqual(services.get_unread_count(self.fan.id), 2)
+        self.assertEqual(services.get_unread_messages(self.fan.id).count(), 2)
+
+        response = client.post(url, {'follow': 'all'}, format='json')
+        self.assertEqual(response.status_code, 400)
+
+    def test_import_follows(self):
+        self.artists[0].facebook_page_id = 'page_0'
+        self.artists[0].save()
+        services.follow_artist(self.artists[1].id, self.fan.id)
+        client = login('eager_fan')
+        url = '/api/profile/%s/connected/import/' % self.fan.id
+        ids = [a.id for a in self.artists]
+        response = client.post(url, {'facebook_page_ids': ['page_0', 'nope'],
+            'artist_ids': [ids[1], 0]}, format='json')
+        self.assertEqual(response.data, {'matched': ids[:2],
+            'followed': ids[:1], 'unmatched_ids': [0],
+            'unmatched_facebook_page_ids': ['nope']})
+        self.assertEqual(services.get_unread_count(self.fan.id), 2)
+
+        response = client.post(url, {'artist_ids': ['x']}, format='json')
+        self.assertEqual(response.status_code, 400)
+
+    def test_unfollow_deletes_one_row(self):
+        other = models.BasicProfile.create_user('other_fan')
+        services.follow_artist(self.artists[0].id, self.fan.id)
+        services.follow_artist(self.artists[0].id, other.id)
+        Follow = models.ArtistProfile.connected_users.through
+        kept = Follow.objects.get(basicprofile=other)
+        client = login('eager_fan')
+        response = client.delete('/api/profile/%s/connected/%s/' % (
+            self.fan.id, self.artists[0].id))
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(list(Follow.objects.filter(
+            artistprofile=self.artists[0])), [kept])
 
+class FollowCountTest(TestCase):
 
+    @classmethod
+    def setUpTestData(cls):
+        models.BasicProfile.create_groups()
+        cls.fan = models.BasicProfile.create_user('counted_fan')
+        cls.artists = [create_artist('popular_band_%d' % i, None,
+            None) for i in range(2)]
+
+    def assertCounts(self, follower_counts, following_count):
+        self.assertEqual([a.follower_count for a in
+            models.ArtistProfile.objects.filter(id__in=[a.id for a in
+            self.artists]).order_by('id')], follower_counts)
+        self.assertEqual(models.BasicProfile.objects.get(
+            id=self.fan.id).following_count, following_count)
+
+    def test_follow_counts(self):
+        services.follow_artist(self.artists[0].id, self.fan.id)
+        services.follow_artists(self.fan.id, [a.id for a in self.artists])
+        self.assertCounts([1, 1], 2)
+        # saving a stale instance doesn't overwrite the counters
+        artist = self.artists[0]
+        artist.name = 'renamed'
+        artist.save()
+        self.fan.save()
+        self.assertCounts([1, 1], 2)
+        services.unfollow_artist(self.artists[0].id, self.fan.id)
+        self.assertCounts([0, 1], 1)
+
+        models.ArtistProfile.objects.update(follower_count=7)
+        repair_follow_counts.run()
+        self.assertCounts([0, 1], 1)
+
+class FollowerExportTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        models.BasicProfile.create_groups()
+        cls.artist = create_artist('exported_band', None, None)
+        cls.fans = [models.BasicProfile.create_user('exported_fan_%d' % i,
+            email='fan%d@example.com' % i) for i in range(5)]
+        services.follow_artists(cls.fans[0].id, [cls.artist.id])
+        for fan in cls.fans:
+            services.follow_artist(cls.artist.id, fan.id)
+
+    def test_iter_followers(self):
+        rows = list(services.iter_followers(self.artist.id, chunk_size=2))
+        self.assertEqual([r[0] for r in rows], [f.id for f in self.fans])
+
+    def test_export(self):
+        client = login('exported_band')
+        url = '/api/artist/%s/connected/export/' % self.artist.id
+        response = client.get(url)
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(len(lines), 5)
+        self.assertEqual(json.loads(lines[0]), {'id': self.fans[0].id,
+            'username': 'exported_fan_0', 'email': 'fan0@example.com'})
+
+        response = client.get(url + '?format=csv')
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(lines[0], 'id,username,email')
+        self.assertEqual(lines[1], '%d,exported_fan_0,fan0@example.com' %
+            self.fans[0].id)
+
+    def test_export_access(self):
+        # profiles created before the artist, so profile and artist ids differ
+        fans = [models.BasicProfile.create_user('early_fan_%d' % i)
+            for i in range(3)]
+        artist = create_artist('late_band', None, None)
+        self.assertNotEqual(artist.id, artist.basic_profile.id)
+        services.follow_artist(artist.id, fans[0].id)
+        url = '/api/artist/%s/connected/export/' % artist.id
+        # the fan whose profile id is the artist's id
+        fan = models.BasicProfile.objects.get(id=artist.id)
+        client = login(fan.user.username)
+        self.assertEqual(client.get(url).status_code, 403)
+        client = login('late_band')
+        response = client.get(url)
+        self.assertEqual(response.status_code, 200)
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(len(lines), 1)
+
+class IdentityTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        models.BasicProfile.create_groups()
+        cls.artist = create_artist('known_band', None, None)
+        cls.fan = models.BasicProfile.create_user('known_fan')
+
+    def test_identity(self):
+        current = identity.Identity.for_user(self.artist.basic_profile.user)
+        self.assertEqual(current.artist_id, self.artist.id)
+        self.assertEqual(current.highest_role(), 'ARTIST')
+        self.assertTrue(current.can_access(self.artist.basic_profile.id))
+        self.assertFalse(current.can_access(self.fan.id))
+        self.assertTrue(current.can_manage_artist(self.artist.id))
+        fan = identity.Identity.for_user(self.fan.user)
+        self.assertIsNone(fan.artist_id)
+        self.assertFalse(fan.can_manage_artist(self.artist.id))
+
+    def test_query_counts(self):
+        services.get_unread_count(self.fan.id)
+        client = login('known_fan')
+        # user (the session is cached) and profile (with artist), then the
+        # view
+        with self.assertNumQueries(3):
+            response = client.get('/api/profile/%s/message/unread_count/' %
+                self.fan.id)
+        self.assertEqual(response.status_code, 200)
+        # the user is cached for the session
+        with self.assertNumQueries(1):
+            response = client.get('/api/profile/%s/message/unread_count/' %
+                self.artist.basic_profile.id)
+        self.assertEqual(response.status_code, 403)
+
+        client = login('known_band')
+        with self.assertNumQueries(4):
+            response = client.get('/api/artist/%s/connected/export/' %
+                self.artist.id)
+            b''.join(response.streaming_content)
+
+    def test_roles(self):
+        self.assertEqual(self.fan.roles, models.BasicProfile.FAN)
+        admin = models.BasicProfile.create_user('known_admin',
+            groups=['ADMIN'])
+        self.assertEqual(admin.highest_role(), 'ADMIN')
+        profile = self.artist.basic_profile
+        self.assertEqual(profile.role_names(), ['ARTIST'])
+        profile = models.BasicProfile.objects.get(id=self.fan.id)
+        profile.add_role('ARTIST')
+        profile = models.BasicProfile.objects.get(id=self.fan.id)
+        with self.assertNumQueries(0):
+            self.assertEqual(profile.highest_role(), 'ARTIST')
+            self.assertTrue(profile.has_role('FAN'))
+        self.assertEqual(sorted(profile.user.groups.values_list('name',
+            flat=True)), ['ARTIST', 'FAN'])
+        self.assertEqual(sorted(p.id for p in services.get_profiles_by_role(
+            'ARTIST')), [self.artist.basic_profile.id, self.fan.id])
+        self.assertEqual(list(services.get_profiles_by_role('ADMIN')),
+            [admin])
+        self.assertEqual(list(services.get_profiles_by_role('NOBODY')), [])
+
+        # groups changed behind the profile's back (without m2m signals)
+        django.contrib.auth.models.User.groups.through.objects.filter(
+            user_id=profile.user_id).delete()
+        self.assertEqual(repair_profile_roles.repair(), 1)
+        self.assertEqual(models.BasicProfile.objects.get(
+            id=self.fan.id).roles, 0)
+
+    def test_group_changes_sync_roles(self):
+        def roles():
+            return models.BasicProfile.objects.get(id=self.fan.id).roles
+        stale = models.BasicProfile.objects.get(id=self.fan.id)
+        user = self.fan.user
+        artist_group = django.contrib.auth.models.Group.objects.get(
+            name='ARTIST')
+        user.groups.add(artist_group)
+        self.assertEqual(roles(), models.BasicProfile.FAN |
+            models.BasicProfile.ARTIST)
+        # saving an old instance doesn't undo it
+        stale.save()
+        self.assertEqual(roles(), models.BasicProfile.FAN |
+            models.BasicProfile.ARTIST)
+        user.groups.remove(artist_group)
+        self.assertEqual(roles(), models.BasicProfile.FAN)
+        artist_group.user_set.add(user)
+        self.assertEqual(roles(), models.BasicProfile.FAN |
+            models.BasicProfile.ARTIST)
+        artist_group.user_set.clear()
+        self.assertEqual(roles(), models.BasicProfile.FAN)
+        self.assertEqual(models.BasicProfile.objects.get(
+            id=self.artist.basic_profile.id).roles, 0)
+
+
+class SessionUserCacheTest(TestCase):
 
+    @classmethod
+    def setUpTestData(cls):
+        models.BasicProfile.create_groups()
+        cls.fan = models.BasicProfile.create_user('cached_fan')
+
+    def setUp(self):
+        self.users = cache.get_session_user_cache()
+        self.client = login('cached_fan')
+        self.url = '/api/profile/%s/message/unread_count/' % self.fan.id
+        self.session_key = self.client.session.session_key
+
+    def test_cached_user(self):
+        self.client.get(self.url)
+        user = self.users.get(self.session_key)
+        self.assertEqual(user.username, 'cached_fan')
+        user.username = 'changed'
+        self.assertEqual(self.users.get(self.session_key).username,
+            'cached_fan')
+
+        # a user change forgets their sessions, in every process
+        other_process = cache.SessionUserCache()
+        self.assertEqual(other_process.get(self.session_key).username,
+            'cached_fan')
+        self.fan.user.save()
+        self.assertIsNone(self.users.get(self.session_key))
+        self.assertIsNone(other_process.get(self.session_key))
+        self.assertEqual(self.client.get(self.url).status_code, 200)
+        self.assertIsNotNone(self.users.get(self.session_key))
+
+    def test_login_on_same_session(self):
+        other = models.BasicProfile.create_user('other_cached_fan')
+        self.client.get(self.url)
+        # the session no longer has a user, but is still cached
+        session = self.client.session
+        del session['username']
+        session.save()
+        self.client.post('/api/login/', {'anonymous_id': 'other_cached_fan'},
+            format='json')
+        self.assertNotEqual(self.client.session.session_key, self.session_key)
+        self.assertIsNone(self.users.get(self.session_key))
+        response = self.client.get('/api/profile/%s/' % other.id)
+        self.assertEqual(response.status_code, 200)
+        response = self.client.get('/api/profile/%s/' % self.fan.id)
+        self.assertEqual(response.status_code, 403)
+
+    def test_logout(self):
+        self.client.get(self.url)
+        self.client.post('/api/logout/')
+        self.assertIsNone(self.users.get(self.session_key))
+        self.assertIsNone(cache.SessionUserCache().get(self.session_key))
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 403)
+
+
+class TokenAuthenticationTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        models.BasicProfile.create_groups()
+        cls.artist = create_artist('token_band', None, None)
+        cls.fan = models.BasicProfile.create_user('token_fan')
+
+    def login(self, username):
+        response = APIClient().post('/api/login/',
+            {'anonymous_id': username}, format='json')
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION='Bearer %s' %
+            response.data['token'])
+        return client, response.data['token']
+
+    def test_claims(self):
+        token, claims = tokens.issue(self.artist.basic_profile,
+            self.artist.id)
+        self.assertEqual(tokens.verify(token), claims)
+        self.assertEqual(claims['aid'], self.artist.id)
+        self.assertEqual(claims['roles'], models.BasicProfile.ARTIST)
+        with self.assertRaises(errors.InvalidInput):
+            tokens.verify(token[:-2])
+        # an unhashable key id
+        header = tokens._b64encode(json.dumps({'alg': tokens.ALGORITHM,
+            'kid': ['1']}).encode('utf-8'))
+        with self.assertRaises(errors.InvalidInput):
+            tokens.verify(header + token[token.index('.'):])
+        self.assertNotEqual(settings.AUTH_TOKEN_KEYS['1'], settings.SECRET_KEY)
+        with override_settings(AUTH_TOKEN_LIFETIME_SECONDS=-1):
+            expired, _ = tokens.issue(self.fan)
+        with self.assertRaises(errors.InvalidInput):
+            tokens.verify(expired)
+
+    def test_key_rotation(self):
+        token, _ = tokens.issue(self.fan)
+        keys = {'1': settings.AUTH_TOKEN_KEYS['1'], '2': 'a new key'}
+        with override_settings(AUTH_TOKEN_KEYS=keys, AUTH_TOKEN_KEY_ID='2'):
+            self.assertEqual(tokens.verify(token)['pid'], self.fan.id)
+            rotated, _ = tokens.issue(self.fan)
+        with override_settings(AUTH_TOKEN_KEYS={'2': 'a new key'},
+                AUTH_TOKEN_KEY_ID='2'):
+            self.assertEqual(tokens.verify(rotated)['pid'], self.fan.id)
+            with self.assertRaises(errors.InvalidInput):
+                tokens.verify(token)
+
+    def test_denylist_cache_check(self):
+        local = {'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+        shared = {'default': local['default'], 'tokens': {
+            'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+            'LOCATION': '/tmp/fanmobi-tokens'}}
+        with override_settings(CACHES=local, DEBUG=False):
+            self.assertEqual([e.id for e in tokens.check_denylist_cache(None)],
+                ['main.E002'])
+            with override_settings(DEBUG=True):
+                self.assertEqual([e.id for e in
+                    tokens.check_denylist_cache(None)], ['main.W001'])
+            with override_settings(AUTH_TOKEN_CACHE='tokens'):
+                self.assertEqual([e.id for e in
+                    tokens.check_denylist_cache(None)], ['main.E001'])
+        with override_settings(CACHES=shared, AUTH_TOKEN_CACHE='tokens',
+                DEBUG=False):
+            self.assertEqual(tokens.check_denylist_cache(None), [])
+
+    def test_requests(self):
+        services.get_unread_count(self.fan.id)
+        client, token = self.login('token_fan')
+        url = '/api/profile/%s/message/unread_count/'
+        # no session or user queries, only the view's
+        with self.assertNumQueries(1):
+            response = client.get(url % self.fan.id)
+        self.assertEqual(response.status_code, 200)
+        with self.assertNumQueries(0):
+            response = client.get(url % self.artist.basic_profile.id)
+        self.assertEqual(response.status_code, 403)
+
+        band, _ = self.login('token_band')
+        response = band.post('/api/artist/%s/message/' % self.artist.id,
+            {'text': 'hello'}, format='json')
+        self.assertEqual(response.status_code, 201)
+
+        response = client.post('/api/logout/')
+        self.assertEqual(response.data['username'], 'token_fan')
+        with self.assertRaises(errors.InvalidInput):
+            tokens.verify(token)
+        self.assertEqual(client.get(url % self.fan.id).status_code, 403)
+
+
+class CreateUserTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        models.BasicProfile.create_groups()
 
+    def test_anonymous_login(self):
+        response = APIClient().post('/api/login/',
+            {'anonymous_id': 'first_launch'}, format='json')
+        self.assertEqual(response.status_code, 200)
+        profile = services.get_profile('first_launch')
+        self.assertEqual(response.data['profile_id'], profile.id)
+        self.assertFalse(profile.user.has_usable_password())
+        self.assertEqual(list(profile.user.groups.values_list('name',
+            flat=True)), ['FAN'])
+        self.assertEqual(profile.roles, models.BasicProfile.FAN)
 
+    def test_cached_group_ids(self):
+        models.BasicProfile.create_user('warm_up', groups=['FAN', 'ARTIST'])
+        with CaptureQueriesContext(connection) as queries:
+            profile = models.BasicProfile.create_user('with_password',
+                password='secret', groups=['FAN', 'ARTIST'])
+        self.assertFalse([q for q in queries.captured_queries
+            if 'FROM "auth_group"' in q['sql']])
+        self.assertTrue(profile.user.check_password('secret'))
+        self.assertEqual(sorted(profile.user.groups.values_list('name',
+            flat=True)), ['ARTIST', 'FAN'])
+        with self.assertRaises(django.contrib.auth.models.Group.DoesNotExist):
+            models.BasicProfile.create_user('nobody', groups=['NOBODY'])
+        self.assertIsNone(services.get_profile('nobody'))
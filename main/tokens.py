@@ -0,0 +1,176 @@
+"""
+Signed authentication tokens
+
+The login endpoint issues a token carrying the user's id, username, profile
+id, artist id and roles, signed with HMAC-SHA256 (in the JWT compact format,
+with the id of the signing key in the header). Requests presenting it in an
+`Authorization: Bearer <token>` header are authenticated from the claims
+alone (see auth.TokenAuthentication), without reading the session or the
+user
+
+Keys are rotated by adding a new key to settings.AUTH_TOKEN_KEYS, making it
+settings.AUTH_TOKEN_KEY_ID, and removing the old key once the tokens it
+signed have expired (settings.AUTH_TOKEN_LIFETIME_SECONDS later). Logging
+out denies the token's id in the settings.AUTH_TOKEN_CACHE cache until the
+token expires, so that cache must be shared by every process accepting tokens
+(see check_denylist_cache)
+
+Claims are fixed when the token is issued: a user whose roles change (e.g.
+who becomes an artist) needs to log in again to get them in a token
+"""
+import base64
+import binascii
+import hashlib
+import hmac
+import json
+import time
+import uuid
+
+from django.conf import settings
+from django.core import checks
+from django.core.cache import caches
+
+import main.errors as errors
+
+ALGORITHM = 'HS256'
+# prefix of the cache keys of logged out token ids
+DENYLIST_PREFIX = 'fanmobi-token-denied:'
+# cache backends that aren't shared between processes
+PROCESS_LOCAL_CACHE_BACKENDS = (
+    'django.core.cache.backends.locmem.LocMemCache',
+    'django.core.cache.backends.dummy.DummyCache')
+
+class TokenUser(object):
+    """
+    The user a token was issued to (only the fields the token carries)
+
+    Can't be saved: use services.get_profile(username).user for the model
+    """
+    is_active = True
+
+    def __init__(self, claims):
+        self.pk = self.id = claims['sub']
+        self.username = claims['username']
+        self.claims = claims
+
+    def is_authenticated(self):
+        return True
+
+    def is_anonymous(self):
+        return False
+
+    def __str__(self):
+        return self.username
+
+
+def _b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+def _b64decode(data):
+    data = data.encode('ascii')
+    return base64.urlsafe_b64decode(data + b'=' * (-len(data) % 4))
+
+def _sign(key, signing_input):
+    return hmac.new(key.encode('utf-8'), signing_input,
+        hashlib.sha256).digest()
+
+def issue(profile, artist_id=None):
+    """
+    Issue a token for a profile
+
+    Args:
+        profile: models.BasicProfile
+        artist_id: id of the profile's models.ArtistProfile, if any
+
+    Returns:
+        (token, claims)
+    """
+    now = int(time.time())
+    claims = {
+        'sub': profile.user_id,
+        'username': profile.user.username,
+        'pid': profile.id,
+        'aid': artist_id,
+        'roles': profile.roles,
+        'iat': now,
+        'exp': now + settings.AUTH_TOKEN_LIFETIME_SECONDS,
+        'jti': uuid.uuid4().hex
+    }
+    kid = settings.AUTH_TOKEN_KEY_ID
+    header = {'alg': ALGORITHM, 'typ': 'JWT', 'kid': kid}
+    signing_input = ('%s.%s' % (
+        _b64encode(json.dumps(header, separators=(',', ':')).encode('utf-8')),
+        _b64encode(json.dumps(claims, separators=(',', ':')).encode('utf-8'))
+        )).encode('ascii')
+    signature = _sign(settings.AUTH_TOKEN_KEYS[kid], signing_input)
+    return '%s.%s' % (signing_input.decode('ascii'),
+        _b64encode(signature)), claims
+
+def verify(token):
+    """
+    Check a token's signature, expiry and denylist
+
+    Returns:
+        the token's claims
+
+    Raises:
+        errors.InvalidInput if the token isn't valid (any more)
+    """
+    try:
+        header, payload, signature = token.split('.')
+        signing_input = ('%s.%s' % (header, payload)).encode('ascii')
+        header = json.loads(_b64decode(header).decode('utf-8'))
+        signature = _b64decode(signature)
+    except (ValueError, UnicodeError, binascii.Error):
+        raise errors.InvalidInput('Malformed token')
+    if not isinstance(header, dict) or header.get('alg') != ALGORITHM:
+        raise errors.InvalidInput('Unsupported token')
+    kid = header.get('kid')
+    if not isinstance(kid, str):
+        raise errors.InvalidInput('Unknown token key')
+    key = settings.AUTH_TOKEN_KEYS.get(kid, None)
+    if key is None:
+        raise errors.InvalidInput('Unknown token key')
+    if not hmac.compare_digest(_sign(key, signing_input), signature):
+        raise errors.InvalidInput('Invalid token signature')
+    try:
+        claims = json.loads(_b64decode(payload).decode('utf-8'))
+    except (ValueError, UnicodeError, binascii.Error):
+        raise errors.InvalidInput('Malformed token')
+    if claims['exp'] <= time.time():
+        raise errors.InvalidInput('Token expired')
+    if caches[settings.AUTH_TOKEN_CACHE].get(DENYLIST_PREFIX + claims['jti']):
+        raise errors.InvalidInput('Token revoked')
+    return claims
+
+def revoke(claims):
+    """
+    Deny a token until it expires
+    """
+    remaining = int(claims['exp'] - time.time()) + 1
+    if remaining > 0:
+        caches[settings.AUTH_TOKEN_CACHE].set(DENYLIST_PREFIX + claims['jti'],
+            True, remaining)
+
+def check_denylist_cache(app_configs, **kwargs):
+    """
+    System check: the denylist cache must be shared between processes, or a
+    logged out token stays valid in every other worker
+
+    A process-local cache is only a warning with DEBUG (a single runserver
+    process)
+    """
+    config = settings.CACHES.get(settings.AUTH_TOKEN_CACHE, None)
+    if config is None:
+        return [checks.Error('AUTH_TOKEN_CACHE (%r) is not in CACHES' %
+            settings.AUTH_TOKEN_CACHE, id='main.E001')]
+    if config.get('BACKEND') in PROCESS_LOCAL_CACHE_BACKENDS:
+        msg = ('The token denylist cache (%r) is not shared between '
+            'processes' % settings.AUTH_TOKEN_CACHE)
+        hint = ('Point AUTH_TOKEN_CACHE at a shared cache backend (file '
+            'based, database or memcached)')
+        if settings.DEBUG:
+            return [checks.Warning(msg, hint=hint, id='main.W001')]
+        return [checks.Error(msg, hint=hint, id='main.E002')]
+    return []
+
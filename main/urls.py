@@ -44,6 +44,9 @@ profile_nested_router.register(r'connected', views.FanConnectionViewSet,
 urlpatterns = [
     url(r'^', include(router.urls)),
     url(r'^artists-in-radius/$', views.ArtistInRadiusView),
+    url(r'^artists-in-radius/cache/$', views.GeoQueryCacheStatsView),
+    url(r'^nearest-artists/$', views.NearestArtistsView),
+    url(r'^shows-in-radius/$', views.ShowInRadiusView),
     url(r'^', include(artist_nested_router.urls)),
     url(r'^', include(profile_nested_router.urls)),
     url(r'^login/$', views.LoginView),
@@ -1,9 +1,18 @@
 """
 Utility functions
 """
+import base64
+import binascii
+import calendar
+import json
 import logging
 import math
 
+import numpy as np
+
+import main.constants as constants
+import main.errors as errors
+
 logger = logging.getLogger('fanmobi')
 
 def str_to_bool(val):
@@ -36,8 +45,216 @@ def is_inside_radius(center_lat, center_lon, lat, lon, radius):
     lat = float(lat) * math.pi/180
     lon = float(lon) * math.pi/180
     radius = float(radius)
-    earth_radius_km = float(6371)
+    earth_radius_km = constants.EARTH_RADIUS_KM
     # calculate via Great Circle Distance: http://janmatuschek.de/LatitudeLongitudeBoundingCoordinates#Distance
-    km_apart = math.acos(math.sin(center_lat) * math.sin(lat) + math.cos(center_lat) * math.cos(lat) * math.cos(lon - (center_lon))) * earth_radius_km
-    logger.debug('two points are %s km apart' % km_apart)
-    return km_apart <= radius
\ No newline at end of file
+    # (rounding can push the cosine just past 1 for identical points)
+    cos_angle = math.sin(center_lat) * math.sin(lat) + math.cos(center_lat) * math.cos(lat) * math.cos(lon - (center_lon))
+    km_apart = math.acos(max(-1.0, min(1.0, cos_angle))) * earth_radius_km
+    return km_apart <= radius
+
+def get_distances(center_lat, center_lon, lats, lons):
+    """
+    Calculates the distance from a point to many other points at once
+
+    Uses the haversine formula, which (unlike the law of cosines used by
+    is_inside_radius) is numerically stable for points that are close
+    together
+
+    Args:
+        center_lat: the latitude (in degrees) of the center point
+        center_lon: the longitude (in degrees) of the center point
+        lats: sequence of latitudes (in degrees) of the points to measure
+        lons: sequence of longitudes (in degrees) of the points to measure
+
+    Returns:
+        numpy array of distances (in km), in the same order as lats/lons
+    """
+    center_lat = math.radians(float(center_lat))
+    center_lon = math.radians(float(center_lon))
+    lats = np.radians(np.asarray(lats, dtype=np.float64))
+    lons = np.radians(np.asarray(lons, dtype=np.float64))
+    sin_dlat = np.sin((lats - center_lat) / 2)
+    sin_dlon = np.sin((lons - center_lon) / 2)
+    a = sin_dlat * sin_dlat + \
+        math.cos(center_lat) * np.cos(lats) * sin_dlon * sin_dlon
+    return 2 * constants.EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+def get_points_inside_radius(center_lat, center_lon, lats, lons, radius):
+    """
+    Batch version of is_inside_radius
+
+    Args:
+        center_lat: the latitude (in degrees) of the center point
+        center_lon: the longitude (in degrees) of the center point
+        lats: sequence of latitudes (in degrees) of the points to test
+        lons: sequence of longitudes (in degrees) of the points to test
+        radius: the radius (in km) to check
+
+    Returns:
+        (distances, mask) numpy arrays, where distances are in km and mask is
+        True for each point within the radius
+    """
+    distances = get_distances(center_lat, center_lon, lats, lons)
+    return distances, distances <= float(radius)
+
+def encode_cursor(position):
+    """
+    Encode a position in an ordered result set as an opaque cursor string
+
+    Args:
+        position: a JSON serializable value (typically a list of the ordering
+            values of the last item returned)
+    """
+    data = json.dumps(position, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(data).decode('ascii')
+
+def decode_cursor(cursor):
+    """
+    Decode a cursor created by encode_cursor
+
+    Raises:
+        errors.InvalidInput if the cursor is malformed
+    """
+    try:
+        data = base64.urlsafe_b64decode(cursor.encode('ascii'))
+        return json.loads(data.decode('utf-8'))
+    except (binascii.Error, UnicodeError, ValueError, AttributeError):
+        raise errors.InvalidInput('Invalid cursor')
+
+def parse_coordinate(val):
+    """
+    Convert a coordinate (in decimal degrees) to a float
+
+    Returns None if the value is missing or not a number
+    """
+    if val is None or val == '':
+        return None
+    try:
+        val = float(val)
+    except (TypeError, ValueError):
+        return None
+    if math.isnan(val) or math.isinf(val):
+        return None
+    return val
+
+def _grid_dimensions():
+    """
+    Returns the number of (rows, columns) in the location grid
+    """
+    size = constants.GEO_CELL_SIZE_DEGREES
+    return int(math.ceil(180 / size)), int(math.ceil(360 / size))
+
+def _grid_row(lat):
+    rows, cols = _grid_dimensions()
+    row = int(math.floor((lat + 90) / constants.GEO_CELL_SIZE_DEGREES))
+    return min(max(row, 0), rows - 1)
+
+def _grid_col(lon):
+    rows, cols = _grid_dimensions()
+    col = int(math.floor((lon + 180) / constants.GEO_CELL_SIZE_DEGREES))
+    return col % cols
+
+def get_geo_cell(lat, lon):
+    """
+    Get the id of the grid cell containing a point
+
+    The world is divided into a fixed grid of
+    constants.GEO_CELL_SIZE_DEGREES sized cells, numbered row by row
+    starting at the south pole and the antimeridian
+
+    Args:
+        lat: the latitude (in degrees) of the point
+        lon: the longitude (in degrees) of the point
+
+    Returns:
+        the cell id, or None if either coordinate is missing or invalid
+    """
+    lat = parse_coordinate(lat)
+    lon = parse_coordinate(lon)
+    if lat is None or lon is None or abs(lat) > 90:
+        return None
+    rows, cols = _grid_dimensions()
+    return _grid_row(lat) * cols + _grid_col(lon)
+
+def get_time_bucket(dt):
+    """
+    Get the time bucket (constants.SHOW_TIME_BUCKET_SECONDS wide, counted
+    from the Unix epoch in UTC) containing a datetime
+
+    Returns None if dt is None
+    """
+    if dt is None:
+        return None
+    return int(calendar.timegm(dt.utctimetuple()) //
+        constants.SHOW_TIME_BUCKET_SECONDS)
+
+def get_bounding_box(center_lat, center_lon, radius):
+    """
+    Get the latitude/longitude bounding box of a circle on the Earth's surface
+
+    See http://janmatuschek.de/LatitudeLongitudeBoundingCoordinates
+
+    Args:
+        center_lat: the latitude (in degrees) of the center point
+        center_lon: the longitude (in degrees) of the center point
+        radius: the radius (in km) of the circle
+
+    Returns:
+        (min_lat, max_lat, min_lon, max_lon) in degrees. If the box crosses
+        the antimeridian, min_lon will be greater than max_lon
+    """
+    lat = math.radians(float(center_lat))
+    lon = math.radians(float(center_lon))
+    # angular radius
+    angle = float(radius) / constants.EARTH_RADIUS_KM
+    min_lat = lat - angle
+    max_lat = lat + angle
+    if min_lat > -math.pi / 2 and max_lat < math.pi / 2:
+        delta_lon = math.asin(min(math.sin(angle) / math.cos(lat), 1.0))
+        min_lon = lon - delta_lon
+        if min_lon < -math.pi:
+            min_lon += 2 * math.pi
+        max_lon = lon + delta_lon
+        if max_lon > math.pi:
+            max_lon -= 2 * math.pi
+    else:
+        # a pole is within the circle - every longitude is covered
+        min_lat = max(min_lat, -math.pi / 2)
+        max_lat = min(max_lat, math.pi / 2)
+        min_lon, max_lon = -math.pi, math.pi
+    return (math.degrees(min_lat), math.degrees(max_lat),
+        math.degrees(min_lon), math.degrees(max_lon))
+
+def get_cells_in_radius(center_lat, center_lon, radius):
+    """
+    Get the ids of all grid cells that overlap a circle
+
+    Args:
+        center_lat: the latitude (in degrees) of the center point
+        center_lon: the longitude (in degrees) of the center point
+        radius: the radius (in km) of the circle
+
+    Returns:
+        a list of cell ids, or None if the circle covers more than
+        constants.GEO_MAX_QUERY_CELLS cells (callers should then consider
+        every cell)
+    """
+    min_lat, max_lat, min_lon, max_lon = get_bounding_box(center_lat,
+        center_lon, radius)
+    rows, cols = _grid_dimensions()
+    row_ids = range(_grid_row(min_lat), _grid_row(max_lat) + 1)
+    if min_lon <= max_lon:
+        first_col, last_col = _grid_col(min_lon), _grid_col(max_lon)
+        if max_lon - min_lon >= 360 - constants.GEO_CELL_SIZE_DEGREES:
+            col_ids = list(range(cols))
+        elif first_col <= last_col:
+            col_ids = list(range(first_col, last_col + 1))
+        else:
+            col_ids = list(range(first_col, cols)) + list(range(0, last_col + 1))
+    else:
+        # crosses the antimeridian
+        col_ids = list(range(_grid_col(min_lon), cols)) + \
+            list(range(0, _grid_col(max_lon) + 1))
+    if len(row_ids) * len(col_ids) > constants.GEO_MAX_QUERY_CELLS:
+        return None
+    return [row * cols + col for row in row_ids for col in col_ids]
@@ -1,15 +1,26 @@
 """
 Views
 """
+import csv
+import datetime
+import json
 import logging
 import math
+import time
 
 import requests
 
+from django.conf import settings
+from django.db import connection
+from django.db import transaction
 from django.shortcuts import get_object_or_404
 from django.http import HttpResponse
+from django.http import StreamingHttpResponse
+from django.utils import timezone
 
 from rest_framework.decorators import api_view
+from rest_framework.decorators import detail_route
+from rest_framework.decorators import list_route
 from rest_framework.decorators import permission_classes
 from rest_framework import generics
 from rest_framework import permissions as rf_permissions
@@ -17,11 +28,19 @@ from rest_framework import status
 from rest_framework import viewsets
 from rest_framework import mixins as mixins
 from rest_framework.parsers import MultiPartParser, JSONParser
+from rest_framework.renderers import JSONRenderer
 from rest_framework.response import Response
 
+import main.auth as auth
+import main.broker as broker
+import main.cache as cache
 import main.constants as constants
+import main.identity as identity
+import main.pagination as pagination
 import main.permissions as permissions
+import main.renderers as renderers
 import main.serializers as serializers
+import main.tokens as tokens
 import main.models as models
 import main.services as services
 import main.errors as errors
@@ -120,7 +139,7 @@ class BasicProfileViewSet(viewsets.ModelViewSet):
         return queryset
 
     def create(self, request):
-        if not services.is_admin(request.user.username):
+        if not services.is_admin(identity.get_identity(request)):
             return Response('Permission Denied',
                 status=status.HTTP_403_FORBIDDEN)
         try:
@@ -137,11 +156,58 @@ class BasicProfileViewSet(viewsets.ModelViewSet):
         except Exception as e:
             return Response('Error', status=status.HTTP_400_BAD_REQUEST)
 
+    @detail_route(methods=['get'])
+    def sync(self, request, pk=None):
+        """
+        Get changes to a user's followed artists, unread messages and shows
+
+        Without a `token`, everything is returned. Pass the `token` of the
+        response to the next request to only get what changed since. If
+        `full` is true, the client should replace its copy of the data rather
+        than apply the changes
+        ---
+        omit_serializer: true
+        parameters_strategy:
+            form: replace
+        parameters:
+            - name: token
+              paramType: query
+        """
+        if not services.can_access(identity.get_identity(request), pk):
+            return Response('Permission Denied',
+                status=status.HTTP_403_FORBIDDEN)
+        token = request.query_params.get('token', None)
+        since = None
+        if token:
+            try:
+                since = utils.decode_cursor(token)
+                if not isinstance(since, int):
+                    raise errors.InvalidInput('Invalid token')
+            except errors.InvalidInput:
+                return Response('Invalid token',
+                    status=status.HTTP_400_BAD_REQUEST)
+        changes = services.get_changes(int(pk), since=since)
+        context = {'request': request}
+        return Response({
+            'token': utils.encode_cursor(changes['token']),
+            'full': changes['full'],
+            'follows': serializers.ArtistProfileShortSerializer(
+                changes['follows'], many=True, context=context).data,
+            'unfollows': changes['unfollows'],
+            'messages': serializers.MessageSerializer(changes['messages'],
+                many=True, context=context).data,
+            'deleted_messages': changes['deleted_messages'],
+            'dismissed_messages': changes['dismissed_messages'],
+            'shows': serializers.ShowWithArtistSerializer(changes['shows'],
+                many=True, context=context).data,
+            'deleted_shows': changes['deleted_shows']
+        }, status=status.HTTP_200_OK)
+
     def list(self, request):
         """
         Get all Profiles (ADMIN only)
         """
-        if not services.is_admin(request.user.username):
+        if not services.is_admin(identity.get_identity(request)):
             return Response('Permission Denied',
                 status=status.HTTP_403_FORBIDDEN)
         return super(BasicProfileViewSet, self).list(self, request)
@@ -220,6 +286,7 @@ class ShowViewSet(viewsets.ModelViewSet):
     """
     permission_classes = (permissions.IsArtistOrReadOnly,)
     serializer_class = serializers.ShowSerializer
+    pagination_class = pagination.ShowKeysetPagination
 
     def get_queryset(self):
         return services.get_all_shows()
@@ -255,7 +322,7 @@ class ShowViewSet(viewsets.ModelViewSet):
         """
         Create a new show for an artist
         """
-        if not services.can_access(request.user.username, artist_pk):
+        if not services.can_access(identity.get_identity(request), artist_pk):
             return Response('Permission Denied',
                 status=status.HTTP_403_FORBIDDEN)
         try:
@@ -278,7 +345,7 @@ class ShowViewSet(viewsets.ModelViewSet):
         """
         Update an existing show for an artist
         """
-        if not services.can_access(request.user.username, artist_pk):
+        if not services.can_access(identity.get_identity(request), artist_pk):
             return Response('Permission Denied',
                 status=status.HTTP_403_FORBIDDEN)
         try:
@@ -302,13 +369,13 @@ class ShowViewSet(viewsets.ModelViewSet):
         """
         Delete a show for an artist
         """
-        if not services.can_access(request.user.username, artist_pk):
+        if not services.can_access(identity.get_identity(request), artist_pk):
             return Response('Permission Denied',
                 status=status.HTTP_403_FORBIDDEN)
         queryset = self.get_queryset()
         show = get_object_or_404(queryset, pk=pk)
         try:
-            services.delete_show(request.user.username, show)
+            services.delete_show(identity.get_identity(request), show)
         except errors.PermissionDenied:
             return Response('Cannot update another artist\'s show',
                 status=status.HTTP_403_FORBIDDEN)
@@ -318,6 +385,7 @@ class ShowViewSet(viewsets.ModelViewSet):
 class MessageViewSet(viewsets.ModelViewSet):
     permission_classes = (permissions.IsArtistOrReadOnly,)
     serializer_class = serializers.MessageSerializer
+    pagination_class = pagination.MessageKeysetPagination
 
     def get_queryset(self):
         return services.get_all_messages()
@@ -326,7 +394,7 @@ class MessageViewSet(viewsets.ModelViewSet):
         """
         List all messages from an artist
         """
-        if not services.can_access(request.user.username, artist_pk):
+        if not services.can_access(identity.get_identity(request), artist_pk):
             return Response('Permission Denied',
                 status=status.HTTP_403_FORBIDDEN)
         queryset = self.get_queryset().filter(artist__id=artist_pk)
@@ -358,7 +426,7 @@ class MessageViewSet(viewsets.ModelViewSet):
         """
         Create a new message for an artist
         """
-        if not services.can_access(request.user.username, artist_pk):
+        if not services.can_access(identity.get_identity(request), artist_pk):
             return Response('Permission Denied',
                 status=status.HTTP_403_FORBIDDEN)
         try:
@@ -381,13 +449,13 @@ class MessageViewSet(viewsets.ModelViewSet):
         """
         Delete a message from an artist
         """
-        if not services.can_access(request.user.username, artist_pk):
+        if not services.can_access(identity.get_identity(request), artist_pk):
             return Response('Permission Denied',
                 status=status.HTTP_403_FORBIDDEN)
         queryset = self.get_queryset()
         message = get_object_or_404(queryset, pk=pk)
         try:
-            services.delete_message(request.user.username, message)
+            services.delete_message(identity.get_identity(request), message)
         except errors.PermissionDenied:
             return Response('Permission Denied',
                 status=status.HTTP_403_FORBIDDEN)
@@ -397,24 +465,20 @@ class MessageViewSet(viewsets.ModelViewSet):
 class FanMessageViewSet(ListDestroyModelViewSet):
     permission_classes = (permissions.IsAuthenticated,)
     serializer_class = serializers.MessageSerializer
+    pagination_class = pagination.MessageKeysetPagination
 
     def get_queryset(self):
-        username = self.request.user.username
-        if services.is_admin(username):
-            return services.get_all_messages()
-        else:
-            return services.get_all_unread_messages(username)
+        return services.get_unread_messages(self.kwargs['profile_pk'])
 
     def list(self, request, profile_pk=None):
         """
         Get all unread messages for a user
         """
-        if not services.can_access(request.user.username, profile_pk):
+        if not services.can_access(identity.get_identity(request), profile_pk):
             return Response('Permission Denied',
                 status=status.HTTP_403_FORBIDDEN)
 
-        requested_user = models.BasicProfile.objects.get(id=profile_pk)
-        queryset = services.get_all_unread_messages(requested_user.user.username)
+        queryset = self.get_queryset()
         # because we override the queryset here, we must
         # manually invoke the pagination methods
         page = self.paginate_queryset(queryset)
@@ -430,16 +494,144 @@ class FanMessageViewSet(ListDestroyModelViewSet):
         """
         Mark a message as read for a user
         """
+        if not services.can_access(identity.get_identity(request), profile_pk):
+            return Response('Permission Denied',
+                status=status.HTTP_403_FORBIDDEN)
         queryset = self.get_queryset()
-        basic_profile = models.BasicProfile.objects.get(id=profile_pk)
         message = get_object_or_404(queryset, pk=pk)
         try:
-            services.mark_message_as_read(basic_profile.user.username, message)
+            services.mark_message_as_read(int(profile_pk), message)
         except errors.PermissionDenied:
             return Response('Permission Denied',
                 status=status.HTTP_403_FORBIDDEN)
         return Response(status=status.HTTP_204_NO_CONTENT)
 
+    @list_route(methods=['get'], renderer_classes=(JSONRenderer,
+        renderers.EventStreamRenderer))
+    def stream(self, request, profile_pk=None):
+        """
+        Stream new messages from followed artists as server-sent events
+
+        Each message is sent as a `message` event with the message id as the
+        event id. The stream ends after a few minutes and clients (e.g.
+        EventSource) reconnect, sending the id of the last message they got
+        as `Last-Event-ID` to receive any unread messages they missed
+        ---
+        omit_serializer: true
+        """
+        if not services.can_access(identity.get_identity(request), profile_pk):
+            return Response('Permission Denied',
+                status=status.HTTP_403_FORBIDDEN)
+        try:
+            after = int(request.META.get('HTTP_LAST_EVENT_ID', ''))
+        except ValueError:
+            after = None
+        response = StreamingHttpResponse(
+            _message_events(request, int(profile_pk), after),
+            content_type='text/event-stream')
+        response['Cache-Control'] = 'no-cache'
+        # don't let nginx buffer the stream
+        response['X-Accel-Buffering'] = 'no'
+        return response
+
+    @list_route(methods=['get'])
+    def unread_count(self, request, profile_pk=None):
+        """
+        Get the number of unread messages for a user
+        ---
+        omit_serializer: true
+        """
+        if not services.can_access(identity.get_identity(request), profile_pk):
+            return Response('Permission Denied',
+                status=status.HTTP_403_FORBIDDEN)
+        count = services.get_unread_count(int(profile_pk))
+        return Response({'unread_count': count}, status=status.HTTP_200_OK)
+
+    @list_route(methods=['post'])
+    def dismiss(self, request, profile_pk=None):
+        """
+        Mark several messages as read for a user
+
+        Provide either `ids`, a list of message ids, or `up_to`, to mark every
+        unread message with an id up to and including it as read
+        ---
+        omit_serializer: true
+        parameters_strategy:
+            form: replace
+        parameters:
+            - name: ids
+              description: ids of the messages to mark as read
+              type: array
+            - name: up_to
+              description: mark all messages up to this id as read
+              type: integer
+        """
+        if not services.can_access(identity.get_identity(request), profile_pk):
+            return Response('Permission Denied',
+                status=status.HTTP_403_FORBIDDEN)
+        ids = request.data.get('ids', None)
+        up_to = request.data.get('up_to', None)
+        try:
+            if ids is not None:
+                if not isinstance(ids, list):
+                    raise errors.InvalidInput('ids must be a list')
+                ids = [int(i) for i in ids]
+            if up_to is not None:
+                up_to = int(up_to)
+            count = services.dismiss_messages(int(profile_pk),
+                message_ids=ids, up_to=up_to)
+        except (ValueError, TypeError):
+            return Response('Message ids must be integers',
+                status=status.HTTP_400_BAD_REQUEST)
+        except errors.InvalidInput as e:
+            return Response(str(e), status=status.HTTP_400_BAD_REQUEST)
+        return Response({'dismissed': count}, status=status.HTTP_200_OK)
+
+def _message_events(request, profile_id, after=None):
+    """
+    Generate server-sent events for a fan's new messages
+
+    Args:
+        request: the request (for serializer context)
+        profile_id: id of the fan's models.BasicProfile
+        after: also send unread messages with ids greater than this
+    """
+    followed = models.ArtistProfile.connected_users.through.objects.filter(
+        basicprofile_id=profile_id).values_list('artistprofile_id', flat=True)
+    subscription = broker.get_broker().subscribe(list(followed))
+    try:
+        yield 'retry: %d\n\n' % settings.MESSAGE_STREAM_RETRY_MILLISECONDS
+        unread = services.get_unread_messages(profile_id).order_by('id')
+        messages = unread.filter(id__gt=after) if after is not None else []
+        deadline = time.time() + settings.MESSAGE_STREAM_MAX_SECONDS
+        while True:
+            for message in messages:
+                data = serializers.MessageSerializer(message,
+                    context={'request': request}).data
+                yield 'id: %d\nevent: message\ndata: %s\n\n' % (message.id,
+                    JSONRenderer().render(data).decode('utf-8'))
+            if not connection.in_atomic_block:
+                # don't hold a database connection while idle
+                connection.close()
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return
+            message_id = subscription.get(timeout=min(remaining,
+                settings.MESSAGE_STREAM_HEARTBEAT_SECONDS))
+            if message_id is None:
+                yield ': keepalive\n\n'
+                messages = []
+                continue
+            message_ids = [message_id]
+            message_id = subscription.get(timeout=0)
+            while message_id is not None:
+                message_ids.append(message_id)
+                message_id = subscription.get(timeout=0)
+            # skips anything dismissed (or deleted) in the meantime
+            messages = unread.filter(id__in=message_ids)
+    finally:
+        subscription.close()
+
 class ArtistConnectionViewSet(ListModelViewSet):
     permission_classes = (permissions.IsAuthenticated,)
     serializer_class = serializers.BasicProfileShortSerializer
@@ -448,7 +640,7 @@ class ArtistConnectionViewSet(ListModelViewSet):
         """
         Get all users connected to an artist
         """
-        if not services.can_access(request.user.username, artist_pk):
+        if not services.can_access(identity.get_identity(request), artist_pk):
             return Response('Permission Denied',
                 status=status.HTTP_403_FORBIDDEN)
         artist = models.ArtistProfile.objects.get(id=artist_pk)
@@ -464,6 +656,57 @@ class ArtistConnectionViewSet(ListModelViewSet):
             context={'request': request})
         return Response(serializer.data)
 
+    @list_route(methods=['get'], renderer_classes=(renderers.NDJSONRenderer,
+        renderers.CSVRenderer))
+    def export(self, request, artist_pk=None):
+        """
+        Export all users connected to an artist
+
+        Streams one row per follower (`id`, `username`, `email`) as newline
+        delimited JSON, or as CSV with `?format=csv`
+        ---
+        omit_serializer: true
+        """
+        current = identity.get_identity(request)
+        if current is None or not current.can_manage_artist(artist_pk):
+            return Response('Permission Denied',
+                status=status.HTTP_403_FORBIDDEN)
+        artist = services.get_artist_by_id(artist_pk)
+        if artist is None:
+            return Response('Artist not found',
+                status=status.HTTP_404_NOT_FOUND)
+        rows = services.iter_followers(artist.id)
+        renderer = request.accepted_renderer
+        if renderer.format == 'csv':
+            content = _csv_lines(rows)
+        else:
+            content = _ndjson_lines(rows)
+        response = StreamingHttpResponse(content,
+            content_type=renderer.media_type)
+        response['Content-Disposition'] = \
+            'attachment; filename="followers-%d.%s"' % (artist.id,
+            renderer.format)
+        return response
+
+class _Echo(object):
+    """
+    A file-like object that returns what is written to it (to get the lines
+    csv.writer produces)
+    """
+    def write(self, value):
+        return value
+
+def _csv_lines(rows):
+    writer = csv.writer(_Echo())
+    yield writer.writerow(('id', 'username', 'email'))
+    for row in rows:
+        yield writer.writerow(row)
+
+def _ndjson_lines(rows):
+    for profile_id, username, email in rows:
+        yield json.dumps({'id': profile_id, 'username': username,
+            'email': email}) + '\n'
+
 class FanConnectionViewSet(ListUpdateDestroyModelViewSet):
     """
     Artist connections
@@ -475,7 +718,7 @@ class FanConnectionViewSet(ListUpdateDestroyModelViewSet):
         """
         Get all artists followed by a user
         """
-        if not services.can_access(request.user.username, profile_pk):
+        if not services.can_access(identity.get_identity(request), profile_pk):
             return Response('Permission Denied',
                 status=status.HTTP_403_FORBIDDEN)
         queryset = models.ArtistProfile.objects.filter(connected_users__in=[profile_pk])
@@ -494,21 +737,12 @@ class FanConnectionViewSet(ListUpdateDestroyModelViewSet):
         """
         Unfollow an artist
         """
-        if not services.can_access(request.user.username, profile_pk):
+        if not services.can_access(identity.get_identity(request), profile_pk):
             return Response('Permission Denied',
                 status=status.HTTP_403_FORBIDDEN)
         try:
             artist = models.ArtistProfile.objects.get(id=pk)
-            updated_connected_users = []
-            found = False
-            for i in artist.connected_users.all():
-                if str(i.id) != str(profile_pk):
-                    updated_connected_users.append(i)
-                else:
-                    found = True
-            artist.connected_users.clear()
-            artist.connected_users = updated_connected_users
-            if found:
+            if services.unfollow_artist(artist.id, int(profile_pk)):
                 return Response(status=status.HTTP_204_NO_CONTENT)
             else:
                 return Response(status=status.HTTP_404_NOT_FOUND)
@@ -516,6 +750,88 @@ class FanConnectionViewSet(ListUpdateDestroyModelViewSet):
             return Response('Unable to complete the request',
                 status=status.HTTP_400_BAD_REQUEST)
 
+    @list_route(methods=['post'])
+    def bulk(self, request, profile_pk=None):
+        """
+        Follow and/or unfollow several artists at once
+
+        Returns the ids of the artists that were followed and unfollowed
+        (artists that were already followed, or weren't, are skipped)
+        ---
+        omit_serializer: true
+        parameters_strategy:
+            form: replace
+        parameters:
+            - name: follow
+              description: ids of artists to follow
+              type: array
+            - name: unfollow
+              description: ids of artists to unfollow
+              type: array
+        """
+        if not services.can_access(identity.get_identity(request), profile_pk):
+            return Response('Permission Denied',
+                status=status.HTTP_403_FORBIDDEN)
+        try:
+            follow = request.data.get('follow', [])
+            unfollow = request.data.get('unfollow', [])
+            if not isinstance(follow, list) or not isinstance(unfollow, list):
+                raise errors.InvalidInput('follow and unfollow must be lists')
+            follow = [int(i) for i in follow]
+            unfollow = [int(i) for i in unfollow]
+            with transaction.atomic():
+                followed = services.follow_artists(int(profile_pk), follow)
+                unfollowed = services.unfollow_artists(int(profile_pk),
+                    unfollow)
+        except (ValueError, TypeError):
+            return Response('Artist ids must be integers',
+                status=status.HTTP_400_BAD_REQUEST)
+        except errors.InvalidInput as e:
+            return Response(str(e), status=status.HTTP_400_BAD_REQUEST)
+        return Response({'followed': followed, 'unfollowed': unfollowed},
+            status=status.HTTP_200_OK)
+
+    @list_route(methods=['post'], url_path='import')
+    def import_follows(self, request, profile_pk=None):
+        """
+        Follow every artist matching a list of artist ids and/or facebook
+        page ids
+
+        Returns the ids of the artists that matched and that were newly
+        followed, plus the ids that matched no artist
+        ---
+        omit_serializer: true
+        parameters_strategy:
+            form: replace
+        parameters:
+            - name: artist_ids
+              description: ids of artists to follow
+              type: array
+            - name: facebook_page_ids
+              description: facebook page ids of artists to follow
+              type: array
+        """
+        if not services.can_access(identity.get_identity(request), profile_pk):
+            return Response('Permission Denied',
+                status=status.HTTP_403_FORBIDDEN)
+        try:
+            artist_ids = request.data.get('artist_ids', [])
+            page_ids = request.data.get('facebook_page_ids', [])
+            if not isinstance(artist_ids, list) or \
+                    not isinstance(page_ids, list):
+                raise errors.InvalidInput(
+                    'artist_ids and facebook_page_ids must be lists')
+            artist_ids = [int(i) for i in artist_ids]
+            page_ids = [str(i) for i in page_ids]
+            result = services.import_follows(int(profile_pk), artist_ids,
+                page_ids)
+        except (ValueError, TypeError):
+            return Response('Artist ids must be integers',
+                status=status.HTTP_400_BAD_REQUEST)
+        except errors.InvalidInput as e:
+            return Response(str(e), status=status.HTTP_400_BAD_REQUEST)
+        return Response(result, status=status.HTTP_200_OK)
+
     def update(self, request, pk=None, profile_pk=None):
         """
         Follow an artist
@@ -523,13 +839,13 @@ class FanConnectionViewSet(ListUpdateDestroyModelViewSet):
         omit_parameters:
             - body
         """
-        if not services.can_access(request.user.username, profile_pk):
+        if not services.can_access(identity.get_identity(request), profile_pk):
             return Response('Permission Denied',
                 status=status.HTTP_403_FORBIDDEN)
         try:
             artist = models.ArtistProfile.objects.get(id=pk)
             basic_profile = models.BasicProfile.objects.get(id=profile_pk)
-            artist.connected_users.add(basic_profile)
+            services.follow_artist(artist.id, basic_profile.id)
             return Response('Followed artist', status=status.HTTP_200_OK)
         except errors.PermissionDenied:
             return Response('Permission Denied',
@@ -550,6 +866,10 @@ def LoginView(request):
 
     If a user with the corresponding `anonymous_id` or `fb_access_token` is
     not found, it will be created
+
+    The returned `token` can be sent as an `Authorization: Bearer <token>`
+    header instead of using the session. It expires, and doesn't pick up
+    role changes (e.g. becoming an artist) until the next login
     ---
     omit_serializer: true
     parameters_strategy:
@@ -572,15 +892,20 @@ def LoginView(request):
       msg:
         required: false
         type: string
+      token:
+        required: true
+        type: string
     """
     if 'username' in request.session:
         # already logged in
         username = request.session['username']
         user_profile = services.get_profile(username)
+        artist_id = services.get_artist_id_by_username(username)
         r_data = {'username': username,
             'msg': 'already logged in as user: %s' % username,
             'id': user_profile.id,
-            'artist_id': services.get_artist_id_by_username(username)}
+            'artist_id': artist_id,
+            'token': tokens.issue(user_profile, artist_id)[0]}
         return Response(r_data,
             status=status.HTTP_200_OK)
     user_profile = None
@@ -612,8 +937,9 @@ def LoginView(request):
             status=HTTP_400_BAD_REQUEST)
 
     user_profile = services.get_profile(username)
+    artist_id = None
     if not user_profile:
-        # if user doesn't exist, create them
+        # if user doesn't exist, create them (with an unusable password)
         kwargs = {}
         kwargs['groups'] = ['FAN']
 
@@ -621,10 +947,16 @@ def LoginView(request):
         p = models.BasicProfile.create_user(username, **kwargs)
         user_profile = p
         logger.info('created user %s' % (user_profile.user.username))
+    else:
+        artist_id = services.get_artist_id_by_username(username)
+    # log in on a new session key, so nothing cached for the old one (see
+    # auth.FanmobiAuthentication) applies to this user
+    auth.forget_session(request.session.session_key)
+    request.session.cycle_key()
     request.session['username'] = user_profile.user.username
-    artist_id = services.get_artist_id_by_username(username)
     r_data = {'username': username, 'name': friendly_name, 'artist_id': artist_id,
-        'facebook_authenticated': bool(fb_access_token), 'profile_id': user_profile.id}
+        'facebook_authenticated': bool(fb_access_token), 'profile_id': user_profile.id,
+        'token': tokens.issue(user_profile, artist_id)[0]}
     if fb_access_token:
         request.session['fb_access_token'] = fb_access_token
 
@@ -637,7 +969,8 @@ def LogoutView(request):
     Logout user
 
     Provides the `username` of the user that was logged out. Value will be
-    null if no user was logged in
+    null if no user was logged in. A token used to authenticate the request
+    is revoked
     ---
     omit_serializer: true
     type:
@@ -649,11 +982,26 @@ def LogoutView(request):
         username = None
     else:
         username = request.session['username']
+    if isinstance(request.user, tokens.TokenUser):
+        # deny the token until it expires
+        username = request.user.username
+        tokens.revoke(request.user.claims)
+    auth.forget_session(request.session.session_key)
     request.session.flush()
     r_data = {'username': username}
     return Response(r_data, status=status.HTTP_200_OK)
 
 
+def _finite_float(value, name):
+    """
+    Convert a query parameter to a float, rejecting NaN and infinity
+    """
+    value = float(value)
+    if math.isnan(value) or math.isinf(value):
+        raise errors.InvalidInput('%s must be a finite number' % name)
+    return value
+
+
 @api_view(['GET'])
 @permission_classes((permissions.IsAuthenticated,))
 def ArtistInRadiusView(request):
@@ -672,30 +1020,127 @@ def ArtistInRadiusView(request):
           paramType: query
     """
     try:
-        radius = request.query_params.get('radius')
-        user_lat = request.query_params.get('latitude')
-        user_lon = request.query_params.get('longitude')
+        radius = _finite_float(request.query_params.get('radius'), 'radius')
+        user_lat = _finite_float(request.query_params.get('latitude'), 'latitude')
+        user_lon = _finite_float(request.query_params.get('longitude'), 'longitude')
     except Exception as e:
         return Response('Bad request: %s' % str(e), status=status.HTTP_400_BAD_REQUEST)
     logger.debug('looking for artists in a %s km radius of lat: %s, long: %s' % (radius, user_lat, user_lon))
-    # In general, x and y must satisfy (x - center_x)^2 + (y - center_y)^2 < radius^2
-    artists = services.get_all_artists()
-    artists_in_radius = []
-    for a in artists:
-        if not a.basic_profile.current_latitude or not a.basic_profile.current_longitude:
-            continue
-        artist_lat = a.basic_profile.current_latitude
-        artist_lon = a.basic_profile.current_longitude
-        logger.debug('checking if artist %s is within range' % a.basic_profile.user.username)
-        logger.debug('artist lat: %s, artist lon: %s' % (artist_lat, artist_lon))
-        logger.debug('user lat: %s, user lon: %s' % (user_lat, user_lon))
-        if utils.is_inside_radius(user_lat, user_lon, artist_lat, artist_lon, radius):
-            artists_in_radius.append(a)
+    artists_in_radius = services.get_cached_artists_in_radius(user_lat,
+        user_lon, radius)
     serializer = serializers.ArtistProfileSerializer(artists_in_radius, many=True,
         context={'request': request})
     return Response(serializer.data, status=status.HTTP_200_OK)
 
 
+@api_view(['GET'])
+@permission_classes((permissions.IsAdmin,))
+def GeoQueryCacheStatsView(request):
+    """
+    Get hit/miss counters for the artists-in-radius cache of the worker
+    process handling this request (ADMIN only)
+    ---
+    omit_serializer: true
+    """
+    query_cache = cache.get_geo_query_cache()
+    if not query_cache:
+        return Response('Cache is disabled', status=status.HTTP_404_NOT_FOUND)
+    return Response(query_cache.stats(), status=status.HTTP_200_OK)
+
+
+@api_view(['GET'])
+@permission_classes((permissions.IsAuthenticated,))
+def NearestArtistsView(request):
+    """
+    Get the artists nearest to given coordinates (in decimal degrees), closest
+    first
+
+    Each result includes the artist's `distance` (in km). If there may be more
+    results, `next` is a cursor that can be passed back as `cursor` to get the
+    next page
+    ---
+    omit_serializer: true
+    parameters_strategy:
+        form: replace
+    parameters:
+        - name: latitude
+          paramType: query
+        - name: longitude
+          paramType: query
+        - name: limit
+          paramType: query
+        - name: cursor
+          paramType: query
+    """
+    try:
+        user_lat = _finite_float(request.query_params.get('latitude'), 'latitude')
+        user_lon = _finite_float(request.query_params.get('longitude'), 'longitude')
+        limit = int(request.query_params.get('limit',
+            constants.NEAREST_ARTISTS_DEFAULT_LIMIT))
+        limit = min(max(limit, 1), constants.NEAREST_ARTISTS_MAX_LIMIT)
+        cursor = request.query_params.get('cursor', None)
+        after = utils.decode_cursor(cursor) if cursor else None
+        if after is not None and (not isinstance(after, list) or
+                len(after) != 2 or not all(isinstance(v, (int, float)) and
+                not isinstance(v, bool) and math.isfinite(v) for v in after)):
+            raise errors.InvalidInput('Invalid cursor')
+    except Exception as e:
+        return Response('Bad request: %s' % str(e), status=status.HTTP_400_BAD_REQUEST)
+    nearest = services.get_nearest_artists(user_lat, user_lon, limit,
+        after=after)
+    results = []
+    for artist, distance in nearest:
+        data = serializers.ArtistProfileShortSerializer(artist,
+            context={'request': request}).data
+        data['distance'] = round(distance, 3)
+        results.append(data)
+    next_cursor = None
+    if len(nearest) == limit:
+        artist, distance = nearest[-1]
+        next_cursor = utils.encode_cursor([distance, artist.id])
+    return Response({'next': next_cursor, 'results': results},
+        status=status.HTTP_200_OK)
+
+
+@api_view(['GET'])
+@permission_classes((permissions.IsAuthenticated,))
+def ShowInRadiusView(request):
+    """
+    Get shows within a radius (km) of given coordinates (in decimal degrees)
+    that are running at some point in the next `days` days (default 7),
+    ordered by start time
+    ---
+    omit_serializer: true
+    parameters_strategy:
+        form: replace
+    parameters:
+        - name: radius
+          paramType: query
+        - name: latitude
+          paramType: query
+        - name: longitude
+          paramType: query
+        - name: days
+          paramType: query
+    """
+    try:
+        radius = _finite_float(request.query_params.get('radius'), 'radius')
+        user_lat = _finite_float(request.query_params.get('latitude'), 'latitude')
+        user_lon = _finite_float(request.query_params.get('longitude'), 'longitude')
+        days = int(request.query_params.get('days',
+            constants.SHOWS_IN_RADIUS_DEFAULT_DAYS))
+        days = min(max(days, 0), constants.SHOWS_IN_RADIUS_MAX_DAYS)
+    except Exception as e:
+        return Response('Bad request: %s' % str(e), status=status.HTTP_400_BAD_REQUEST)
+    start = timezone.now()
+    end = start + datetime.timedelta(days=days)
+    shows = services.get_shows_in_radius(user_lat, user_lon, radius, start,
+        end)
+    serializer = serializers.ShowWithArtistSerializer(shows, many=True,
+        context={'request': request})
+    return Response(serializer.data, status=status.HTTP_200_OK)
+
+
 class ImageViewSet(viewsets.ModelViewSet):
     def get_queryset(self):
         return services.get_all_images()